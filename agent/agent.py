@@ -3,15 +3,27 @@
 """
 
 from pika import PlainCredentials, ConnectionParameters, BlockingConnection
+from pika import BasicProperties
+from pika.exceptions import AMQPError
 from logging import basicConfig, CRITICAL
-from datetime import datetime
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from random import uniform
+from time import time, sleep
 from metric import Metric
+from clock import Clock
 from socket import gethostname
+from codec import encode, DeviceDictionary, METRIC_IDS, CONTENT_TYPE
+from sampler import Sampler
+from stats import STATS
 
 
 class Agent(object):
     """Agent class"""
-    def __init__(self, user, password, ip, port, metric_labels):
+    def __init__(self, user, password, ip, port, metric_labels,
+                 collect_workers=0, collect_timeout=10, reply_exchange=None,
+                 device_refresh=60, spool=None, max_backoff=60,
+                 sample_interval=0, deadband=None):
         """Generate metrics list, connect to RabbitMQ server"""
         # Add valid metrics to list
         self.metric_list = []
@@ -20,21 +32,93 @@ class Agent(object):
             if metric is not None:
                 self.metric_list.append(metric)
 
-        # Connect to RabbitMQ server
+        # Single value metrics are read by the sampler every sample_interval
+        # seconds between requests, replies carry their summaries
+        self.sampler = None
+        if sample_interval > 0:
+            sampled = [metric for metric in self.metric_list
+                       if metric.get_type() in METRIC_IDS]
+            self.metric_list = [metric for metric in self.metric_list
+                                if metric not in sampled]
+            self.sampler = Sampler(sampled, sample_interval)
+            self.sampler.start()
+
+        # Prepare collector pool, metrics are collected one after another
+        # without it
+        self.collect_timeout = collect_timeout
+        self.pool = None
+        self.running = {}
+        if collect_workers > 0:
+            self.pool = ThreadPool(collect_workers, Metric.init_thread)
+
+        # One timestamp per collection cycle
+        self.clock = Clock()
+
+        # Per device values are sent without their device names while
+        # those do not change, and with them every device_refresh replies
+        self.devices = DeviceDictionary(device_refresh)
+
+        # Values that changed less than their deadband are not sent
+        self.deadband = deadband
+
+        # Replies wait in the spool while the broker is unreachable
+        self.spool = spool
+        self.processing_request = False
+        self.publishing = False
+        self.consuming = False
+        self.host = gethostname()
+
+        # Sharded controllers take replies by a consistent hash of the host
+        # name
+        if reply_exchange is None:
+            self.reply_exchange = ''
+            self.reply_routing_key = 'reply'
+        else:
+            self.reply_exchange = reply_exchange
+            self.reply_routing_key = self.host
+        self.reply_properties = BasicProperties(content_type=CONTENT_TYPE)
+
+        # Connect to RabbitMQ server, failed attempts are retried after
+        # an exponential backoff of up to max_backoff seconds
         credentials = PlainCredentials(user,
                                        password)
         basicConfig(format='%(levelname)s:%(message)s',
                     level=CRITICAL)
-        connection_parameters = ConnectionParameters(ip,
-                                                     port,
-                                                     '/',
-                                                     credentials)
-        self.connection = BlockingConnection(connection_parameters)
-        self.channel = self.connection.channel()
-        self.host = gethostname()
+        self.connection_parameters = ConnectionParameters(ip,
+                                                          port,
+                                                          '/',
+                                                          credentials)
+        self.max_backoff = max_backoff
+        self.backoff = 1
+        self.next_connect = 0
+        self.connection = None
+        self.channel = None
+        self.connect()
 
+    def connect(self):
+        """Connect to RabbitMQ server and prepare the request and reply
+        queues, spooled replies are sent once connected, returns whether
+        the agent is connected"""
+        try:
+            self.connection = BlockingConnection(self.connection_parameters)
+            self.channel = self.connection.channel()
+            self.declare()
+        except AMQPError as error:
+            self.connection = None
+            self.channel = None
+            delay = self.backoff
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+            self.next_connect = time() + delay
+            print 'Connection failed (%s), retrying in %d seconds' % (
+                error.__class__.__name__, delay)
+            return False
+        self.backoff = 1
+        self.drain_spool()
+        return self.connection is not None
+
+    def declare(self):
+        """Prepare request and reply queues"""
         # Prepare request queue
-        self.processing_request = False
         self.channel.exchange_declare(exchange='request',
                                       type='fanout')
         result = self.channel.queue_declare(exclusive=True)
@@ -46,42 +130,190 @@ class Agent(object):
                                    no_ack=True)
 
         # Prepare reply queue
-        self.channel.queue_declare(queue='reply')
+        if self.reply_exchange == '':
+            self.channel.queue_declare(queue='reply')
+        else:
+            self.channel.exchange_declare(exchange=self.reply_exchange,
+                                          type='x-consistent-hash')
+
+    def ensure_connected(self):
+        """Reconnect once the backoff delay is over, returns whether the
+        agent is connected"""
+        if self.connection is None and time() >= self.next_connect:
+            self.connect()
+        return self.connection is not None
+
+    def connection_lost(self, error):
+        """Forget a broken connection, the next attempt is immediate"""
+        print 'Connection lost (%s)' % error.__class__.__name__
+        self.connection = None
+        self.channel = None
+        self.next_connect = 0
+
+    def send(self, reply):
+        """Publish an encoded reply"""
+        self.channel.basic_publish(exchange=self.reply_exchange,
+                                   routing_key=self.reply_routing_key,
+                                   body=reply,
+                                   properties=self.reply_properties)
+
+    def publish_reply(self, reply):
+        """Send an encoded reply, or spool it while the broker is
+        unreachable, returns whether it was sent"""
+        if self.ensure_connected():
+            try:
+                self.send(reply)
+                return True
+            except AMQPError as error:
+                self.connection_lost(error)
+        if self.spool is not None:
+            self.spool.append(reply)
+            print 'Reply spooled'
+        return False
+
+    def drain_spool(self):
+        """Send the spooled replies, oldest first"""
+        if self.spool is None or self.spool.empty():
+            return
+        try:
+            sent = self.spool.drain(self.send)
+            print '%d spooled replies sent' % sent
+        except AMQPError as error:
+            self.connection_lost(error)
+
+    def sleep(self, duration):
+        """Wait duration seconds, serving the connection while there is
+        one"""
+        if self.connection is not None:
+            try:
+                self.connection.sleep(duration)
+                return
+            except AMQPError as error:
+                self.connection_lost(error)
+        sleep(duration)
 
     def request_metric(self, channel, method, properties, body):
         """Request local metrics and send them to the controller"""
         print 'Request received'
+        self.publish_metrics()
+
+    def publish_metrics(self):
+        """Collect local metrics and send them to the controller"""
         if not self.processing_request:
             self.processing_request = True
-            for metric in self.metric_list:
-                # Get current time, host and metric
-                metric_type = metric.get_type()
-                value = metric.get_value()
-
-                timestamp = [datetime.now().year,
-                             datetime.now().month,
-                             datetime.now().day,
-                             datetime.now().hour,
-                             datetime.now().minute,
-                             datetime.now().second,
-                             0]
-
-                # Send reply to controller
-                reply = str([timestamp, self.host, metric_type, value])
-                self.channel.basic_publish(exchange='',
-                                           routing_key='reply',
-                                           body=reply)
-                print 'Metric ' + metric_type + ' sent'
+            request_start = STATS.now()
+            Metric.new_cycle()
+            timestamp = self.clock.now_ms()
+            start = STATS.now()
+            samples = self.collect_metrics(timestamp)
+            STATS.record('request.collect', start)
+            if self.sampler is not None:
+                samples = self.sampler.summaries(timestamp) + samples
+            if self.deadband is not None:
+                samples = self.deadband.filter(samples)
+
+            # Send all metrics of this cycle in a single reply
+            if not samples:
+                print 'No changed metrics'
+            else:
+                start = STATS.now()
+                reply = encode(self.host, samples, self.devices)
+                STATS.record('request.encode', start)
+                start = STATS.now()
+                sent = self.publish_reply(reply)
+                STATS.record('request.publish', start)
+                if sent:
+                    print '%d metrics sent' % len(samples)
+            STATS.record('request', request_start)
             self.processing_request = False
 
+    def start_publishing(self, interval, jitter):
+        """Start publish loop, metrics are sent every interval seconds give
+        or take a random jitter fraction of it"""
+        self.publishing = True
+
+        # Random first cycle, agents started together do not publish together
+        self.sleep(uniform(0, interval))
+        while self.publishing:
+            cycle_start = time()
+            self.publish_metrics()
+            period = interval * uniform(1 - jitter, 1 + jitter)
+            self.sleep(max(0, period - (time() - cycle_start)))
+
+    def stop_publishing(self):
+        """Stop publish loop"""
+        self.publishing = False
+
+    def collect_metrics(self, timestamp=None):
+        """Get (timestamp, metric_type, value) samples of all metrics, all
+        samples of a cycle share its epoch millisecond timestamp"""
+        if timestamp is None:
+            timestamp = self.clock.now_ms()
+        if self.pool is None:
+            return [self.collect_metric(metric, timestamp)
+                    for metric in self.metric_list]
+
+        # Collect in parallel, every collector gets collect_timeout seconds
+        # from the start of the cycle, collectors that timed out are not
+        # started again before they return
+        results = []
+        for metric in self.metric_list:
+            result = self.running.get(metric)
+            if result is not None and not result.ready():
+                results.append(None)
+                continue
+            results.append(self.pool.apply_async(self.collect_metric,
+                                                 (metric, timestamp)))
+        deadline = time() + self.collect_timeout
+        samples = []
+        for metric, result in zip(self.metric_list, results):
+            if result is None:
+                samples.append((timestamp, metric.get_type(), None))
+                print 'Metric ' + metric.get_type() + ' still running'
+                continue
+            try:
+                samples.append(result.get(max(0, deadline - time())))
+                self.running.pop(metric, None)
+            except TimeoutError:
+                # Report slow collectors as missing
+                self.running[metric] = result
+                samples.append((timestamp, metric.get_type(), None))
+                print 'Metric ' + metric.get_type() + ' timed out'
+        return samples
+
+    def collect_metric(self, metric, timestamp):
+        """Get the (timestamp, metric_type, value) sample of a metric"""
+        start = STATS.now()
+        value = metric.get_value()
+        STATS.record('metric.' + metric.get_type(), start)
+        return (timestamp, metric.get_type(), value)
+
     def start_consuming(self):
-        """Start consuming request messages"""
-        self.channel.start_consuming()
+        """Start consuming request messages, reconnecting until stopped"""
+        self.consuming = True
+        while self.consuming:
+            if not self.ensure_connected():
+                sleep(max(0, self.next_connect - time()))
+                continue
+            try:
+                self.channel.start_consuming()
+                return
+            except AMQPError as error:
+                self.connection_lost(error)
 
     def stop_consuming(self):
         """Stop consuming request messages"""
-        self.channel.stop_consuming()
+        self.consuming = False
+        if self.channel is not None:
+            self.channel.stop_consuming()
 
     def disconnect(self):
         """Disconnect controller from RabbitMQ server"""
-        self.connection.close()
+        if self.connection is not None:
+            self.connection.close()
+        if self.pool is not None:
+            self.pool.terminate()
+        if self.sampler is not None:
+            self.sampler.stop()
+        if self.spool is not None:
+            self.spool.close()
@@ -0,0 +1,21 @@
+"""
+    Sample clock module
+"""
+from threading import Lock
+from time import time
+
+
+class Clock(object):
+    """Epoch millisecond timestamps that never repeat or go backwards,
+    the wall clock is followed again once it passes the last timestamp"""
+    def __init__(self):
+        self.lock = Lock()
+        self.last = 0
+
+    def now_ms(self):
+        """Get the current time in milliseconds since the epoch, one
+        millisecond past the previous timestamp after a clock step back"""
+        now = (int)(time() * 1000)
+        with self.lock:
+            self.last = max(now, self.last + 1)
+            return self.last
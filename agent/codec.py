@@ -0,0 +1,142 @@
+"""
+    Wire format module
+"""
+from collections import namedtuple
+from struct import Struct, pack
+
+# Content type of encoded replies, replies without it use the legacy
+# str()/literal_eval format
+CONTENT_TYPE = 'application/x-monitor-v1'
+VERSION = 1
+
+# Replies with per device samples
+DEVICES_VERSION = 2
+
+# Replies with per device samples and sample summaries
+SUMMARIES_VERSION = 3
+
+# Interned metric identifiers, must match controller/codec.py
+METRIC_IDS = {
+    'available_memory': 1,
+    'total_memory': 2,
+    'cpu_percentage': 3,
+    'network_bytes_sent': 4,
+    'network_bytes_received': 5,
+    'disk_reads_sec': 6,
+    'disk_writes_sec': 7,
+}
+
+# Interned per device metric identifiers, must match controller/codec.py
+VECTOR_METRIC_IDS = {
+    'cpu_percentage_per_core': 1,
+    'network_bytes_sent_per_nic': 2,
+    'network_bytes_received_per_nic': 3,
+    'disk_reads_sec_per_disk': 4,
+    'disk_writes_sec_per_disk': 5,
+}
+
+# Header: version, host name length, sample count
+HEADER = Struct('!BBH')
+
+# Sample: metric id, flags, epoch timestamp in milliseconds, value
+SAMPLE = Struct('!BBQq')
+
+# Summary of a flagged sample, following it: minimum, maximum, mean and
+# reading count, the sample value is the last reading
+SUMMARY = Struct('!qqdI')
+
+# Vector section: vector count, then per vector its metric id, flags,
+# epoch timestamp in milliseconds, device dictionary id and value count,
+# the device names when flagged and the packed values
+VECTOR_COUNT = Struct('!H')
+VECTOR = Struct('!BBQHH')
+DEVICE_NAME = Struct('!B')
+
+# Sample flags, missing samples carry no value, vectors flagged with
+# DEVICES carry their device names, samples flagged with SUMMARIZED are
+# followed by a summary
+MISSING = 0x01
+DEVICES = 0x02
+SUMMARIZED = 0x04
+
+# Readings of a metric over a request period
+Summary = namedtuple('Summary', 'min max mean last count')
+
+
+class DeviceDictionary(object):
+    """Device lists of per device metrics, a list is sent along with the
+    values when it changes and again every refresh replies"""
+    def __init__(self, refresh=60):
+        self.refresh = refresh
+        self.entries = {}
+
+    def pack(self, metric_type, pairs):
+        """Split (device, value) pairs into a dictionary id, the device
+        names when they are due and the values"""
+        devices = [device for device, _ in pairs]
+        values = [value for _, value in pairs]
+        entry = self.entries.get(metric_type)
+        if entry is None or entry[1] != devices:
+            # New device list, the controller drops values of unknown ids
+            dictionary_id = 1 if entry is None else entry[0] % 0xffff + 1
+            entry = [dictionary_id, devices, 0]
+            self.entries[metric_type] = entry
+        send = entry[2] % self.refresh == 0
+        entry[2] += 1
+        return entry[0], devices if send else None, values
+
+
+def encode(host, samples, dictionary=None):
+    """Pack a host and its (timestamp, metric_type, value) samples, per
+    device metrics have a list of (device, value) pairs as value and their
+    device names are sent as dictionary decides, sampled metrics have a
+    Summary as value"""
+    if dictionary is None:
+        dictionary = DeviceDictionary(refresh=1)
+    scalars = [sample for sample in samples
+               if sample[1] not in VECTOR_METRIC_IDS]
+    vectors = [sample for sample in samples
+               if sample[1] in VECTOR_METRIC_IDS]
+    host = host.encode('utf-8')
+    summaries = [sample for sample in scalars
+                 if isinstance(sample[2], Summary)]
+    if summaries:
+        version = SUMMARIES_VERSION
+    elif vectors:
+        version = DEVICES_VERSION
+    else:
+        version = VERSION
+    parts = [HEADER.pack(version, len(host), len(scalars)), host]
+    for timestamp, metric_type, value in scalars:
+        summary = None
+        if value is None:
+            flags, value = MISSING, 0
+        elif isinstance(value, Summary):
+            flags, summary, value = SUMMARIZED, value, value.last
+        else:
+            flags = 0
+        parts.append(SAMPLE.pack(METRIC_IDS[metric_type], flags, timestamp,
+                                 value))
+        if summary is not None:
+            parts.append(SUMMARY.pack(summary.min, summary.max, summary.mean,
+                                      summary.count))
+    if version == VERSION:
+        return ''.join(parts)
+
+    # Per device values travel as one packed array per metric
+    parts.append(VECTOR_COUNT.pack(len(vectors)))
+    for timestamp, metric_type, pairs in vectors:
+        if pairs is None:
+            parts.append(VECTOR.pack(VECTOR_METRIC_IDS[metric_type], MISSING,
+                                     timestamp, 0, 0))
+            continue
+        dictionary_id, devices, values = dictionary.pack(metric_type, pairs)
+        flags = 0 if devices is None else DEVICES
+        parts.append(VECTOR.pack(VECTOR_METRIC_IDS[metric_type], flags,
+                                 timestamp, dictionary_id, len(values)))
+        for device in devices or []:
+            device = device.encode('utf-8')[:255]
+            parts.append(DEVICE_NAME.pack(len(device)))
+            parts.append(device)
+        parts.append(pack('!%dq' % len(values), *values))
+    return ''.join(parts)
@@ -0,0 +1,69 @@
+"""
+    Change-only reporting module
+"""
+from codec import Summary
+
+
+def parse_band(text):
+    """Get the (absolute, relative) deadband of a configuration value, a
+    number is an absolute amount and a percentage is relative to the last
+    sent value"""
+    text = text.strip()
+    if text.endswith('%'):
+        return 0, (float)(text[:-1]) / 100
+    return (float)(text), 0
+
+
+class Deadband(object):
+    """Drops samples within the deadband of the last value sent for their
+    metric, every metric is still sent at least every heartbeat seconds"""
+
+    def __init__(self, bands, heartbeat=300):
+        """bands maps metric types to (absolute, relative) deadbands,
+        metrics without one are always sent"""
+        self.bands = bands
+        self.heartbeat = heartbeat
+        self.last = {}
+
+    def filter(self, samples):
+        """Get the (timestamp, metric_type, value) samples worth sending,
+        missing samples are always sent"""
+        kept = []
+        for sample in samples:
+            timestamp, metric_type, value = sample
+            band = self.bands.get(metric_type)
+            if band is None:
+                kept.append(sample)
+                continue
+            if value is None:
+                # The next reading is sent whatever its value
+                self.last.pop(metric_type, None)
+                kept.append(sample)
+                continue
+            last = self.last.get(metric_type)
+            if (last is not None and
+                    timestamp - last[0] < self.heartbeat * 1000 and
+                    self.within(band, last[1], value)):
+                continue
+            self.last[metric_type] = (timestamp, value)
+            kept.append(sample)
+        return kept
+
+    def within(self, band, last, value):
+        """Whether value is within the deadband of the last sent value,
+        summaries compare their extremes and mean and per device values
+        compare every device"""
+        if isinstance(value, Summary):
+            pairs = [(last.min, value.min), (last.max, value.max),
+                     (last.mean, value.mean)]
+        elif isinstance(value, list):
+            last_devices = [device for device, _ in last]
+            devices = [device for device, _ in value]
+            if last_devices != devices:
+                return False
+            pairs = [(old, new) for (_, old), (_, new) in zip(last, value)]
+        else:
+            pairs = [(last, value)]
+        absolute, relative = band
+        return all(abs(new - old) <= max(absolute, relative * abs(old))
+                   for old, new in pairs)
@@ -3,14 +3,34 @@
 """
 import psutil
 from abc import ABCMeta, abstractmethod
+from threading import Lock
 from time import time
 from metric import Metric
 
 
+class LinuxSnapshot(object):
+    """psutil readings shared by the metrics of one collection cycle"""
+    def __init__(self):
+        self.lock = Lock()
+        self.readings = {}
+
+    def get(self, source, **arguments):
+        """Read a psutil source once per cycle, returns (time, result)"""
+        key = (source,) + tuple(sorted(arguments.items()))
+        with self.lock:
+            if key not in self.readings:
+                self.readings[key] = (time(),
+                                      getattr(psutil, source)(**arguments))
+            return self.readings[key]
+
+
 class LinuxMetric(Metric):
     """Linux metric abstract class"""
     __metaclass__ = ABCMeta
 
+    # Readings of the current collection cycle
+    snapshot = LinuxSnapshot()
+
     @abstractmethod
     def get_type(self):
         """Get metric type"""
@@ -38,10 +58,34 @@ class LinuxMetric(Metric):
             metric = LinDiskReadsPerSec()
         elif metric_label == 'disk_writes_sec':
             metric = LinDiskWritesPerSec()
+        elif metric_label == 'cpu_percentage_per_core':
+            metric = LinCpuPercentagePerCore()
+        elif metric_label == 'network_bytes_sent_per_nic':
+            metric = LinNetworkBytesSentPerNic()
+        elif metric_label == 'network_bytes_received_per_nic':
+            metric = LinNetworkBytesReceivedPerNic()
+        elif metric_label == 'disk_reads_sec_per_disk':
+            metric = LinDiskReadsPerSecPerDisk()
+        elif metric_label == 'disk_writes_sec_per_disk':
+            metric = LinDiskWritesPerSecPerDisk()
         else:
             metric = None
         return metric
 
+    @classmethod
+    def new_cycle(cls, metrics=None):
+        """Start a new collection cycle, psutil sources are read again,
+        metrics given share a snapshot of their own instead"""
+        snapshot = LinuxSnapshot()
+        if metrics is None:
+            LinuxMetric.snapshot = snapshot
+        for metric in metrics or []:
+            metric.snapshot = snapshot
+
+    def read(self, source, **arguments):
+        """Read a psutil source from the current cycle snapshot"""
+        return self.snapshot.get(source, **arguments)[1]
+
 
 class LinAvailableMemory(LinuxMetric):
     """Available virtual memory, in kilobytes, for Linux"""
@@ -53,7 +97,7 @@ class LinAvailableMemory(LinuxMetric):
         return self.metric_type
 
     def get_value(self):
-        memory = psutil.virtual_memory()
+        memory = self.read('virtual_memory')
         return (int)(memory.available/1024)
 
 
@@ -67,11 +111,11 @@ class LinTotalMemory(LinuxMetric):
         return self.metric_type
 
     def get_value(self):
-        memory = psutil.virtual_memory()
+        memory = self.read('virtual_memory')
         return (int)(memory.total/1024)
 
 
-class LinCpuPercentage(Metric):
+class LinCpuPercentage(LinuxMetric):
     """CPU percentage for Linux"""
     def __init__(self):
         self.metric_type = 'cpu_percentage'
@@ -81,11 +125,11 @@ class LinCpuPercentage(Metric):
         return self.metric_type
 
     def get_value(self):
-        cpu_percentage = (int)(psutil.cpu_percent(percpu=False))
+        cpu_percentage = (int)(self.read('cpu_percent'))
         return cpu_percentage
 
 
-class LinNetworkBytesSent(Metric):
+class LinNetworkBytesSent(LinuxMetric):
     """Total network bytes sent for Linux"""
     def __init__(self):
         self.metric_type = 'network_bytes_sent'
@@ -95,11 +139,11 @@ class LinNetworkBytesSent(Metric):
         return self.metric_type
 
     def get_value(self):
-        network = psutil.net_io_counters()
+        network = self.read('net_io_counters')
         return network.bytes_sent
 
 
-class LinNetworkBytesReceived(Metric):
+class LinNetworkBytesReceived(LinuxMetric):
     """Total network bytes received for Linux"""
     def __init__(self):
         self.metric_type = 'network_bytes_received'
@@ -109,11 +153,11 @@ class LinNetworkBytesReceived(Metric):
         return self.metric_type
 
     def get_value(self):
-        network = psutil.net_io_counters()
+        network = self.read('net_io_counters')
         return network.bytes_recv
 
 
-class LinDiskReadsPerSec(Metric):
+class LinDiskReadsPerSec(LinuxMetric):
     """Total disk byte reads/sec for Linux"""
     def __init__(self):
         self.metric_type = 'disk_reads_sec'
@@ -125,8 +169,8 @@ class LinDiskReadsPerSec(Metric):
         return self.metric_type
 
     def get_value(self):
-        current_time = time()
-        read_bytes = psutil.disk_io_counters().read_bytes
+        current_time, disk = self.snapshot.get('disk_io_counters')
+        read_bytes = disk.read_bytes
         read_bytes_sec = (int)((read_bytes - self.old_read_bytes) /
                                (current_time - self.old_time))
         self.old_time = current_time
@@ -134,7 +178,7 @@ class LinDiskReadsPerSec(Metric):
         return read_bytes_sec
 
 
-class LinDiskWritesPerSec(Metric):
+class LinDiskWritesPerSec(LinuxMetric):
     """Total disk byte writes/sec for Linux"""
     def __init__(self):
         self.metric_type = 'disk_writes_sec'
@@ -146,10 +190,102 @@ class LinDiskWritesPerSec(Metric):
         return self.metric_type
 
     def get_value(self):
-        current_time = time()
-        write_bytes = psutil.disk_io_counters().write_bytes
+        current_time, disk = self.snapshot.get('disk_io_counters')
+        write_bytes = disk.write_bytes
         write_bytes_sec = (int)((write_bytes - self.old_write_bytes) /
                                 (current_time - self.old_time))
         self.old_time = current_time
         self.old_write_bytes = write_bytes
         return write_bytes_sec
+
+
+class LinCpuPercentagePerCore(LinuxMetric):
+    """CPU percentage of every core for Linux"""
+    def __init__(self):
+        self.metric_type = 'cpu_percentage_per_core'
+        super(LinCpuPercentagePerCore, self).__init__()
+
+    def get_type(self):
+        return self.metric_type
+
+    def get_value(self):
+        cores = self.read('cpu_percent', percpu=True)
+        return [(str(core), (int)(percentage))
+                for core, percentage in enumerate(cores)]
+
+
+class LinNetworkBytesSentPerNic(LinuxMetric):
+    """Network bytes sent of every interface for Linux"""
+    def __init__(self):
+        self.metric_type = 'network_bytes_sent_per_nic'
+        super(LinNetworkBytesSentPerNic, self).__init__()
+
+    def get_type(self):
+        return self.metric_type
+
+    def get_value(self):
+        nics = self.read('net_io_counters', pernic=True)
+        return [(nic, nics[nic].bytes_sent) for nic in sorted(nics)]
+
+
+class LinNetworkBytesReceivedPerNic(LinuxMetric):
+    """Network bytes received of every interface for Linux"""
+    def __init__(self):
+        self.metric_type = 'network_bytes_received_per_nic'
+        super(LinNetworkBytesReceivedPerNic, self).__init__()
+
+    def get_type(self):
+        return self.metric_type
+
+    def get_value(self):
+        nics = self.read('net_io_counters', pernic=True)
+        return [(nic, nics[nic].bytes_recv) for nic in sorted(nics)]
+
+
+class LinDiskPerDisk(LinuxMetric):
+    """Disk byte rate of every disk for Linux, disks are reported from
+    their second reading on"""
+    __metaclass__ = ABCMeta
+
+    def __init__(self, field):
+        self.field = field
+        self.old_time = time()
+        self.old_bytes = self.disk_bytes(psutil.disk_io_counters(perdisk=True))
+        super(LinDiskPerDisk, self).__init__()
+
+    def disk_bytes(self, disks):
+        """Get {disk: byte count} of a per disk reading"""
+        return dict((disk, getattr(counters, self.field))
+                    for disk, counters in disks.items())
+
+    def get_value(self):
+        current_time, disks = self.snapshot.get('disk_io_counters',
+                                                perdisk=True)
+        current_bytes = self.disk_bytes(disks)
+        elapsed = current_time - self.old_time
+        rates = [(disk, (int)((current_bytes[disk] - self.old_bytes[disk]) /
+                              elapsed))
+                 for disk in sorted(current_bytes) if disk in self.old_bytes]
+        self.old_time = current_time
+        self.old_bytes = current_bytes
+        return rates
+
+
+class LinDiskReadsPerSecPerDisk(LinDiskPerDisk):
+    """Disk byte reads/sec of every disk for Linux"""
+    def __init__(self):
+        self.metric_type = 'disk_reads_sec_per_disk'
+        super(LinDiskReadsPerSecPerDisk, self).__init__('read_bytes')
+
+    def get_type(self):
+        return self.metric_type
+
+
+class LinDiskWritesPerSecPerDisk(LinDiskPerDisk):
+    """Disk byte writes/sec of every disk for Linux"""
+    def __init__(self):
+        self.metric_type = 'disk_writes_sec_per_disk'
+        super(LinDiskWritesPerSecPerDisk, self).__init__('write_bytes')
+
+    def get_type(self):
+        return self.metric_type
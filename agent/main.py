@@ -1,8 +1,10 @@
 """
-<<<<<<< HEAD
     Main program entry
 """
 from agent import Agent
+from spool import Spool
+from deadband import Deadband, parse_band
+from stats import expose
 from ConfigParser import ConfigParser
 from time import sleep
 
@@ -17,7 +19,71 @@ def main():
     address = config.get('Connection', 'ip')
     port = config.get('Connection', 'port')
     metrics = config.get('Metrics', 'metrics').split()
-    agent = Agent(user, passw, address, (int)(port), metrics)
+    collect_workers = 0
+    collect_timeout = 10
+    if config.has_option('Metrics', 'collect_workers'):
+        collect_workers = config.getint('Metrics', 'collect_workers')
+    if config.has_option('Metrics', 'collect_timeout'):
+        collect_timeout = config.getfloat('Metrics', 'collect_timeout')
+    device_refresh = 60
+    if config.has_option('Metrics', 'device_refresh'):
+        device_refresh = config.getint('Metrics', 'device_refresh')
+    reply_exchange = None
+    if config.has_option('Connection', 'reply_exchange'):
+        reply_exchange = config.get('Connection', 'reply_exchange')
+    max_backoff = 60
+    if config.has_option('Connection', 'max_backoff'):
+        max_backoff = config.getfloat('Connection', 'max_backoff')
+    spool = None
+    if config.has_option('Spool', 'directory'):
+        # Replies are kept on disk while the broker is unreachable
+        segment_size = 1048576
+        max_size = 67108864
+        if config.has_option('Spool', 'segment_size'):
+            segment_size = config.getint('Spool', 'segment_size')
+        if config.has_option('Spool', 'max_size'):
+            max_size = config.getint('Spool', 'max_size')
+        spool = Spool(config.get('Spool', 'directory'), segment_size,
+                      max_size)
+    sample_interval = 0
+    if config.has_option('Schedule', 'sample_interval'):
+        sample_interval = config.getfloat('Schedule', 'sample_interval')
+    deadband = None
+    if config.has_section('Deadband'):
+        # Only values that moved past their metric's deadband are sent
+        heartbeat = 300
+        bands = {}
+        for option, value in config.items('Deadband'):
+            if option == 'heartbeat':
+                heartbeat = (float)(value)
+            else:
+                bands[option] = parse_band(value)
+        deadband = Deadband(bands, heartbeat)
+    mode = 'pull'
+    if config.has_option('Schedule', 'mode'):
+        mode = config.get('Schedule', 'mode')
+    stats_port = 0
+    if config.has_option('Stats', 'port'):
+        stats_port = config.getint('Stats', 'port')
+    expose(stats_port)
+    agent = Agent(user, passw, address, (int)(port), metrics,
+                  collect_workers, collect_timeout, reply_exchange,
+                  device_refresh, spool=spool, max_backoff=max_backoff,
+                  sample_interval=sample_interval, deadband=deadband)
+    if mode == 'push':
+        # Collect and publish on our own schedule
+        interval = config.getfloat('Schedule', 'interval')
+        jitter = config.getfloat('Schedule', 'jitter')
+        print 'Agent started. Publishing every %s seconds...' % interval
+        try:
+            agent.start_publishing(interval, jitter)
+        except KeyboardInterrupt:
+            print 'Stopping agent'
+            agent.stop_publishing()
+            agent.disconnect()
+            print 'Agent stopped'
+        return
+
     print 'Agent started. Waiting for requests...'
     try:
         agent.start_consuming()
@@ -30,91 +96,3 @@ def main():
 
 if __name__ == "__main__":
     main()
-=======
-    Agent module
-"""
-
-from pika import PlainCredentials, ConnectionParameters, BlockingConnection
-from logging import basicConfig, CRITICAL
-from datetime import datetime
-from metric import Metric
-from socket import gethostname
-
-
-class Agent(object):
-    """Agent class"""
-    def __init__(self, user, password, ip, port, metric_labels):
-        """Generate metrics list, connect to RabbitMQ server"""
-        # Add valid metrics to list
-        self.metric_list = []
-        for label in metric_labels:
-            metric = Metric.create(label)
-            if metric is not None:
-                self.metric_list.append(metric)
-
-        # Connect to RabbitMQ server
-        credentials = PlainCredentials(user,
-                                       password)
-        basicConfig(format='%(levelname)s:%(message)s',
-                    level=CRITICAL)
-        connection_parameters = ConnectionParameters(ip,
-                                                     port,
-                                                     '/',
-                                                     credentials)
-        self.connection = BlockingConnection(connection_parameters)
-        self.channel = self.connection.channel()
-        self.host = gethostname()
-
-        # Prepare request queue
-        self.processing_request = False
-        self.channel.exchange_declare(exchange='request',
-                                      type='fanout')
-        result = self.channel.queue_declare(exclusive=True)
-        request_queue = result.method.queue
-        self.channel.queue_bind(exchange='request',
-                                queue=request_queue)
-        self.channel.basic_consume(self.request_metric,
-                                   queue=request_queue,
-                                   no_ack=True)
-
-        # Prepare reply queue
-        self.channel.queue_declare(queue='reply')
-
-    def request_metric(self, channel, method, properties, body):
-        """Request local metrics and send them to the controller"""
-        print 'Request received'
-        if not self.processing_request:
-            self.processing_request = True
-            for metric in self.metric_list:
-                # Get current time, host and metric
-                metric_type = metric.get_type()
-                value = metric.get_value()
-
-                timestamp = [datetime.now().year,
-                             datetime.now().month,
-                             datetime.now().day,
-                             datetime.now().hour,
-                             datetime.now().minute,
-                             datetime.now().second,
-                             0]
-
-                # Send reply to controller
-                reply = str([timestamp, self.host, metric_type, value])
-                self.channel.basic_publish(exchange='',
-                                           routing_key='reply',
-                                           body=reply)
-                print 'Metric ' + metric_type + ' sent'
-            self.processing_request = False
-
-    def start_consuming(self):
-        """Start consuming request messages"""
-        self.channel.start_consuming()
-
-    def stop_consuming(self):
-        """Stop consuming request messages"""
-        self.channel.stop_consuming()
-
-    def disconnect(self):
-        """Disconnect controller from RabbitMQ server"""
-        self.connection.close()
->>>>>>> origin/master
@@ -30,3 +30,21 @@ class Metric(object):
             return linux_metric.LinuxMetric.create(metric)
         else:
             raise Exception(sys.platform)
+
+    @classmethod
+    def new_cycle(cls, metrics=None):
+        """Start a new collection cycle, shared sources are read again,
+        metrics given get a cycle of their own apart from the others"""
+        if sys.platform == 'win32':
+            import windows_metric
+            windows_metric.WindowsMetric.new_cycle(metrics)
+        elif sys.platform == 'linux2':
+            import linux_metric
+            linux_metric.LinuxMetric.new_cycle(metrics)
+
+    @classmethod
+    def init_thread(cls):
+        """Prepare a collector thread"""
+        if sys.platform == 'win32':
+            import windows_metric
+            windows_metric.WindowsMetric.init_thread()
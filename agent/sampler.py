@@ -0,0 +1,99 @@
+"""
+    Background sampler module
+"""
+from array import array
+from threading import Thread, Event, Lock
+from time import time
+from metric import Metric
+from codec import Summary
+from stats import STATS
+
+
+class Sampler(object):
+    """Reads metrics every interval seconds on a background thread, the
+    readings between two summaries are kept in preallocated ring arrays
+    of capacity values per metric"""
+
+    def __init__(self, metrics, interval=1, capacity=3600):
+        self.metrics = metrics
+        self.interval = interval
+        self.capacity = capacity
+        self.values = dict((metric.get_type(), array('d', [0.0]) * capacity)
+                           for metric in metrics)
+        self.counts = dict((metric.get_type(), 0) for metric in metrics)
+        self.positions = dict((metric.get_type(), 0) for metric in metrics)
+        self.lock = Lock()
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self):
+        """Start sampling on a background thread"""
+        self.thread = Thread(target=self.loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def loop(self):
+        """Sample every interval seconds until stopped"""
+        Metric.init_thread()
+        next_sample = time()
+        while not self.stopped.is_set():
+            self.sample()
+            next_sample += self.interval
+            self.stopped.wait(max(0, next_sample - time()))
+
+    def sample(self):
+        """Read every metric once, failed readings are skipped, the
+        readings of request cycles are left alone"""
+        Metric.new_cycle(self.metrics)
+        for metric in self.metrics:
+            start = STATS.now()
+            try:
+                value = metric.get_value()
+            except Exception as error:
+                print 'Sampling ' + metric.get_type() + ' failed: %s' % error
+                continue
+            STATS.record('metric.' + metric.get_type(), start)
+            self.record(metric.get_type(), value)
+
+    def record(self, metric_type, value):
+        """Add a reading, the oldest reading is overwritten when the ring
+        is full"""
+        with self.lock:
+            position = self.positions[metric_type]
+            self.values[metric_type][position] = value
+            self.positions[metric_type] = (position + 1) % self.capacity
+            self.counts[metric_type] = min(self.counts[metric_type] + 1,
+                                           self.capacity)
+
+    def summaries(self, timestamp):
+        """Get (timestamp, metric_type, Summary) samples of the readings
+        since the previous call, metrics without readings are missing"""
+        samples = []
+        with self.lock:
+            for metric in self.metrics:
+                metric_type = metric.get_type()
+                count = self.counts[metric_type]
+                if not count:
+                    samples.append((timestamp, metric_type, None))
+                    continue
+                values = self.values[metric_type]
+                end = self.positions[metric_type]
+                if count <= end:
+                    readings = values[end - count:end]
+                else:
+                    readings = values[end - count:] + values[:end]
+                samples.append((timestamp, metric_type,
+                                Summary((int)(min(readings)),
+                                        (int)(max(readings)),
+                                        sum(readings) / count,
+                                        (int)(readings[-1]),
+                                        count)))
+                self.counts[metric_type] = 0
+        return samples
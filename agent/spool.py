@@ -0,0 +1,113 @@
+"""
+    Reply spool module
+"""
+import mmap
+import os
+from struct import Struct
+
+# Record header: body length, a zero length marks the unused end of a
+# segment
+RECORD = Struct('!I')
+
+# Segment file names, numbered in write order
+SEGMENT_FORMAT = '%012d.spool'
+
+
+class Spool(object):
+    """Append-only spool of encoded replies kept in memory-mapped segment
+    files while the broker is unreachable, the oldest segments are dropped
+    once the spool grows past max_size bytes"""
+
+    def __init__(self, directory, segment_size=1048576, max_size=67108864):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Segments left by a previous run are drained first, new replies
+        # always go to a new segment
+        self.segments = sorted((int)(name.split('.')[0])
+                               for name in os.listdir(directory)
+                               if name.endswith('.spool'))
+        self.current = None
+        self.offset = 0
+
+    def path(self, number):
+        """Get the file path of a segment"""
+        return os.path.join(self.directory, SEGMENT_FORMAT % number)
+
+    def empty(self):
+        """Whether there is nothing to drain"""
+        return not self.segments
+
+    def append(self, body):
+        """Add an encoded reply, written through to its segment file"""
+        size = RECORD.size + len(body)
+        if self.current is None or self.offset + size > len(self.current):
+            self.open_segment(max(self.segment_size, size))
+        record = RECORD.pack(len(body)) + body
+        self.current[self.offset:self.offset + size] = record
+        self.offset += size
+        self.current.flush()
+        self.evict()
+
+    def open_segment(self, size):
+        """Start a new zero filled segment of size bytes"""
+        self.seal()
+        number = self.segments[-1] + 1 if self.segments else 1
+        with open(self.path(number), 'w+b') as segment_file:
+            segment_file.truncate(size)
+            self.current = mmap.mmap(segment_file.fileno(), size)
+        self.offset = 0
+        self.segments.append(number)
+
+    def seal(self):
+        """Stop appending to the current segment"""
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+    def evict(self):
+        """Drop the oldest segments past max_size, the segment being
+        written is always kept"""
+        sizes = [os.path.getsize(self.path(number))
+                 for number in self.segments]
+        while len(self.segments) > 1 and sum(sizes) > self.max_size:
+            print 'Spool full, dropping segment %d' % self.segments[0]
+            os.remove(self.path(self.segments.pop(0)))
+            sizes.pop(0)
+
+    def read(self, number):
+        """Get the replies of a segment"""
+        with open(self.path(number), 'rb') as segment_file:
+            data = segment_file.read()
+        bodies = []
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            length, = RECORD.unpack_from(data, offset)
+            if not length:
+                break
+            offset += RECORD.size
+            bodies.append(data[offset:offset + length])
+            offset += length
+        return bodies
+
+    def drain(self, send):
+        """Send spooled replies oldest first, one segment at a time, a
+        segment is deleted once all its replies are sent, returns the
+        number of replies sent"""
+        self.seal()
+        sent = 0
+        while self.segments:
+            number = self.segments[0]
+            for body in self.read(number):
+                send(body)
+                sent += 1
+            os.remove(self.path(number))
+            self.segments.pop(0)
+        return sent
+
+    def close(self):
+        """Close the segment being written"""
+        self.seal()
@@ -1,16 +1,91 @@
 """
     Metrics module for Windows
 """
-import wmi
 from abc import ABCMeta, abstractmethod
+from threading import Lock, local
 from metric import Metric
+try:
+    import wmi
+except ImportError:
+    # WMI is only available on Windows, tests set their own provider
+    wmi = None
+
+
+# Properties read from every WMI class, the only ones kept of a query
+PROPERTIES = {
+    'Win32_OperatingSystem': ('FreeVirtualMemory', 'TotalVirtualMemorySize'),
+    'Win32_Processor': ('LoadPercentage',),
+    'Win32_PerfRawData_Tcpip_NetworkInterface': ('Name', 'BytesSentPerSec',
+                                                 'BytesReceivedPerSec'),
+    'Win32_PerfFormattedData_PerfDisk_LogicalDisk': ('DiskReadBytesPerSec',
+                                                     'DiskWriteBytesPerSec'),
+    'Win32_PerfFormattedData_PerfOS_Processor': ('Name',
+                                                 'PercentProcessorTime'),
+    'Win32_PerfFormattedData_PerfDisk_PhysicalDisk': ('Name',
+                                                      'DiskReadBytesPerSec',
+                                                      'DiskWriteBytesPerSec'),
+}
+
+
+class WmiRecord(object):
+    """Property values of a WMI instance, read on the querying thread so
+    no COM object is shared between threads"""
+    def __init__(self, instance, properties):
+        for name in properties:
+            setattr(self, name, getattr(instance, name, None))
+
+
+class WmiSession(object):
+    """WMI connection shared by all metrics, with a per cycle query cache"""
+    def __init__(self, provider=None):
+        self.provider = provider
+        self.lock = Lock()
+        self.results = {}
+        self.class_locks = {}
+
+        # COM objects belong to the thread that created them, collector
+        # threads get their own connection
+        self.connections = local()
+
+    def connection(self):
+        """Get the WMI connection of the calling thread"""
+        if self.provider is not None:
+            return self.provider
+        if not hasattr(self.connections, 'wmi'):
+            self.connections.wmi = wmi.WMI()
+        return self.connections.wmi
+
+    def query(self, wmi_class):
+        """Query a WMI class once per cycle, returns the property values
+        of its instances"""
+        with self.lock:
+            results = self.results
+            class_lock = self.class_locks.setdefault(wmi_class, Lock())
+
+        # Different classes may be queried concurrently
+        with class_lock:
+            if wmi_class not in results:
+                properties = PROPERTIES[wmi_class]
+                instances = getattr(self.connection(), wmi_class)(
+                    list(properties))
+                results[wmi_class] = [WmiRecord(instance, properties)
+                                      for instance in instances]
+            return results[wmi_class]
+
+    def new_cycle(self):
+        """Drop the query results of the previous cycle"""
+        with self.lock:
+            self.results = {}
+
 
 class WindowsMetric(Metric):
     """Windows metric abstract class"""
     __metaclass__ = ABCMeta
 
+    # WMI session shared by all metrics
+    session = WmiSession()
+
     def __init__(self):
-        self.wmi = wmi.WMI()
         super(WindowsMetric, self).__init__()
 
     @abstractmethod
@@ -40,10 +115,58 @@ class WindowsMetric(Metric):
             metric = WinDiskReadsPerSec()
         elif metric_label == 'disk_writes_sec':
             metric = WinDiskWritesPerSec()
+        elif metric_label == 'cpu_percentage_per_core':
+            metric = WinCpuPercentagePerCore()
+        elif metric_label == 'network_bytes_sent_per_nic':
+            metric = WinNetworkBytesSentPerNic()
+        elif metric_label == 'network_bytes_received_per_nic':
+            metric = WinNetworkBytesReceivedPerNic()
+        elif metric_label == 'disk_reads_sec_per_disk':
+            metric = WinDiskReadsPerSecPerDisk()
+        elif metric_label == 'disk_writes_sec_per_disk':
+            metric = WinDiskWritesPerSecPerDisk()
         else:
             metric = None
         return metric
 
+    @classmethod
+    def new_cycle(cls, metrics=None):
+        """Start a new collection cycle, WMI classes are queried again,
+        metrics given share a session of their own instead"""
+        if metrics is None:
+            WindowsMetric.session.new_cycle()
+            return
+        sessions = [vars(metric)['session'] for metric in metrics
+                    if 'session' in vars(metric)]
+        session = sessions[0] if sessions else WmiSession(
+            WindowsMetric.session.provider)
+        session.new_cycle()
+        for metric in metrics:
+            metric.session = session
+
+    @classmethod
+    def init_thread(cls):
+        """Prepare a collector thread for COM calls"""
+        if wmi is not None:
+            import pythoncom
+            pythoncom.CoInitialize()
+
+    @classmethod
+    def set_provider(cls, provider):
+        """Replace the shared WMI session, None connects with wmi.WMI()"""
+        WindowsMetric.session = WmiSession(provider)
+
+    def query(self, wmi_class):
+        """Query a WMI class through the session of the metric's cycle"""
+        return self.session.query(wmi_class)
+
+    def query_devices(self, wmi_class, field):
+        """Get (instance name, value) pairs of a WMI class, without its
+        _Total instance"""
+        return [(instance.Name, (int)(getattr(instance, field)))
+                for instance in self.query(wmi_class)
+                if instance.Name != '_Total']
+
 
 class WinAvailableMemory(WindowsMetric):
     """Available virtual memory, in kilobytes, for Windows"""
@@ -56,7 +179,7 @@ class WinAvailableMemory(WindowsMetric):
 
     def get_value(self):
         available_memory = 0
-        for operating_system in self.wmi.Win32_OperatingSystem():
+        for operating_system in self.query('Win32_OperatingSystem'):
             available_memory += (int)(operating_system.FreeVirtualMemory)
         return available_memory
 
@@ -72,7 +195,7 @@ class WinTotalMemory(WindowsMetric):
 
     def get_value(self):
         total_memory = 0
-        for operating_system in self.wmi.Win32_OperatingSystem():
+        for operating_system in self.query('Win32_OperatingSystem'):
             total_memory += (int)(operating_system.TotalVirtualMemorySize)
         return total_memory
 
@@ -88,10 +211,11 @@ class WinCpuPercentage(WindowsMetric):
 
     def get_value(self):
         total_percentage = 0
-        for cpu in self.wmi.Win32_Processor():
+        cpus = self.query('Win32_Processor')
+        for cpu in cpus:
             # Get percentage of each core
             total_percentage += (int)(cpu.LoadPercentage)
-        cpu_percentage = (int)(total_percentage / len(self.wmi.Win32_Processor()))
+        cpu_percentage = (int)(total_percentage / len(cpus))
         return cpu_percentage
 
 
@@ -106,7 +230,7 @@ class WinNetworkBytesSent(WindowsMetric):
 
     def get_value(self):
         bytes_sent = 0
-        for network in self.wmi.Win32_PerfRawData_Tcpip_NetworkInterface():
+        for network in self.query('Win32_PerfRawData_Tcpip_NetworkInterface'):
             bytes_sent += (int)(network.BytesSentPerSec)
         return bytes_sent
 
@@ -122,7 +246,7 @@ class WinNetworkBytesReceived(WindowsMetric):
 
     def get_value(self):
         bytes_received = 0
-        for network in self.wmi.Win32_PerfRawData_Tcpip_NetworkInterface():
+        for network in self.query('Win32_PerfRawData_Tcpip_NetworkInterface'):
             bytes_received += (int)(network.BytesReceivedPerSec)
         return bytes_received
 
@@ -137,7 +261,7 @@ class WinDiskReadsPerSec(WindowsMetric):
         return self.metric_type
 
     def get_value(self):
-        disk = self.wmi.Win32_PerfFormattedData_PerfDisk_LogicalDisk()
+        disk = self.query('Win32_PerfFormattedData_PerfDisk_LogicalDisk')
         byte_reads_sec = (int)(disk[0].DiskReadBytesPerSec)
         return byte_reads_sec
 
@@ -152,7 +276,78 @@ class WinDiskWritesPerSec(WindowsMetric):
         return self.metric_type
 
     def get_value(self):
-        disk = self.wmi.Win32_PerfFormattedData_PerfDisk_LogicalDisk()
+        disk = self.query('Win32_PerfFormattedData_PerfDisk_LogicalDisk')
         disk_writes_sec = (int)(disk[0].DiskWriteBytesPerSec)
         return disk_writes_sec
 
+
+class WinCpuPercentagePerCore(WindowsMetric):
+    """CPU percentage of every core, for Windows"""
+    def __init__(self):
+        self.metric_type = 'cpu_percentage_per_core'
+        super(WinCpuPercentagePerCore, self).__init__()
+
+    def get_type(self):
+        return self.metric_type
+
+    def get_value(self):
+        return self.query_devices('Win32_PerfFormattedData_PerfOS_Processor',
+                                  'PercentProcessorTime')
+
+
+class WinNetworkBytesSentPerNic(WindowsMetric):
+    """Network bytes sent of every interface for Windows"""
+    def __init__(self):
+        self.metric_type = 'network_bytes_sent_per_nic'
+        super(WinNetworkBytesSentPerNic, self).__init__()
+
+    def get_type(self):
+        return self.metric_type
+
+    def get_value(self):
+        return self.query_devices('Win32_PerfRawData_Tcpip_NetworkInterface',
+                                  'BytesSentPerSec')
+
+
+class WinNetworkBytesReceivedPerNic(WindowsMetric):
+    """Network bytes received of every interface for Windows"""
+    def __init__(self):
+        self.metric_type = 'network_bytes_received_per_nic'
+        super(WinNetworkBytesReceivedPerNic, self).__init__()
+
+    def get_type(self):
+        return self.metric_type
+
+    def get_value(self):
+        return self.query_devices('Win32_PerfRawData_Tcpip_NetworkInterface',
+                                  'BytesReceivedPerSec')
+
+
+class WinDiskReadsPerSecPerDisk(WindowsMetric):
+    """Disk byte reads/sec of every physical disk for Windows"""
+    def __init__(self):
+        self.metric_type = 'disk_reads_sec_per_disk'
+        super(WinDiskReadsPerSecPerDisk, self).__init__()
+
+    def get_type(self):
+        return self.metric_type
+
+    def get_value(self):
+        return self.query_devices(
+            'Win32_PerfFormattedData_PerfDisk_PhysicalDisk',
+            'DiskReadBytesPerSec')
+
+
+class WinDiskWritesPerSecPerDisk(WindowsMetric):
+    """Disk byte writes/sec of every physical disk for Windows"""
+    def __init__(self):
+        self.metric_type = 'disk_writes_sec_per_disk'
+        super(WinDiskWritesPerSecPerDisk, self).__init__()
+
+    def get_type(self):
+        return self.metric_type
+
+    def get_value(self):
+        return self.query_devices(
+            'Win32_PerfFormattedData_PerfDisk_PhysicalDisk',
+            'DiskWriteBytesPerSec')
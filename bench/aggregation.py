@@ -0,0 +1,83 @@
+"""
+    Fleet p95 CPU per minute, ORM loops against Database.query and the
+    vectorized aggregation module
+
+    Usage: python bench/aggregation.py [hosts] [samples per host]
+"""
+import os
+import shutil
+import sys
+import tempfile
+from random import randint
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'controller'))
+
+from aggregation import fleet_statistics
+from database import Database, CpuPercentageTable, HostTable, epoch_ms
+
+
+def fill(database, hosts, samples, start):
+    """Store samples every 5 seconds of hosts"""
+    for host in range(hosts):
+        database.set_metrics('host%d' % host,
+                             [((start + index * 5) * 1000,
+                               'cpu_percentage',
+                               randint(0, 100))
+                              for index in range(samples)])
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of a list"""
+    values = sorted(values)
+    return values[max(0, (int)(round(fraction * len(values))) - 1)]
+
+
+def naive(database, step):
+    """Load every row as an ORM object, bucket and compute in Python"""
+    host_names = dict((host.id, host.name)
+                      for host in database.session.query(HostTable))
+    buckets = {}
+    for row in database.session.query(CpuPercentageTable).all():
+        timestamp = epoch_ms(row.timestamp)
+        bucket = timestamp - timestamp % (step * 1000)
+        host_buckets = buckets.setdefault(bucket, {})
+        host_buckets.setdefault(host_names[row.host_id], []).append(
+            row.cpu_percentage)
+    result = {}
+    for bucket, host_buckets in buckets.items():
+        means = [float(sum(values)) / len(values)
+                 for values in host_buckets.values()]
+        result[bucket] = percentile(means, 0.95)
+    return result
+
+
+def vectorized(database, step):
+    """Load columns with Database.query and aggregate with NumPy"""
+    columns = database.query('cpu_percentage')
+    return fleet_statistics(columns, step, ('p95',))
+
+
+def main():
+    """Run both paths over the same database"""
+    hosts = (int)(sys.argv[1]) if len(sys.argv) > 1 else 100
+    samples = (int)(sys.argv[2]) if len(sys.argv) > 2 else 720
+    directory = tempfile.mkdtemp()
+    try:
+        database = Database('sqlite:///' + os.path.join(directory, 'bench.db'),
+                            batch_size=10000)
+        fill(database, hosts, samples, 1442880000)
+        database.flush()
+        print '%d hosts, %d samples each' % (hosts, samples)
+        for name, function in [('ORM loops', naive),
+                               ('vectorized', vectorized)]:
+            start = time()
+            function(database, 60)
+            print '%-12s %8.3f s' % (name, time() - start)
+        database.close_session()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,419 @@
+"""
+    Fleet simulation, simulated agents with synthetic metrics reply to a
+    real controller and database through an in-process broker
+
+    Usage: python bench/fleet.py [agents] [cycles] [options], see --help
+"""
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import deque, namedtuple
+from random import Random
+from time import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Both programs have codec and stats modules, the agent's are taken out of
+# sys.modules once the agent is imported so the controller gets its own,
+# they are still referenced or Python would clear their globals
+sys.path.insert(0, os.path.join(ROOT, 'agent'))
+import agent
+agent_modules = [sys.modules.pop(name) for name in ('codec', 'stats')]
+sys.path.insert(0, os.path.join(ROOT, 'controller'))
+import controller
+
+# Exchange routing is shared with the controller tests' broker
+sys.path.insert(0, os.path.join(ROOT, 'test', 'controller'))
+from fake_amqp import Router
+
+# AMQP method frames the programs read
+DeclareOk = namedtuple('DeclareOk', 'queue')
+Frame = namedtuple('Frame', 'method')
+Deliver = namedtuple('Deliver', 'delivery_tag routing_key')
+
+
+class Consumer(object):
+    """Consumer of a queue, at most prefetch deliveries are unacknowledged
+    when prefetch is above 0"""
+
+    def __init__(self, channel, callback, no_ack, prefetch):
+        self.channel = channel
+        self.callback = callback
+        self.no_ack = no_ack
+        self.prefetch = prefetch
+        self.unacked = []
+
+    def ready(self):
+        """Whether the consumer takes another delivery"""
+        return (self.no_ack or self.prefetch <= 0 or
+                len(self.unacked) < self.prefetch)
+
+
+class Broker(Router):
+    """In-process stand-in for the RabbitMQ features agents and controllers
+    use through BlockingConnection: named and exclusive queues and
+    consumers with prefetch, messages are delivered by run() on the calling
+    thread, one queue after another"""
+
+    def __init__(self):
+        super(Broker, self).__init__()
+        self.consumers = {}
+        self.scheduled = deque()
+        self.pending = set()
+        self.tags = 0
+        self.published = 0
+        self.delivered = 0
+
+    def connect(self, parameters):
+        """Replacement for BlockingConnection"""
+        return Connection(self)
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """Route a message to the queues of its exchange"""
+        self.published += 1
+        for queue in self.route(exchange, routing_key):
+            self.queues[queue].append((routing_key, properties, body))
+            self.schedule(queue)
+
+    def schedule(self, queue):
+        """Have run() look at a queue"""
+        if queue in self.consumers and queue not in self.pending:
+            self.scheduled.append(queue)
+            self.pending.add(queue)
+
+    def consume(self, queue, consumer):
+        """Attach a consumer to a queue"""
+        self.consumers[queue] = consumer
+        if self.queues.get(queue):
+            self.schedule(queue)
+
+    def ack(self, channel, delivery_tag, multiple):
+        """Acknowledge deliveries of a channel"""
+        for queue, consumer in self.consumers.items():
+            if consumer.channel is not channel:
+                continue
+            consumer.unacked = [tag for tag in consumer.unacked
+                                if tag > delivery_tag or
+                                (not multiple and tag != delivery_tag)]
+            if self.queues.get(queue):
+                self.schedule(queue)
+
+    def run(self):
+        """Deliver messages until no consumer can take one"""
+        while self.scheduled:
+            queue = self.scheduled.popleft()
+            self.pending.discard(queue)
+            consumer = self.consumers[queue]
+            messages = self.queues[queue]
+            if not messages or not consumer.ready():
+                continue
+            routing_key, properties, body = messages.popleft()
+            self.tags += 1
+            if not consumer.no_ack:
+                consumer.unacked.append(self.tags)
+            self.delivered += 1
+            consumer.callback(consumer.channel,
+                              Deliver(self.tags, routing_key),
+                              properties, body)
+            if messages:
+                self.schedule(queue)
+
+
+class Connection(object):
+    """BlockingConnection stand-in"""
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def channel(self):
+        return Channel(self.broker)
+
+    def sleep(self, duration):
+        self.broker.run()
+
+    def add_timeout(self, deadline, callback):
+        # Cycles run back to back, timers never come due
+        pass
+
+    def close(self):
+        pass
+
+
+class Channel(object):
+    """BlockingChannel stand-in"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.prefetch = 0
+
+    def exchange_declare(self, exchange, type='direct'):
+        self.broker.declare_exchange(exchange, type)
+
+    def queue_declare(self, queue='', exclusive=False):
+        return Frame(DeclareOk(self.broker.declare_queue(queue)))
+
+    def queue_bind(self, exchange, queue, routing_key=None):
+        self.broker.bind(exchange, queue, routing_key)
+
+    def basic_qos(self, prefetch_count=0):
+        self.prefetch = prefetch_count
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False):
+        self.broker.consume(queue, Consumer(self, consumer_callback, no_ack,
+                                            self.prefetch))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.broker.publish(exchange, routing_key, body, properties)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.broker.ack(self, delivery_tag, multiple)
+
+    def start_consuming(self):
+        self.broker.run()
+
+    def stop_consuming(self):
+        pass
+
+
+class SyntheticMetric(agent.Metric):
+    """Random walk readings of a metric, counters only go up and per device
+    metrics have devices readings"""
+
+    def __init__(self, metric_type, random, low, high, devices=0):
+        self.metric_type = metric_type
+        self.random = random
+        self.low = low
+        self.high = high
+        self.devices = devices
+        self.values = [random.randint(low, high)
+                       for _ in range(max(1, devices))]
+
+    def get_type(self):
+        return self.metric_type
+
+    def get_value(self):
+        step = max(1, (self.high - self.low) // 20)
+        for index, value in enumerate(self.values):
+            if self.metric_type in controller.COUNTERS:
+                value += self.random.randint(0, step)
+            else:
+                value += self.random.randint(-step, step)
+                value = min(self.high, max(self.low, value))
+            self.values[index] = value
+        if self.devices:
+            return [(str(index), value)
+                    for index, value in enumerate(self.values)]
+        return self.values[0]
+
+
+def synthetic_metrics(random, devices):
+    """Collectors of one simulated host"""
+    metrics = [SyntheticMetric('cpu_percentage', random, 0, 100),
+               SyntheticMetric('available_memory', random, 2 ** 28, 2 ** 33),
+               SyntheticMetric('total_memory', random, 2 ** 33, 2 ** 33),
+               SyntheticMetric('network_bytes_sent', random, 0, 2 ** 20),
+               SyntheticMetric('network_bytes_received', random, 0, 2 ** 20),
+               SyntheticMetric('disk_reads_sec', random, 0, 500),
+               SyntheticMetric('disk_writes_sec', random, 0, 500)]
+    if devices:
+        metrics.append(SyntheticMetric('cpu_percentage_per_core', random,
+                                       0, 100, devices))
+    return metrics
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of a list"""
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[max(0, (int)(round(fraction * len(values))) - 1)]
+
+
+def rss():
+    """Resident set size of this process in bytes, the peak one without
+    psutil"""
+    if psutil is not None:
+        return psutil.Process(os.getpid()).memory_info().rss
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def commit():
+    """Short id of the checked out commit, None outside a git checkout"""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short',
+                                            'HEAD'], cwd=ROOT,
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def simulate(options, directory):
+    """Run the fleet for options.cycles request cycles, returns the
+    measurements"""
+    broker = Broker()
+    agent.BlockingConnection = broker.connect
+    controller.BlockingConnection = broker.connect
+    random = Random(options.seed)
+
+    fleet = []
+    for index in range(options.agents):
+        simulated = agent.Agent('bench', 'bench', 'localhost', 5672, [])
+        simulated.host = 'agent%05d' % index
+        simulated.metric_list = synthetic_metrics(Random(random.random()),
+                                                  options.devices)
+        fleet.append(simulated)
+    agents_rss = rss()
+
+    database_options = {'storage': options.storage,
+                        'batch_size': options.batch_size}
+    if options.wal:
+        database_options['wal'] = True
+        database_options['pragmas'] = {'synchronous': 'NORMAL'}
+    ingest = controller.Controller('bench', 'bench', 'localhost', 5672,
+                                   'sqlite:///' + os.path.join(directory,
+                                                               'bench.db'),
+                                   database_options, options.prefetch)
+
+    # Time spent in the controller and latency from sample to commit
+    measured = {'busy': 0.0, 'replies': 0, 'rows': 0, 'buffered': [],
+                'latencies': []}
+    receive_metric = ingest.receive_metric
+    store = ingest.store
+    flush = ingest.database.flush
+
+    def timed_receive_metric(channel, method, properties, body):
+        start = time()
+        receive_metric(channel, method, properties, body)
+        measured['busy'] += time() - start
+        measured['replies'] += 1
+
+    def timed_store(host, samples, delivery_tag=None):
+        store(host, samples, delivery_tag)
+        measured['rows'] += len(samples)
+        if samples:
+            measured['buffered'].append(samples[0][0])
+
+    def timed_flush():
+        # Buffered samples are only stored once the flush commits them
+        flush()
+        committed = time() * 1000
+        measured['latencies'].extend(committed - timestamp
+                                     for timestamp in measured['buffered'])
+        measured['buffered'] = []
+
+    ingest.receive_metric = timed_receive_metric
+    ingest.store = timed_store
+    ingest.database.flush = timed_flush
+    ingest.channel.basic_consume(timed_receive_metric, queue='reply',
+                                 no_ack=options.prefetch <= 0)
+
+    start = time()
+    for _ in range(options.cycles):
+        ingest.channel.basic_publish(exchange='request', routing_key='',
+                                     body='request_metrics')
+        broker.run()
+    flush_start = time()
+    ingest.database.flush()
+    measured['busy'] += time() - flush_start
+    elapsed = time() - start
+    end_rss = rss()
+    ingest.disconnect()
+    for simulated in fleet:
+        simulated.disconnect()
+
+    busy = measured['busy'] or elapsed
+    latencies = measured['latencies']
+    return {'messages': broker.delivered,
+            'replies': measured['replies'],
+            'rows': measured['rows'],
+            'seconds': round(elapsed, 3),
+            'messages_sec': round(broker.delivered / elapsed, 1),
+            'replies_sec': round(measured['replies'] / busy, 1),
+            'rows_sec': round(measured['rows'] / busy, 1),
+            'latency_p50_ms': round(percentile(latencies, 0.5), 1),
+            'latency_p95_ms': round(percentile(latencies, 0.95), 1),
+            'latency_p99_ms': round(percentile(latencies, 0.99), 1),
+            'rss_mb': round(end_rss / 1048576.0, 1),
+            'controller_rss_mb': round((end_rss - agents_rss) / 1048576.0, 1),
+            'agents_per_controller': (int)(measured['replies'] / busy *
+                                           options.interval)}
+
+
+def compare(results_file, result):
+    """Print the change from the last stored run with the same parameters,
+    then store this one"""
+    previous = None
+    if os.path.exists(results_file):
+        with open(results_file) as results:
+            for line in results:
+                stored = json.loads(line)
+                if stored['parameters'] == result['parameters']:
+                    previous = stored
+    if previous is not None:
+        print 'Against %s:' % previous['commit']
+        for name, value in sorted(result['measurements'].items()):
+            old = previous['measurements'].get(name)
+            if old:
+                print '  %-24s %+7.1f%%' % (name, (value - old) * 100.0 / old)
+    with open(results_file, 'a') as results:
+        results.write(json.dumps(result, sort_keys=True) + '\n')
+
+
+def main():
+    """Run the simulation and report its measurements"""
+    parser = argparse.ArgumentParser(description='Fleet simulation')
+    parser.add_argument('agents', nargs='?', type=int, default=1000)
+    parser.add_argument('cycles', nargs='?', type=int, default=10)
+    parser.add_argument('--devices', type=int, default=0,
+                        help='cores of the per core CPU metric, 0 for none')
+    parser.add_argument('--storage', default='tables',
+                        choices=['tables', 'samples'])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--prefetch', type=int, default=0)
+    parser.add_argument('--wal', action='store_true')
+    parser.add_argument('--interval', type=float, default=5,
+                        help='agent reply interval for the capacity estimate')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--stages', action='store_true',
+                        help='print the controller stage timings')
+    parser.add_argument('--results',
+                        help='JSON lines file compared against and '
+                        'appended to')
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    stdout = sys.stdout
+    try:
+        # Agents and controller report every message
+        sys.stdout = open(os.devnull, 'w')
+        measurements = simulate(options, directory)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        shutil.rmtree(directory)
+
+    parameters = dict((name, value) for name, value in vars(options).items()
+                      if name not in ('results', 'stages'))
+    print '%d agents, %d cycles' % (options.agents, options.cycles)
+    for name, value in sorted(measurements.items()):
+        print '  %-24s %12s' % (name, value)
+    if options.stages:
+        print controller.STATS.report()
+    if options.results:
+        compare(options.results, {'commit': commit(),
+                                  'parameters': parameters,
+                                  'measurements': measurements})
+
+if __name__ == "__main__":
+    main()
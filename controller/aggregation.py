@@ -0,0 +1,137 @@
+"""
+    Fleet aggregation module
+"""
+import numpy
+
+
+def cache_columns(cache, metric, hosts=None):
+    """Get {host: (timestamps, values)} columns of a metric from a
+    SampleCache, the same shape Database.query returns"""
+    columns = {}
+    for host, series_metric in cache.series():
+        if series_metric != metric or (hosts is not None and
+                                       host not in hosts):
+            continue
+        window = cache.window(host, metric)
+        if window:
+            samples = numpy.array(window, dtype=numpy.float64)
+            columns[host] = (samples[:, 0].astype(numpy.int64), samples[:, 1])
+    return columns
+
+
+def flatten(columns):
+    """Concatenate columns into host names and host index, timestamp and
+    value arrays"""
+    hosts = sorted(columns)
+    if not hosts:
+        empty = numpy.array([], dtype=numpy.int64)
+        return hosts, empty, empty, numpy.array([], dtype=numpy.float64)
+    indexes = numpy.concatenate([numpy.full(len(columns[host][0]), index,
+                                            dtype=numpy.int64)
+                                 for index, host in enumerate(hosts)])
+    timestamps = numpy.concatenate([numpy.asarray(columns[host][0],
+                                                  dtype=numpy.int64)
+                                    for host in hosts])
+    values = numpy.concatenate([numpy.asarray(columns[host][1],
+                                              dtype=numpy.float64)
+                                for host in hosts])
+    return hosts, indexes, timestamps, values
+
+
+def rates(indexes, timestamps, values):
+    """Turn counter samples into per second rates, counter resets and the
+    first sample of every host have no rate"""
+    if len(values) < 2:
+        return indexes[:0], timestamps[:0], values[:0]
+    elapsed = numpy.diff(timestamps) / 1000.0
+    increase = numpy.diff(values)
+    valid = ((indexes[1:] == indexes[:-1]) & (elapsed > 0) &
+             (increase >= 0))
+    return (indexes[1:][valid], timestamps[1:][valid],
+            increase[valid] / elapsed[valid])
+
+
+def align(columns, step, start=None, end=None, rate=False):
+    """Bucket columns into a hosts x buckets matrix of per host means over
+    step seconds, buckets without samples are NaN, returns (hosts, bucket
+    start timestamps, matrix)"""
+    hosts, indexes, timestamps, values = flatten(columns)
+    if rate:
+        indexes, timestamps, values = rates(indexes, timestamps, values)
+    width = (int)(step * 1000)
+    if start is None:
+        start = timestamps.min() if len(timestamps) else 0
+    start -= start % width
+    if end is None:
+        end = timestamps.max() + 1 if len(timestamps) else start
+    count = max(0, (int)((end - start + width - 1) // width))
+    buckets = start + width * numpy.arange(count, dtype=numpy.int64)
+
+    # One flat bucket per host and time bucket
+    inside = (timestamps >= start) & (timestamps < end)
+    flat = (indexes[inside] * count +
+            (timestamps[inside] - start) // width)
+    size = len(hosts) * count
+    sums = numpy.bincount(flat, weights=values[inside], minlength=size)
+    counts = numpy.bincount(flat, minlength=size)
+    matrix = numpy.full(size, numpy.nan)
+    reported = counts > 0
+    matrix[reported] = sums[reported] / counts[reported]
+    return hosts, buckets, matrix.reshape(len(hosts), count)
+
+
+def statistic(matrix, name):
+    """Compute a statistic across hosts for every bucket, name is one of
+    mean, min, max, count or pNN for the NNth percentile"""
+    reported = ~numpy.isnan(matrix)
+    if name == 'count':
+        return reported.sum(axis=0)
+    result = numpy.full(matrix.shape[1], numpy.nan)
+    columns = reported.any(axis=0)
+    if not columns.any():
+        return result
+    matrix = matrix[:, columns]
+    if name == 'mean':
+        result[columns] = numpy.nanmean(matrix, axis=0)
+    elif name == 'min':
+        result[columns] = numpy.nanmin(matrix, axis=0)
+    elif name == 'max':
+        result[columns] = numpy.nanmax(matrix, axis=0)
+    elif name.startswith('p'):
+        result[columns] = numpy.nanpercentile(matrix, float(name[1:]), axis=0)
+    else:
+        raise ValueError('Unknown statistic ' + name)
+    return result
+
+
+def group(hosts, tags=None):
+    """Get {group: host indexes} of hosts grouped by their tags, a host
+    tagged with a list belongs to every group in it, untagged hosts and
+    tags None give a single None group"""
+    if not hosts:
+        return {}
+    if tags is None:
+        return {None: range(len(hosts))}
+    groups = {}
+    for index, host in enumerate(hosts):
+        host_tags = tags.get(host)
+        if host_tags is None or isinstance(host_tags, basestring):
+            host_tags = [host_tags]
+        for tag in host_tags:
+            groups.setdefault(tag, []).append(index)
+    return groups
+
+
+def fleet_statistics(columns, step, statistics=('mean',), tags=None,
+                     start=None, end=None, rate=False):
+    """Compute statistics across hosts for every step seconds bucket of
+    Database.query or cache_columns columns, counters are turned into per
+    second rates first when rate is set, returns (bucket start timestamps,
+    {group: {statistic: values}})"""
+    hosts, buckets, matrix = align(columns, step, start, end, rate)
+    result = {}
+    for name, indexes in group(hosts, tags).items():
+        rows = matrix[list(indexes)]
+        result[name] = dict((statistic_name, statistic(rows, statistic_name))
+                            for statistic_name in statistics)
+    return buckets, result
@@ -0,0 +1,238 @@
+"""
+    Event loop controller module
+"""
+
+from pika import PlainCredentials, ConnectionParameters, SelectConnection
+from logging import basicConfig, CRITICAL
+from Queue import Queue, Empty, Full
+from threading import Thread
+from controller import Controller
+from stats import STATS
+
+
+class AsyncController(Controller):
+    """Controller running the reply consumer and the request schedule on a
+    single connection IO loop, database writes are done by a writer thread"""
+
+    def __init__(self, user, password, ip, port, database_url,
+                 database_options=None, prefetch=0, reply_queue='reply',
+                 reply_exchange=None, cache_size=60, max_pending=1000,
+                 resume_delay=1, flush_interval=1):
+        """Prepare RabbitMQ connection parameters and connect to the
+        database, the connection is opened by run()"""
+
+        credentials = PlainCredentials(user, password)
+        basicConfig(format='%(levelname)s:%(message)s',
+                    level=CRITICAL)
+        self.parameters = ConnectionParameters(ip,
+                                               port,
+                                               '/',
+                                               credentials)
+        self.connection = None
+        self.channel = None
+        self.reply_queue = reply_queue
+        self.reply_exchange = reply_exchange
+        self.consumer_tag = None
+        self.period = None
+        self.requesting = False
+        self.stopping = False
+
+        # Replies waiting for the writer, consuming pauses while it is full
+        self.pending = Queue(max_pending)
+        self.overflow = []
+        self.resume_delay = resume_delay
+
+        # (delivery tag, stored) pairs of the writer, committed replies are
+        # acknowledged on the loop and failed ones delivered again
+        self.committed = Queue()
+
+        # Only the writer thread uses the database afterwards
+        self.prepare_ingest(database_url, database_options, prefetch,
+                            cache_size, flush_interval)
+        self.writer = Thread(target=self.write_loop)
+
+    def run(self, period=None):
+        """Run the IO loop until stop() or KeyboardInterrupt, metrics are
+        requested every period seconds unless period is None"""
+        self.period = period
+        self.writer.start()
+        self.connection = SelectConnection(
+            self.parameters, on_open_callback=self.on_connection_open)
+        try:
+            self.connection.ioloop.start()
+        except KeyboardInterrupt:
+            # Let the loop run until the connection is closed
+            self.stop()
+            self.connection.ioloop.start()
+
+        # Hand remaining replies to the writer and wait for it
+        for item in self.overflow:
+            self.pending.put(item)
+        self.overflow = []
+        self.pending.put(None)
+        self.writer.join()
+
+    def stop(self):
+        """Stop requesting and consuming, close the connection"""
+        self.stopping = True
+        self.requesting = False
+        self.connection.close()
+
+    def on_connection_open(self, connection):
+        """Open a channel once connected"""
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_channel_open(self, channel):
+        """Prepare request exchange"""
+        self.channel = channel
+        channel.exchange_declare(self.on_exchange_declare,
+                                 exchange='request',
+                                 exchange_type='fanout')
+
+    def on_exchange_declare(self, frame):
+        """Prepare reply queue"""
+        self.channel.queue_declare(self.on_queue_declare,
+                                   queue=self.reply_queue)
+
+    def on_queue_declare(self, frame):
+        """Prepare the sharded reply exchange if there is one"""
+        if self.reply_exchange is None:
+            self.on_queue_bind(frame)
+            return
+        self.channel.exchange_declare(self.on_reply_exchange_declare,
+                                      exchange=self.reply_exchange,
+                                      exchange_type='x-consistent-hash')
+
+    def on_reply_exchange_declare(self, frame):
+        """Bind the reply queue as one shard of the reply exchange"""
+        self.channel.queue_bind(self.on_queue_bind,
+                                queue=self.reply_queue,
+                                exchange=self.reply_exchange,
+                                routing_key='1')
+
+    def on_queue_bind(self, frame):
+        """Start consuming replies and requesting metrics"""
+        if self.prefetch > 0:
+            self.channel.basic_qos(prefetch_count=self.prefetch)
+            self.connection.add_timeout(self.flush_interval, self.acknowledge)
+        self.start_consuming()
+        if self.period is not None:
+            self.start_requesting(self.period)
+
+    def store(self, host, samples, delivery_tag=None):
+        """Queue the samples of a host for the writer, pause consuming when
+        the writer falls behind"""
+        item = (host, samples, delivery_tag)
+        try:
+            self.pending.put_nowait(item)
+        except Full:
+            # Replies already on their way are kept until the writer catches up
+            self.overflow.append(item)
+            if self.consumer_tag is not None:
+                print 'Writer behind, pausing consumer'
+                self.stop_consuming()
+                self.connection.add_timeout(self.resume_delay, self.resume)
+
+    def resume(self):
+        """Move overflow replies to the writer queue and consume again"""
+        while self.overflow:
+            try:
+                self.pending.put_nowait(self.overflow[0])
+            except Full:
+                self.connection.add_timeout(self.resume_delay, self.resume)
+                return
+            self.overflow.pop(0)
+        if not self.stopping:
+            print 'Writer caught up, resuming consumer'
+            self.start_consuming()
+
+    def write_loop(self):
+        """Store queued replies until None is queued"""
+        uncommitted = 0
+        last_delivery_tag = None
+        while True:
+            try:
+                item = self.pending.get(timeout=self.flush_interval)
+            except Empty:
+                # Commit batches that waited long enough, or that hold
+                # back replies after a failed commit
+                self.flush(due=not uncommitted or
+                           uncommitted < self.prefetch)
+                item = False
+            if item is None:
+                break
+            if item:
+                host, samples, delivery_tag = item
+                start = STATS.now()
+                try:
+                    self.database.set_metrics(host, samples)
+                    stored = True
+                except Exception as error:
+                    print 'Failed to store metrics from %s: %s' % (host, error)
+                    stored = False
+                STATS.record('write', start)
+                if delivery_tag is not None and not stored:
+                    # Acknowledging later replies must not cover this one
+                    self.committed.put((delivery_tag, False))
+                elif delivery_tag is not None:
+                    uncommitted += 1
+                    last_delivery_tag = delivery_tag
+
+                    # No more replies come before some are acknowledged
+                    if uncommitted >= self.prefetch:
+                        self.flush()
+            if uncommitted and not self.database.pending_count:
+                self.committed.put((last_delivery_tag, True))
+                uncommitted = 0
+        self.flush()
+        self.database.close_session()
+
+    def acknowledge(self):
+        """Acknowledge replies up to the last committed one and requeue
+        failed ones in the order the writer saw them, then check again
+        after flush_interval"""
+        delivery_tag = None
+        while not self.committed.empty():
+            tag, stored = self.committed.get_nowait()
+            if stored:
+                delivery_tag = tag
+                continue
+            if delivery_tag is not None:
+                self.channel.basic_ack(delivery_tag=delivery_tag,
+                                       multiple=True)
+                delivery_tag = None
+            self.channel.basic_nack(delivery_tag=tag, requeue=True)
+        if delivery_tag is not None:
+            self.channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+        self.connection.add_timeout(self.flush_interval, self.acknowledge)
+
+    def start_requesting(self, period):
+        """Start request schedule"""
+        self.period = period
+        self.requesting = True
+        self.send_request()
+
+    def send_request(self):
+        """Send a request and schedule the next one"""
+        if not self.requesting:
+            return
+        self.channel.basic_publish(exchange='request',
+                                   routing_key='',
+                                   body='request_metrics')
+        print 'Request sent'
+        self.connection.add_timeout((float)(self.period), self.send_request)
+
+    def start_consuming(self):
+        """Start consuming reply messages"""
+        self.consumer_tag = self.channel.basic_consume(
+            self.receive_metric, queue=self.reply_queue,
+            no_ack=self.prefetch <= 0)
+
+    def stop_consuming(self):
+        """Stop consuming reply messages"""
+        self.channel.basic_cancel(consumer_tag=self.consumer_tag)
+        self.consumer_tag = None
+
+    def disconnect(self):
+        """The writer thread flushes and closes the database session when
+        run() returns, nothing is left to disconnect"""
@@ -0,0 +1,97 @@
+"""
+    Recent samples cache module
+"""
+from array import array
+from threading import Lock
+
+
+class RingBuffer(object):
+    """Last size samples of a series, timestamps are epoch milliseconds"""
+
+    def __init__(self, size):
+        self.size = size
+        self.timestamps = array('d', [0] * size)
+        self.values = array('d', [0] * size)
+        self.count = 0
+        self.next = 0
+
+    def append(self, timestamp, value):
+        """Add a sample, overwriting the oldest one when full"""
+        self.timestamps[self.next] = timestamp
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def latest(self):
+        """Get the last (timestamp, value) sample, None when empty"""
+        if not self.count:
+            return None
+        index = (self.next - 1) % self.size
+        return (self.timestamps[index], self.values[index])
+
+    def window(self, count=None):
+        """Get the last count (timestamp, value) samples, oldest first"""
+        if count is None or count > self.count:
+            count = self.count
+        start = self.next - count
+        indexes = [(start + offset) % self.size for offset in range(count)]
+        return [(self.timestamps[index], self.values[index])
+                for index in indexes]
+
+    def stats(self, count=None):
+        """Get min, max, avg and count of the last count samples, None when
+        empty"""
+        values = [value for _, value in self.window(count)]
+        if not values:
+            return None
+        return {'min': min(values),
+                'max': max(values),
+                'avg': sum(values) / len(values),
+                'count': len(values)}
+
+
+class SampleCache(object):
+    """Ring buffers of the last samples of every (host, metric) series"""
+
+    def __init__(self, size=60):
+        self.size = size
+        self.buffers = {}
+        self.lock = Lock()
+
+    def update(self, host, samples):
+        """Add the (timestamp, metric, value) samples of a host, timestamps
+        are epoch milliseconds"""
+        with self.lock:
+            for timestamp, metric, value in samples:
+                key = (host, metric)
+                if key not in self.buffers:
+                    self.buffers[key] = RingBuffer(self.size)
+                self.buffers[key].append(timestamp, value)
+
+    def series(self):
+        """Get the (host, metric) keys of all cached series"""
+        with self.lock:
+            return self.buffers.keys()
+
+    def latest(self, host, metric):
+        """Get the last (timestamp, value) sample of a series"""
+        with self.lock:
+            if (host, metric) not in self.buffers:
+                return None
+            return self.buffers[(host, metric)].latest()
+
+    def window(self, host, metric, count=None):
+        """Get the last count (timestamp, value) samples of a series"""
+        with self.lock:
+            if (host, metric) not in self.buffers:
+                return []
+            return self.buffers[(host, metric)].window(count)
+
+    def stats(self, host, metric, count=None):
+        """Get min, max, avg and count over the last count samples of a
+        series"""
+        with self.lock:
+            if (host, metric) not in self.buffers:
+                return None
+            return self.buffers[(host, metric)].stats(count)
@@ -0,0 +1,163 @@
+"""
+    Wire format module
+"""
+from collections import namedtuple
+from struct import Struct, unpack_from
+from threading import Lock
+
+# Content type of encoded replies, replies without it use the legacy
+# str()/literal_eval format
+CONTENT_TYPE = 'application/x-monitor-v1'
+VERSION = 1
+
+# Replies with per device samples
+DEVICES_VERSION = 2
+
+# Replies with per device samples and sample summaries
+SUMMARIES_VERSION = 3
+
+# Interned metric identifiers, must match agent/codec.py
+METRIC_NAMES = {
+    1: 'available_memory',
+    2: 'total_memory',
+    3: 'cpu_percentage',
+    4: 'network_bytes_sent',
+    5: 'network_bytes_received',
+    6: 'disk_reads_sec',
+    7: 'disk_writes_sec',
+}
+
+# Interned per device metric identifiers, must match agent/codec.py
+VECTOR_METRIC_NAMES = {
+    1: 'cpu_percentage_per_core',
+    2: 'network_bytes_sent_per_nic',
+    3: 'network_bytes_received_per_nic',
+    4: 'disk_reads_sec_per_disk',
+    5: 'disk_writes_sec_per_disk',
+}
+
+# Per device samples are stored as the metric family/device
+DEVICE_SEPARATOR = '/'
+
+# Header: version, host name length, sample count
+HEADER = Struct('!BBH')
+
+# Sample: metric id, flags, epoch timestamp in milliseconds, value
+SAMPLE = Struct('!BBQq')
+
+# Summary of a flagged sample, following it: minimum, maximum, mean and
+# reading count, the sample value is the last reading
+SUMMARY = Struct('!qqdI')
+
+# Vector section: vector count, then per vector its metric id, flags,
+# epoch timestamp in milliseconds, device dictionary id and value count,
+# the device names when flagged and the packed values
+VECTOR_COUNT = Struct('!H')
+VECTOR = Struct('!BBQHH')
+DEVICE_NAME = Struct('!B')
+
+# Sample flags, missing samples carry no value, vectors flagged with
+# DEVICES carry their device names, samples flagged with SUMMARIZED are
+# followed by a summary
+MISSING = 0x01
+DEVICES = 0x02
+SUMMARIZED = 0x04
+
+# Readings of a metric over a request period
+Summary = namedtuple('Summary', 'min max mean last count')
+
+
+def device_metric(metric_type, device):
+    """Metric name of one device of a per device metric"""
+    return metric_type + DEVICE_SEPARATOR + device
+
+
+def summary_metric(metric_type, statistic):
+    """Metric name of a statistic of a sampled metric, kept like a device
+    of the metric"""
+    return metric_type + DEVICE_SEPARATOR + statistic
+
+
+def split_metric(metric):
+    """Split a metric name into its family and device, None for metrics
+    that are not per device"""
+    family, _, device = metric.partition(DEVICE_SEPARATOR)
+    return family, device or None
+
+
+class DeviceDictionaries(object):
+    """Device lists of every host's per device metrics, agents only send a
+    list when it changes and now and then after that"""
+    def __init__(self):
+        self.lock = Lock()
+        self.devices = {}
+
+    def resolve(self, host, metric_type, dictionary_id, devices=None):
+        """Store the device list of a dictionary id when sent, returns the
+        known device list of the id or None"""
+        key = (host, metric_type)
+        with self.lock:
+            if devices is not None:
+                self.devices[key] = (dictionary_id, devices)
+                return devices
+            entry = self.devices.get(key)
+        if entry is None or entry[0] != dictionary_id:
+            return None
+        return entry[1]
+
+
+def decode(body, dictionaries=None):
+    """Unpack a reply into its host and (timestamp, metric_type, value)
+    samples, missing samples have a None value, per device samples are
+    named by device_metric() and dropped until their device list is known,
+    summarized samples have a Summary value, samples of unknown metrics
+    from newer agents are skipped"""
+    version, host_length, count = HEADER.unpack_from(body, 0)
+    if version not in (VERSION, DEVICES_VERSION, SUMMARIES_VERSION):
+        raise ValueError('Unsupported message version %d' % version)
+    offset = HEADER.size
+    host = body[offset:offset + host_length].decode('utf-8')
+    offset += host_length
+    samples = []
+    for _ in range(count):
+        metric_id, flags, timestamp, value = SAMPLE.unpack_from(body, offset)
+        offset += SAMPLE.size
+        if flags & MISSING:
+            value = None
+        elif flags & SUMMARIZED:
+            low, high, mean, readings = SUMMARY.unpack_from(body, offset)
+            offset += SUMMARY.size
+            value = Summary(low, high, mean, value, readings)
+        if metric_id in METRIC_NAMES:
+            samples.append((timestamp, METRIC_NAMES[metric_id], value))
+    if version == VERSION:
+        return host, samples
+
+    if dictionaries is None:
+        dictionaries = DeviceDictionaries()
+    vector_count, = VECTOR_COUNT.unpack_from(body, offset)
+    offset += VECTOR_COUNT.size
+    for _ in range(vector_count):
+        (metric_id, flags, timestamp, dictionary_id,
+         value_count) = VECTOR.unpack_from(body, offset)
+        offset += VECTOR.size
+        metric_type = VECTOR_METRIC_NAMES.get(metric_id)
+        devices = None
+        if flags & DEVICES:
+            devices = []
+            for _ in range(value_count):
+                length, = DEVICE_NAME.unpack_from(body, offset)
+                offset += DEVICE_NAME.size
+                devices.append(body[offset:offset + length].decode('utf-8'))
+                offset += length
+        values = unpack_from('!%dq' % value_count, body, offset)
+        offset += 8 * value_count
+        if flags & MISSING or metric_type is None:
+            continue
+        devices = dictionaries.resolve(host, metric_type, dictionary_id,
+                                       devices)
+        if devices is None or len(devices) != value_count:
+            continue
+        samples.extend((timestamp, device_metric(metric_type, device), value)
+                       for device, value in zip(devices, values))
+    return host, samples
@@ -6,14 +6,71 @@ from pika import PlainCredentials, ConnectionParameters, BlockingConnection
 from logging import basicConfig, CRITICAL
 from time import sleep
 from ast import literal_eval
-from database import Database
+from database import Database, epoch_ms
+from cache import SampleCache
+from rates import RateConverter, COUNTERS
 from datetime import datetime
+from codec import decode, summary_metric, DeviceDictionaries, Summary
+from codec import CONTENT_TYPE
+from stats import STATS
+
+
+def expand_summaries(samples):
+    """Replace summarized samples by their mean, the last reading for
+    counters, and min and max samples of the metric"""
+    expanded = []
+    for timestamp, metric_type, value in samples:
+        if not isinstance(value, Summary):
+            expanded.append((timestamp, metric_type, value))
+        elif metric_type in COUNTERS:
+            expanded.append((timestamp, metric_type, value.last))
+        else:
+            expanded.append((timestamp, metric_type,
+                             (int)(round(value.mean))))
+            expanded.append((timestamp, summary_metric(metric_type, 'min'),
+                             value.min))
+            expanded.append((timestamp, summary_metric(metric_type, 'max'),
+                             value.max))
+    return expanded
+
+
+def parse_reply(properties, body, devices=None):
+    """Decode a reply into its host and (timestamp, metric_type, value)
+    samples, timestamps are epoch milliseconds, devices keeps the device
+    lists of per device metrics"""
+    if properties.content_type == CONTENT_TYPE:
+        start = STATS.now()
+        host, samples = decode(body, devices)
+        STATS.record('receive.decode', start)
+        # Missing samples are not stored
+        samples = [sample for sample in samples if sample[2] is not None]
+        return host, expand_summaries(samples)
+
+    # Legacy agents send str() encoded lists
+    start = STATS.now()
+    metric = literal_eval(body)
+    STATS.record('receive.literal_eval', start)
+    start = STATS.now()
+    timestamp = epoch_ms(datetime(year=metric[0][0],
+                                  month=metric[0][1],
+                                  day=metric[0][2],
+                                  hour=metric[0][3],
+                                  minute=metric[0][4],
+                                  second=metric[0][5],
+                                  microsecond=metric[0][6]))
+    STATS.record('receive.datetime', start)
+    host = metric[1]
+    metric_type = metric[2]
+    value = metric[3]
+    return host, [(timestamp, metric_type, value)]
 
 
 class Controller(object):
     """Controller handler class"""
 
-    def __init__(self, user, password, ip, port, database_url):
+    def __init__(self, user, password, ip, port, database_url,
+                 database_options=None, prefetch=0, reply_queue='reply',
+                 reply_exchange=None, cache_size=60, flush_interval=1):
         """Connect to RabbitMQ server and to the database"""
 
         credentials = PlainCredentials(user, password)
@@ -32,33 +89,128 @@ class Controller(object):
 
         self.requesting = False
 
-        # Prepare reply queue
-        self.channel.queue_declare(queue='reply')
+        # Prepare reply queue, with a prefetch above 0 replies are
+        # acknowledged once stored and the broker holds back more once
+        # prefetch of them are unacknowledged
+        self.unacked = 0
+        self.last_delivery_tag = None
+        self.channel.queue_declare(queue=reply_queue)
+        if reply_exchange is not None:
+            # Agents route replies by a consistent hash of their host name,
+            # the binding key is the weight of this shard
+            self.channel.exchange_declare(exchange=reply_exchange,
+                                          type='x-consistent-hash')
+            self.channel.queue_bind(exchange=reply_exchange,
+                                    queue=reply_queue,
+                                    routing_key='1')
+        if prefetch > 0:
+            self.channel.basic_qos(prefetch_count=prefetch)
         self.channel.basic_consume(self.receive_metric,
-                                   queue='reply',
-                                   no_ack=True)
+                                   queue=reply_queue,
+                                   no_ack=prefetch <= 0)
+
+        # Batches are committed on the consumer thread every
+        # flush_interval seconds while no replies come
+        self.prepare_ingest(database_url, database_options, prefetch,
+                            cache_size, flush_interval)
+        self.connection.add_timeout(flush_interval, self.flush_due)
+
+    def prepare_ingest(self, database_url, database_options, prefetch,
+                       cache_size, flush_interval):
+        """Connect to the database and prepare the reply pipeline"""
+        self.prefetch = prefetch
+        self.database = Database(database_url, **(database_options or {}))
+        self.flush_interval = flush_interval
+
+        # Keep the last cache_size samples of every series in memory
+        self.cache = SampleCache(cache_size)
 
-        # Connect to database
-        self.database = Database(database_url)
+        # Network counters are stored as per second rates
+        self.rates = RateConverter()
+
+        # Device lists of per device metrics, sent apart from their values
+        self.devices = DeviceDictionaries()
 
     def receive_metric(self, channel, method, properties, body):
-        """Retrieve metric from queue and stores it into the database"""
-        metric = literal_eval(body)
-        timestamp = datetime(year=metric[0][0],
-                             month=metric[0][1],
-                             day=metric[0][2],
-                             hour=metric[0][3],
-                             minute=metric[0][4],
-                             second=metric[0][5],
-                             microsecond=metric[0][6])
-        host = metric[1]
-        metric_type = metric[2]
-        value = metric[3]
-        self.database.set_metric(metric=metric_type,
-                                 host=host,
-                                 timestamp=timestamp,
-                                 value=value)
-        print 'Retrieved ' + metric_type + ' from ' + host
+        """Retrieve metrics from queue, convert and cache them and hand
+        them to store"""
+        receive_start = STATS.now()
+        try:
+            host, samples = parse_reply(properties, body, self.devices)
+        except Exception as error:
+            self.reject(method, error)
+            return
+        start = STATS.now()
+        samples = self.rates.convert(host, samples)
+        STATS.record('receive.rates', start)
+        start = STATS.now()
+        self.cache.update(host, samples)
+        STATS.record('receive.cache', start)
+        delivery_tag = None
+        if self.prefetch > 0:
+            delivery_tag = method.delivery_tag
+        start = STATS.now()
+        try:
+            self.store(host, samples, delivery_tag)
+        except Exception as error:
+            print 'Failed to store metrics from %s: %s' % (host, error)
+            if delivery_tag is not None:
+                self.channel.basic_nack(delivery_tag=delivery_tag,
+                                        requeue=True)
+            return
+        STATS.record('receive.store', start)
+        STATS.record('receive', receive_start)
+        print 'Retrieved %d metrics from %s' % (len(samples), host)
+
+    def flush_due(self):
+        """Commit batches that waited long enough and acknowledge their
+        replies, then check again after flush_interval"""
+        # No more replies come before some are acknowledged
+        self.flush(due=self.prefetch <= 0 or self.unacked < self.prefetch)
+        if self.prefetch > 0:
+            self.acknowledge()
+        self.connection.add_timeout(self.flush_interval, self.flush_due)
+
+    def flush(self, due=False):
+        """Commit buffered samples, only once due with due, they stay
+        buffered when the commit fails"""
+        try:
+            if due:
+                self.database.flush_if_due()
+            else:
+                self.database.flush()
+        except Exception as error:
+            print 'Failed to commit metrics: %s' % error
+
+    def reject(self, method, error):
+        """Drop a reply that cannot be decoded, it would fail the same way
+        if it was delivered again"""
+        print 'Dropped bad reply: %s' % error
+        if self.prefetch > 0:
+            self.channel.basic_reject(delivery_tag=method.delivery_tag,
+                                      requeue=False)
+
+    def acknowledge(self):
+        """Acknowledge all replies received so far once the database has
+        committed them"""
+        if self.unacked and not self.database.pending_count:
+            self.channel.basic_ack(delivery_tag=self.last_delivery_tag,
+                                   multiple=True)
+            self.unacked = 0
+
+    def store(self, host, samples, delivery_tag=None):
+        """Store the (timestamp, metric_type, value) samples of a host,
+        the reply of delivery_tag is acknowledged once committed"""
+        self.database.set_metrics(host, samples)
+        if delivery_tag is None:
+            return
+        self.unacked += 1
+        self.last_delivery_tag = delivery_tag
+
+        # No more replies come before some are acknowledged
+        if self.unacked >= self.prefetch:
+            self.flush()
+        self.acknowledge()
 
     def start_requesting(self, period):
         """Start request loop"""
@@ -85,5 +237,9 @@ class Controller(object):
 
     def disconnect(self):
         """Disconnect controller from RabbitMQ server and database"""
+        # Store and acknowledge buffered replies before closing
+        self.database.flush()
+        if self.prefetch > 0:
+            self.acknowledge()
         self.connection.close()
         self.database.close_session()
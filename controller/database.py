@@ -2,10 +2,25 @@
     Database module
 """
 from abc import ABCMeta
-from sqlalchemy import Column, Integer, String, DateTime
-from sqlalchemy import create_engine
+from datetime import datetime
+from itertools import chain
+from threading import Thread, Event
+from time import time, mktime
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime
+from sqlalchemy import ForeignKey, UniqueConstraint, Index
+from sqlalchemy import MetaData, Table, create_engine, inspect, select
+from sqlalchemy import and_, func, event
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, NullPool
+from codec import split_metric
+from stats import STATS
+try:
+    import numpy
+except ImportError:
+    # Query results are plain lists without NumPy
+    numpy = None
 
 
 # Get base mapper class
@@ -17,118 +32,1081 @@ class MetricTable(object):
     __metaclass__ = ABCMeta
 
     @classmethod
-    def insert(cls, metric, timestamp, host, value):
+    def insert(cls, metric, timestamp, host_id, value):
         """Table factory"""
         if metric == 'available_memory':
             table = AvailableMemoryTable(timestamp=timestamp,
-                                         host=host,
+                                         host_id=host_id,
                                          available_memory=value)
         elif metric == 'total_memory':
             table = TotalMemoryTable(timestamp=timestamp,
-                                     host=host,
+                                     host_id=host_id,
                                      total_memory=value)
         elif metric == 'cpu_percentage':
             table = CpuPercentageTable(timestamp=timestamp,
-                                       host=host,
+                                       host_id=host_id,
                                        cpu_percentage=value)
         elif metric == 'network_bytes_sent':
             table = NetworkBytesSentTable(timestamp=timestamp,
-                                          host=host,
+                                          host_id=host_id,
                                           bytes_sent=value)
         elif metric == 'network_bytes_received':
             table = NetworkBytesReceivedTable(timestamp=timestamp,
-                                              host=host,
+                                              host_id=host_id,
                                               bytes_received=value)
+        elif metric == 'network_bytes_sent_sec':
+            table = NetworkBytesSentPerSecTable(timestamp=timestamp,
+                                                host_id=host_id,
+                                                bytes_sent_sec=value)
+        elif metric == 'network_bytes_received_sec':
+            table = NetworkBytesReceivedPerSecTable(timestamp=timestamp,
+                                                    host_id=host_id,
+                                                    bytes_received_sec=value)
         elif metric == 'disk_reads_sec':
             table = DiskReadsPerSecTable(timestamp=timestamp,
-                                         host=host,
+                                         host_id=host_id,
                                          reads_sec=value)
         elif metric == 'disk_writes_sec':
             table = DiskWritesPerSecTable(timestamp=timestamp,
-                                          host=host,
+                                          host_id=host_id,
                                           writes_sec=value)
         else:
             table = None
         return table
 
+    @classmethod
+    def row(cls, metric, timestamp, host_id, value):
+        """Core row factory, returns the metric table and its column values"""
+        if metric not in METRIC_COLUMNS:
+            return None, None
+        table, column = METRIC_COLUMNS[metric]
+        return table, {'timestamp': timestamp,
+                       'host_id': host_id,
+                       column: value}
+
+
+class HostTable(Base):
+    """Host table"""
+    __tablename__ = 'Hosts'
+    id = Column(Integer, primary_key=True)
+    name = Column(String(250), unique=True, nullable=False)
+
 
-# Metric tables
+# Metric tables, keyed by host and time
 class AvailableMemoryTable(Base):
     """Available virtual memory class"""
     __tablename__ = 'Available virtual memory'
+    host_id = Column(Integer, ForeignKey('Hosts.id'), primary_key=True)
     timestamp = Column(DateTime(timezone=True), primary_key=True)
-    host = Column(String(250))
     available_memory = Column(Integer)
 
 
 class TotalMemoryTable(Base):
     """Total virtual memory table"""
     __tablename__ = 'Total virtual memory'
+    host_id = Column(Integer, ForeignKey('Hosts.id'), primary_key=True)
     timestamp = Column(DateTime(timezone=True), primary_key=True)
-    host = Column(String(250))
     total_memory = Column(Integer)
 
 
 class CpuPercentageTable(Base):
     """CPU percentage table"""
     __tablename__ = 'CPU percentage'
+    host_id = Column(Integer, ForeignKey('Hosts.id'), primary_key=True)
     timestamp = Column(DateTime(timezone=True), primary_key=True)
-    host = Column(String(250))
     cpu_percentage = Column(Integer)
 
 
 class NetworkBytesSentTable(Base):
     """Network bytes sent table"""
     __tablename__ = 'Network bytes sent'
+    host_id = Column(Integer, ForeignKey('Hosts.id'), primary_key=True)
     timestamp = Column(DateTime(timezone=True), primary_key=True)
-    host = Column(String(250))
     bytes_sent = Column(Integer)
 
 
 class NetworkBytesReceivedTable(Base):
     """Network bytes received table"""
     __tablename__ = 'Network bytes received'
+    host_id = Column(Integer, ForeignKey('Hosts.id'), primary_key=True)
     timestamp = Column(DateTime(timezone=True), primary_key=True)
-    host = Column(String(250))
     bytes_received = Column(Integer)
 
 
+class NetworkBytesSentPerSecTable(Base):
+    """Network bytes sent/sec table"""
+    __tablename__ = 'Network bytes sent/sec'
+    host_id = Column(Integer, ForeignKey('Hosts.id'), primary_key=True)
+    timestamp = Column(DateTime(timezone=True), primary_key=True)
+    bytes_sent_sec = Column(Integer)
+
+
+class NetworkBytesReceivedPerSecTable(Base):
+    """Network bytes received/sec table"""
+    __tablename__ = 'Network bytes received/sec'
+    host_id = Column(Integer, ForeignKey('Hosts.id'), primary_key=True)
+    timestamp = Column(DateTime(timezone=True), primary_key=True)
+    bytes_received_sec = Column(Integer)
+
+
 class DiskReadsPerSecTable(Base):
     """Disk reads/sec table"""
     __tablename__ = 'Disk reads/sec'
+    host_id = Column(Integer, ForeignKey('Hosts.id'), primary_key=True)
     timestamp = Column(DateTime(timezone=True), primary_key=True)
-    host = Column(String(250))
     reads_sec = Column(Integer)
 
 
 class DiskWritesPerSecTable(Base):
     """Disk writes/sec table"""
     __tablename__ = 'Disk writes/sec'
+    host_id = Column(Integer, ForeignKey('Hosts.id'), primary_key=True)
     timestamp = Column(DateTime(timezone=True), primary_key=True)
-    host = Column(String(250))
     writes_sec = Column(Integer)
 
 
+# Samples storage, one narrow table for all metrics
+class SeriesTable(Base):
+    """Series catalog, one series per host and metric"""
+    __tablename__ = 'Series'
+    __table_args__ = (UniqueConstraint('host_id', 'metric'),)
+    id = Column(Integer, primary_key=True)
+    host_id = Column(Integer, ForeignKey('Hosts.id'), nullable=False)
+    metric = Column(String(250), nullable=False)
+
+
+class SampleTable(Base):
+    """Samples table, timestamps are in milliseconds since the epoch"""
+    __tablename__ = 'Samples'
+    __table_args__ = (Index('ix_samples_timestamp', 'timestamp'),
+                      {'sqlite_with_rowid': False})
+    series_id = Column(Integer, ForeignKey('Series.id'), primary_key=True)
+    timestamp = Column(BigInteger, primary_key=True, autoincrement=False)
+    value = Column(BigInteger)
+
+
+class RollupTable(Base):
+    """Rollup tiers of the samples table, tier is the bucket width in
+    seconds, buckets start at milliseconds since the epoch"""
+    __tablename__ = 'Rollups'
+    __table_args__ = (Index('ix_rollups_bucket', 'tier', 'bucket'),
+                      {'sqlite_with_rowid': False})
+    tier = Column(Integer, primary_key=True, autoincrement=False)
+    series_id = Column(Integer, ForeignKey('Series.id'), primary_key=True)
+    bucket = Column(BigInteger, primary_key=True, autoincrement=False)
+    min = Column(BigInteger)
+    max = Column(BigInteger)
+    sum = Column(BigInteger)
+    count = Column(Integer)
+    last = Column(BigInteger)
+
+
+class WatermarkTable(Base):
+    """Rollup progress, buckets of a tier before timestamp are complete"""
+    __tablename__ = 'Rollup watermarks'
+    tier = Column(Integer, primary_key=True, autoincrement=False)
+    timestamp = Column(BigInteger, nullable=False)
+
+
+class LateBucketTable(Base):
+    """Buckets of a tier behind its watermark that got late data and are
+    aggregated again by the next rollup"""
+    __tablename__ = 'Rollup late buckets'
+    tier = Column(Integer, primary_key=True, autoincrement=False)
+    series_id = Column(Integer, ForeignKey('Series.id'), primary_key=True)
+    bucket = Column(BigInteger, primary_key=True, autoincrement=False)
+
+
+# Metric label to (table, value column) map, used by bulk inserts
+METRIC_COLUMNS = {
+    'available_memory': (AvailableMemoryTable, 'available_memory'),
+    'total_memory': (TotalMemoryTable, 'total_memory'),
+    'cpu_percentage': (CpuPercentageTable, 'cpu_percentage'),
+    'network_bytes_sent': (NetworkBytesSentTable, 'bytes_sent'),
+    'network_bytes_received': (NetworkBytesReceivedTable, 'bytes_received'),
+    'network_bytes_sent_sec': (NetworkBytesSentPerSecTable, 'bytes_sent_sec'),
+    'network_bytes_received_sec': (NetworkBytesReceivedPerSecTable,
+                                   'bytes_received_sec'),
+    'disk_reads_sec': (DiskReadsPerSecTable, 'reads_sec'),
+    'disk_writes_sec': (DiskWritesPerSecTable, 'writes_sec'),
+}
+
+
+def epoch_ms(timestamp):
+    """Milliseconds since the epoch of a local datetime"""
+    return ((int)(mktime(timestamp.timetuple())) * 1000 +
+            timestamp.microsecond // 1000)
+
+
+def from_epoch_ms(timestamp):
+    """Local datetime of milliseconds since the epoch"""
+    return datetime.fromtimestamp(timestamp // 1000).replace(
+        microsecond=timestamp % 1000 * 1000)
+
+
+def migrate(engine):
+    """Move metric tables of the timestamp keyed schema, with a host name
+    column, to the (host_id, timestamp) keyed one"""
+    inspector = inspect(engine)
+    table_names = inspector.get_table_names()
+    HostTable.__table__.create(engine, checkfirst=True)
+    hosts = HostTable.__table__
+    quote = engine.dialect.identifier_preparer.quote
+    for table, column in METRIC_COLUMNS.values():
+        name = table.__tablename__
+        if name not in table_names:
+            continue
+        columns = [info['name'] for info in inspector.get_columns(name)]
+        if 'host_id' in columns:
+            continue
+
+        print 'Migrating ' + name
+        legacy_name = name + ' (legacy)'
+        with engine.begin() as connection:
+            connection.execute('ALTER TABLE %s RENAME TO %s' %
+                               (quote(name), quote(legacy_name)))
+            legacy = Table(legacy_name, MetaData(),
+                           autoload=True, autoload_with=connection)
+            table.__table__.create(connection)
+
+            # Add unknown hosts, then copy samples with their host id
+            known_hosts = select([hosts.c.name])
+            new_hosts = select([legacy.c.host]).distinct().where(
+                legacy.c.host.isnot(None)).where(
+                ~legacy.c.host.in_(known_hosts))
+            connection.execute(hosts.insert().from_select(['name'],
+                                                          new_hosts))
+            samples = select([hosts.c.id,
+                              legacy.c.timestamp,
+                              legacy.c[column]]).where(
+                hosts.c.name == legacy.c.host)
+            connection.execute(table.__table__.insert().from_select(
+                ['host_id', 'timestamp', column], samples))
+            legacy.drop(connection)
+
+    # Samples tables created before time range scans lack their index
+    if SampleTable.__tablename__ in table_names:
+        indexes = [info['name'] for info in
+                   inspector.get_indexes(SampleTable.__tablename__)]
+        for index in SampleTable.__table__.indexes:
+            if index.name not in indexes:
+                index.create(engine)
+
+
+def create_schema(url):
+    """Migrate and create the tables of a database once, before worker
+    processes open it"""
+    engine = create_engine(url)
+    try:
+        migrate(engine)
+        Base.metadata.create_all(engine)
+    finally:
+        engine.dispose()
+
+
+# Rollup tier widths in seconds, every tier is built from the one before it
+TIERS = [60, 3600, 86400]
+
+# Default retention in seconds per tier, 0 is the raw samples tier and a
+# retention of 0 keeps a tier forever
+RETENTION = {0: 2 * 86400,
+             60: 30 * 86400,
+             3600: 365 * 86400,
+             86400: 0}
+
+
+# Aggregate row columns by aggregation name, avg is sum / count
+AGGREGATES = {'min': 2, 'max': 3, 'sum': 4, 'count': 5, 'last': 6}
+
+# End of open ended ranges, in milliseconds since the epoch
+MAX_TIMESTAMP = 2 ** 62
+
+# SQLite pragmas that may be set on every connection
+PRAGMAS = ('synchronous', 'cache_size', 'mmap_size')
+
+
+def aggregate(rows, width):
+    """Merge (series_id, timestamp, min, max, sum, count, last) rows,
+    ordered by series and time, into buckets of width milliseconds"""
+    current = None
+    for series_id, timestamp, low, high, total, count, last in rows:
+        bucket = timestamp - timestamp % width
+        if current is not None and current[:2] == [series_id, bucket]:
+            current[2] = min(current[2], low)
+            current[3] = max(current[3], high)
+            current[4] += total
+            current[5] += count
+            current[6] = last
+            continue
+        if current is not None:
+            yield tuple(current)
+        current = [series_id, bucket, low, high, total, count, last]
+    if current is not None:
+        yield tuple(current)
+
+
+def forward_fill(rows, width, limit, start, end, previous=None):
+    """Fill the empty width millisecond buckets of (series_id, bucket, min,
+    max, sum, count, last) rows between start and end with the last value
+    before them, for up to limit milliseconds after the bucket holding it,
+    previous is the last row before start"""
+    bucket = start - start % width
+    for row in chain(rows, [None]):
+        stop = end if row is None else row[1]
+        if previous is not None:
+            series_id, last = previous[0], previous[6]
+            while bucket < stop and bucket <= previous[1] + limit:
+                yield (series_id, bucket, last, last, last, 1, last)
+                bucket += width
+        if row is None:
+            return
+        yield row
+        previous = row
+        bucket = row[1] + width
+
+
+def sample_rows(rows):
+    """Turn (series_id, timestamp, value) samples into aggregate rows"""
+    for series_id, timestamp, value in rows:
+        yield (series_id, timestamp, value, value, value, 1, value)
+
+
+class Rollup(object):
+    """Builds the rollup tiers of the samples table and prunes every tier
+    past its retention, all work is done in short chunked transactions"""
+
+    def __init__(self, engine, retention=None, delay=60, chunk=60,
+                 prune_span=3600, prune_rows=10000):
+        """Samples are rolled up delay seconds after their minute ended,
+        chunk buckets per transaction, pruning deletes at most prune_span
+        seconds and about prune_rows rows per transaction"""
+        self.engine = engine
+        self.retention = dict(RETENTION)
+        self.retention.update(retention or {})
+        self.delay = delay
+        self.chunk = chunk
+        self.prune_span = prune_span
+        self.prune_rows = prune_rows
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self, interval):
+        """Run rollups every interval seconds on a background thread"""
+        self.thread = Thread(target=self.loop, args=(interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def loop(self, interval):
+        """Roll up and prune until stopped"""
+        while not self.stopped.wait(interval):
+            try:
+                self.run_once()
+            except Exception as error:
+                print 'Rollup failed: %s' % error
+
+    def run_once(self, now=None):
+        """Roll up late and complete buckets of every tier, then prune"""
+        now_ms = (int)((time() if now is None else now) * 1000)
+        for index in range(len(TIERS)):
+            self.refresh(index, now_ms)
+            self.roll(index, now_ms)
+        self.prune(now_ms)
+
+    def watermark(self, tier, connection=None):
+        """Get the end of the complete buckets of a tier, None before its
+        first rollup"""
+        query = select([WatermarkTable.__table__.c.timestamp]).where(
+            WatermarkTable.__table__.c.tier == tier)
+        return (connection or self.engine).execute(query).scalar()
+
+    def set_watermark(self, connection, tier, timestamp):
+        """Move the watermark of a tier"""
+        watermarks = WatermarkTable.__table__
+        result = connection.execute(watermarks.update().where(
+            watermarks.c.tier == tier).values(timestamp=timestamp))
+        if not result.rowcount:
+            connection.execute(watermarks.insert().values(tier=tier,
+                                                          timestamp=timestamp))
+
+    def source(self, connection, index, series_id, start, end):
+        """Get the aggregate rows a tier is built from, ordered by series
+        and time, index -1 is the raw samples tier"""
+        if index < 0:
+            samples = SampleTable.__table__
+            query = select([samples.c.series_id,
+                            samples.c.timestamp,
+                            samples.c.value]).where(
+                and_(samples.c.timestamp >= start, samples.c.timestamp < end))
+            if series_id is not None:
+                query = query.where(samples.c.series_id == series_id)
+            query = query.order_by(samples.c.series_id, samples.c.timestamp)
+            return sample_rows(connection.execute(query))
+        rollups = RollupTable.__table__
+        query = select([rollups.c.series_id,
+                        rollups.c.bucket,
+                        rollups.c.min,
+                        rollups.c.max,
+                        rollups.c.sum,
+                        rollups.c.count,
+                        rollups.c.last]).where(
+            and_(rollups.c.tier == TIERS[index],
+                 rollups.c.bucket >= start,
+                 rollups.c.bucket < end))
+        if series_id is not None:
+            query = query.where(rollups.c.series_id == series_id)
+        query = query.order_by(rollups.c.series_id, rollups.c.bucket)
+        return connection.execute(query)
+
+    def oldest(self, index, connection=None):
+        """Get the oldest timestamp of a tier, None when it is empty"""
+        connection = connection or self.engine
+        if index < 0:
+            column = SampleTable.__table__.c.timestamp
+            return connection.execute(select([func.min(column)])).scalar()
+        rollups = RollupTable.__table__
+        return connection.execute(select([func.min(rollups.c.bucket)]).where(
+            rollups.c.tier == TIERS[index])).scalar()
+
+    def roll(self, index, now_ms):
+        """Aggregate the complete buckets of a tier from the tier before it,
+        chunk buckets per transaction"""
+        tier = TIERS[index]
+        width = tier * 1000
+        if index == 0:
+            end = now_ms - self.delay * 1000
+        else:
+            end = self.watermark(TIERS[index - 1])
+            if end is None:
+                return
+        end -= end % width
+        start = self.watermark(tier)
+        if start is None:
+            start = self.oldest(index - 1)
+            if start is None:
+                return
+            start -= start % width
+        while start < end:
+            stop = min(end, start + width * self.chunk)
+            with self.engine.begin() as connection:
+                rows = [{'tier': tier,
+                         'series_id': series_id,
+                         'bucket': bucket,
+                         'min': low,
+                         'max': high,
+                         'sum': total,
+                         'count': count,
+                         'last': last}
+                        for series_id, bucket, low, high, total, count, last
+                        in aggregate(self.source(connection, index - 1, None,
+                                                 start, stop), width)]
+                if rows:
+                    connection.execute(RollupTable.__table__.insert(), rows)
+                self.set_watermark(connection, tier, stop)
+            start = stop
+
+    def mark(self, connection, index, keys):
+        """Mark the buckets of a tier holding (series_id, timestamp) keys
+        as late when they are behind its watermark"""
+        if index >= len(TIERS):
+            return
+        tier = TIERS[index]
+        width = tier * 1000
+        watermark = self.watermark(tier, connection)
+        if watermark is None:
+            return
+        late = set((series_id, timestamp - timestamp % width)
+                   for series_id, timestamp in keys if timestamp < watermark)
+        if late:
+            insert = LateBucketTable.__table__.insert().prefix_with(
+                'OR IGNORE', dialect='sqlite')
+            connection.execute(insert, [{'tier': tier,
+                                         'series_id': series_id,
+                                         'bucket': bucket}
+                                        for series_id, bucket in sorted(late)])
+
+    def refresh(self, index, now_ms):
+        """Aggregate the late buckets of a tier again from the tier before
+        it, chunk buckets per transaction, buckets whose source is past its
+        retention are dropped"""
+        tier = TIERS[index]
+        width = tier * 1000
+        retention = self.retention.get(TIERS[index - 1] if index else 0)
+        cutoff = now_ms - retention * 1000 if retention else None
+        late = LateBucketTable.__table__
+        rollups = RollupTable.__table__
+        while True:
+            with self.engine.begin() as connection:
+                buckets = connection.execute(
+                    select([late.c.series_id, late.c.bucket]).where(
+                        late.c.tier == tier).order_by(
+                        late.c.series_id, late.c.bucket).limit(
+                        self.chunk)).fetchall()
+                if not buckets:
+                    return
+                for series_id, bucket in buckets:
+                    connection.execute(late.delete().where(
+                        and_(late.c.tier == tier,
+                             late.c.series_id == series_id,
+                             late.c.bucket == bucket)))
+                    if cutoff is not None and bucket < cutoff:
+                        continue
+                    connection.execute(rollups.delete().where(
+                        and_(rollups.c.tier == tier,
+                             rollups.c.series_id == series_id,
+                             rollups.c.bucket == bucket)))
+                    rows = [{'tier': tier,
+                             'series_id': series_id,
+                             'bucket': bucket,
+                             'min': low,
+                             'max': high,
+                             'sum': total,
+                             'count': count,
+                             'last': last}
+                            for _, bucket, low, high, total, count, last
+                            in aggregate(self.source(connection, index - 1,
+                                                     series_id, bucket,
+                                                     bucket + width), width)]
+                    if rows:
+                        connection.execute(rollups.insert(), rows)
+
+                # The next tier was built from the old buckets
+                self.mark(connection, index + 1, buckets)
+
+    def prune(self, now_ms):
+        """Delete data past the retention of every tier, data is kept until
+        the next tier has been built from it"""
+        samples = SampleTable.__table__
+        rollups = RollupTable.__table__
+        for index in range(-1, len(TIERS)):
+            tier = TIERS[index] if index >= 0 else 0
+            if not self.retention.get(tier):
+                continue
+            cutoff = now_ms - self.retention[tier] * 1000
+            if index + 1 < len(TIERS):
+                cutoff = min(cutoff, self.watermark(TIERS[index + 1]) or 0)
+            if index < 0:
+                self.delete(samples, samples.c.timestamp, cutoff)
+            else:
+                self.delete(rollups, rollups.c.bucket, cutoff,
+                            rollups.c.tier == tier)
+
+    def delete(self, table, column, cutoff, condition=None):
+        """Delete rows before cutoff, at most prune_span seconds and
+        prune_rows rows per transaction, plus the rows sharing the last
+        timestamp"""
+        while True:
+            with self.engine.begin() as connection:
+                query = select([func.min(column)])
+                if condition is not None:
+                    query = query.where(condition)
+                oldest = connection.execute(query).scalar()
+                if oldest is None or oldest >= cutoff:
+                    return
+                stop = min(cutoff, oldest + self.prune_span * 1000)
+
+                # Timestamp of the first row past the chunk, found by a
+                # scan of the time index
+                query = select([column]).order_by(column).offset(
+                    self.prune_rows).limit(1)
+                if condition is not None:
+                    query = query.where(condition)
+                bound = connection.execute(query).scalar()
+                if bound is not None:
+                    stop = min(stop, max(bound, oldest + 1))
+                clause = column < stop
+                if condition is not None:
+                    clause = and_(condition, clause)
+                connection.execute(table.delete().where(clause))
+
+    def select_tier(self, start, step, now=None, connection=None):
+        """Get the index of the coarsest tier whose width divides step
+        seconds that still holds data from start, -1 for raw samples, else
+        the finest tier that holds it, else the coarsest tier"""
+        now_ms = (int)((time() if now is None else now) * 1000)
+        indexes = range(-1, len(TIERS))
+
+        def retained(index, start):
+            retention = self.retention.get(TIERS[index] if index >= 0 else 0)
+            return not retention or start >= now_ms - retention * 1000
+
+        covering = [index for index in indexes if retained(index, start)]
+        if len(covering) < len(indexes):
+            # Data past retention is kept until it is pruned, and no tier
+            # holds data before the oldest of them all
+            oldest = dict((index, self.oldest(index, connection))
+                          for index in indexes)
+            known = [timestamp for timestamp in oldest.values()
+                     if timestamp is not None]
+            if known:
+                start = max(start, min(known))
+            covering = [index for index in indexes
+                        if retained(index, start) or
+                        oldest[index] is not None and oldest[index] <= start]
+        # Buckets of a tier only merge into steps they divide
+        fitting = [index for index in covering
+                   if index < 0 or step % TIERS[index] == 0]
+        if fitting:
+            return fitting[-1]
+        if covering:
+            return covering[0]
+        return len(TIERS) - 1
+
+    def read(self, series_id, start, end, step=None, now=None,
+             connection=None):
+        """Get (series_id, bucket, min, max, sum, count, last) rows of a
+        series between start and end epoch milliseconds, in buckets of step
+        seconds read from the coarsest tier that fits, through connection
+        when given"""
+        if connection is None:
+            with self.engine.connect() as connection:
+                for row in self.read(series_id, start, end, step, now,
+                                     connection):
+                    yield row
+            return
+        if not step:
+            index = -1
+        else:
+            index = self.select_tier(start, step, now, connection)
+        rows = self.tier_rows(connection, index, series_id, start, end)
+        if step:
+            rows = aggregate(rows, step * 1000)
+        for row in rows:
+            yield row
+
+    def tier_rows(self, connection, index, series_id, start, end):
+        """Get the rows of a tier from the bucket holding start, buckets
+        past its watermark are aggregated from the tier before it"""
+        if index < 0:
+            for row in self.source(connection, -1, series_id, start, end):
+                yield row
+            return
+        tier = TIERS[index]
+        start -= start % (tier * 1000)
+        watermark = self.watermark(tier, connection) or start
+        watermark = max(start, min(end, watermark))
+        for row in self.source(connection, index, series_id, start,
+                               watermark):
+            yield tuple(row)
+        for row in aggregate(self.tier_rows(connection, index - 1, series_id,
+                                            watermark, end), tier * 1000):
+            yield row
+
+
+def set_pragmas(engine, pragmas):
+    """Set SQLite pragmas on every new connection of an engine"""
+    def connect(connection, record):
+        cursor = connection.cursor()
+        for name, value in sorted(pragmas.items()):
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+    event.listen(engine, 'connect', connect)
+
+
+def sqlite_engine(url, pool_size, pragmas):
+    """Create an engine of at most pool_size SQLite connections, shared
+    by all threads, with pragmas set on every connection"""
+    engine = create_engine(url, poolclass=QueuePool, pool_size=pool_size,
+                           max_overflow=0,
+                           connect_args={'check_same_thread': False})
+    set_pragmas(engine, pragmas)
+    return engine
+
+
+class Checkpointer(object):
+    """Checkpoints the write-ahead log of a SQLite database from a
+    background thread, so commits never wait for a checkpoint"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.stopped = Event()
+        self.thread = None
+
+    def start(self, interval):
+        """Checkpoint every interval seconds on a background thread"""
+        self.thread = Thread(target=self.loop, args=(interval,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop the background thread"""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def loop(self, interval):
+        """Checkpoint until stopped"""
+        while not self.stopped.wait(interval):
+            try:
+                self.run_once()
+            except Exception as error:
+                print 'Checkpoint failed: %s' % error
+
+    def run_once(self):
+        """Copy committed pages back to the database file as far as open
+        readers allow, returns the (log, checkpointed) frame counts"""
+        with self.engine.connect() as connection:
+            _, log, checkpointed = connection.execute(
+                'PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+        return log, checkpointed
+
+
 class Database(object):
     """Main database class"""
 
-    def __init__(self, url):
+    def __init__(self, url, batch_size=1, commit_latency=0, storage='tables',
+                 rollup_interval=0, retention=None, wal=False, pragmas=None,
+                 read_connections=4, checkpoint_interval=0):
         """Create new session"""
-        engine = create_engine(url)
+        # Pragmas are set on every SQLite connection
+        pragmas = dict(pragmas or {})
+        for name in pragmas:
+            if name not in PRAGMAS:
+                raise ValueError('Unknown pragma ' + name)
+        if wal:
+            # One writer connection in WAL mode, queries go through up to
+            # read_connections read only ones
+            database = make_url(url)
+            if (database.get_backend_name() != 'sqlite' or
+                    database.database in (None, '', ':memory:')):
+                raise ValueError('WAL needs a SQLite database file')
+
+            # Readers never block the writer, commits only wait for the
+            # checkpoint thread when there is one
+            writer_pragmas = dict(pragmas, journal_mode='WAL')
+            if checkpoint_interval > 0:
+                writer_pragmas['wal_autocheckpoint'] = 0
+            engine = sqlite_engine(url, 1, writer_pragmas)
+            self.reader = sqlite_engine(url, read_connections,
+                                        dict(pragmas, query_only='ON'))
+        else:
+            engine = create_engine(url)
+            if pragmas:
+                set_pragmas(engine, pragmas)
+            self.reader = engine
+        migrate(engine)
         Base.metadata.create_all(engine)
         Base.metadata.bind = engine
         DBSession = sessionmaker(bind=engine)
         self.session = DBSession()
+        self.engine = engine
+        self.wal = wal
+
+        # Checkpoints of the write-ahead log
+        self.checkpointer = None
+        if wal and checkpoint_interval > 0:
+            # The writer's only connection stays free for commits
+            self.checkpointer = Checkpointer(create_engine(
+                url, poolclass=NullPool))
+            self.checkpointer.start(checkpoint_interval)
+
+        # Rollup tiers and retention of the samples table
+        self.rollup = Rollup(engine, retention)
+        if rollup_interval > 0:
+            self.rollup.start(rollup_interval)
+
+        # Prepare write buffer, a batch size of 1 commits every sample
+        self.batch_size = batch_size
+        self.commit_latency = commit_latency
+        self.pending = {}
+        self.pending_count = 0
+        self.pending_since = None
+
+        # Host name and series id caches, storage is either 'tables' (one
+        # table per metric) or 'samples' (one table for all metrics), per
+        # device metrics always go to the samples table
+        self.storage = storage
+        self.host_ids = {}
+        self.series_ids = {}
 
     def set_metric(self, metric, timestamp, host, value):
-        """Set new metric data to the appropriate table"""
-        new_entry = MetricTable.insert(metric=metric,
-                                       timestamp=timestamp,
-                                       host=host,
-                                       value=value)
-        self.session.add(new_entry)
-        self.session.commit()
+        """Set new metric data to the appropriate table, timestamp is in
+        milliseconds since the epoch"""
+        set_start = STATS.now()
+        host_id = self.get_host_id(host)
+        if self.batch_size <= 1 and not self.narrow(metric):
+            start = STATS.now()
+            new_entry = MetricTable.insert(metric=metric,
+                                           timestamp=from_epoch_ms(timestamp),
+                                           host_id=host_id,
+                                           value=value)
+            self.session.add(new_entry)
+            STATS.record('db.insert', start)
+            start = STATS.now()
+            self.session.commit()
+            STATS.record('db.commit', start)
+            STATS.record('db.set_metric', set_start)
+            return
+
+        # Buffer the sample, flush once the batch is full or too old
+        start = STATS.now()
+        self.buffer_metric(metric=metric,
+                           timestamp=timestamp,
+                           host_id=host_id,
+                           value=value)
+        STATS.record('db.insert', start)
+        self.flush_if_due()
+        STATS.record('db.set_metric', set_start)
+
+    def set_metrics(self, host, samples):
+        """Set a batch of (timestamp, metric, value) samples of one host,
+        timestamps are in milliseconds since the epoch, unbuffered batches
+        are written in a single transaction"""
+        set_start = STATS.now()
+        host_id = self.get_host_id(host)
+        start = STATS.now()
+        for timestamp, metric, value in samples:
+            self.buffer_metric(metric=metric,
+                               timestamp=timestamp,
+                               host_id=host_id,
+                               value=value)
+        STATS.record('db.insert', start)
+        if self.batch_size <= 1:
+            self.flush()
+        else:
+            self.flush_if_due()
+        STATS.record('db.set_metric', set_start)
+
+    def buffer_metric(self, metric, timestamp, host_id, value):
+        """Add a sample to the write buffer"""
+        if self.narrow(metric):
+            table = SampleTable
+            row = {'series_id': self.get_series_id(host_id, metric),
+                   'timestamp': timestamp,
+                   'value': value}
+        else:
+            # Metric tables keep local datetimes
+            table, row = MetricTable.row(metric=metric,
+                                         timestamp=from_epoch_ms(timestamp),
+                                         host_id=host_id,
+                                         value=value)
+        if table is None:
+            return
+        self.pending.setdefault(table, []).append(row)
+        self.pending_count += 1
+        if self.pending_since is None:
+            self.pending_since = time()
+
+    def narrow(self, metric):
+        """Whether a metric is kept in the samples table, per device
+        metrics have a series per device whatever the storage"""
+        return self.storage == 'samples' or split_metric(metric)[1] is not None
+
+    def get_host_id(self, host):
+        """Get the id of a host, new hosts are added to the hosts table"""
+        if host not in self.host_ids:
+            entry = self.session.query(HostTable).filter_by(name=host).first()
+            if entry is None:
+                entry = HostTable(name=host)
+                self.session.add(entry)
+                self.session.flush()
+            self.host_ids[host] = entry.id
+
+            # Also ends the lookup, the writer connection is not held
+            self.session.commit()
+        return self.host_ids[host]
+
+    def get_series_id(self, host_id, metric):
+        """Get the id of a host's metric series, new series are added to
+        the series catalog"""
+        key = (host_id, metric)
+        if key not in self.series_ids:
+            entry = self.session.query(SeriesTable).filter_by(
+                host_id=host_id, metric=metric).first()
+            if entry is None:
+                entry = SeriesTable(host_id=host_id, metric=metric)
+                self.session.add(entry)
+                self.session.flush()
+            self.series_ids[key] = entry.id
+            self.session.commit()
+        return self.series_ids[key]
+
+    def flush_if_due(self):
+        """Flush the write buffer once it is full or too old"""
+        if self.pending_count >= self.batch_size:
+            self.flush()
+        elif (self.pending_count and self.commit_latency > 0 and
+              time() - self.pending_since >= self.commit_latency):
+            self.flush()
+
+    def flush(self):
+        """Bulk insert buffered samples, one statement per table, samples
+        stay buffered when the commit fails"""
+        if not self.pending_count:
+            return
+        flush_start = STATS.now()
+        pending, count, since = (self.pending, self.pending_count,
+                                 self.pending_since)
+        self.pending = {}
+        self.pending_count = 0
+        self.pending_since = None
+        try:
+            for table, rows in pending.items():
+                # Redelivered replies may repeat committed samples
+                insert = table.__table__.insert().prefix_with('OR IGNORE',
+                                                              dialect='sqlite')
+                self.session.execute(insert, rows)
+                if table is SampleTable:
+                    # Samples behind the rollups are rolled up again
+                    self.rollup.mark(self.session, 0,
+                                     [(row['series_id'], row['timestamp'])
+                                      for row in rows])
+            start = STATS.now()
+            self.session.commit()
+            STATS.record('db.commit', start)
+        except Exception:
+            self.session.rollback()
+
+            # Keep the samples for the next flush
+            for table, rows in pending.items():
+                self.pending.setdefault(table, [])[:0] = rows
+            self.pending_count += count
+            self.pending_since = since
+            raise
+        STATS.record('db.flush', flush_start)
+
+    def query(self, metric, hosts=None, start=None, end=None, step=None,
+              agg='avg', fill=None):
+        """Get a metric of hosts (all when None) between start and end epoch
+        milliseconds as {host: (timestamps, values)} columns, samples are
+        aggregated with agg into buckets of step seconds when it is set,
+        with fill empty buckets hold the last value reported up to fill
+        seconds before them"""
+        columns = {}
+        for host, timestamps, values in self.stream(metric, hosts, start,
+                                                    end, step, agg,
+                                                    fill=fill):
+            if host in columns:
+                timestamps, values = self.concatenate(columns[host],
+                                                      (timestamps, values))
+            columns[host] = (timestamps, values)
+        return columns
+
+    def stream(self, metric, hosts=None, start=None, end=None, step=None,
+               agg='avg', chunk_size=10000, fill=None):
+        """Get the same columns as query() host by host in (host, timestamps,
+        values) chunks of at most chunk_size samples"""
+        if agg != 'avg' and agg not in AGGREGATES:
+            raise ValueError('Unknown aggregation ' + agg)
+        if not self.narrow(metric) and metric not in METRIC_COLUMNS:
+            raise ValueError('Unknown metric ' + metric)
+        if fill and (not step or agg in ('sum', 'count')):
+            raise ValueError('Fill needs a step and a value aggregation')
+        start = 0 if start is None else start
+        end = MAX_TIMESTAMP if end is None else end
+        with self.reader.connect() as connection:
+            for host, series_id in self.series(connection, metric, hosts):
+                rows = self.range_rows(connection, metric, series_id, start,
+                                       end, step, agg, fill)
+                timestamps, values = [], []
+                for timestamp, value in rows:
+                    timestamps.append(timestamp)
+                    values.append(value)
+                    if len(timestamps) >= chunk_size:
+                        yield (host,) + self.columns(timestamps, values)
+                        timestamps, values = [], []
+                if timestamps:
+                    yield (host,) + self.columns(timestamps, values)
+
+    def series(self, connection, metric, hosts=None):
+        """Get (host, series id) pairs of a metric, tables storage uses the
+        host id as series id"""
+        host_table = HostTable.__table__
+        if self.narrow(metric):
+            series_table = SeriesTable.__table__
+            query = select([host_table.c.name, series_table.c.id]).where(
+                and_(series_table.c.host_id == host_table.c.id,
+                     series_table.c.metric == metric))
+        else:
+            query = select([host_table.c.name, host_table.c.id])
+        if hosts is not None:
+            query = query.where(host_table.c.name.in_(hosts))
+        return connection.execute(query.order_by(host_table.c.name)).fetchall()
+
+    def range_rows(self, connection, metric, series_id, start, end, step,
+                   agg, fill=None):
+        """Get the (timestamp, value) rows of a series, read by a range scan
+        of its primary key, with fill empty buckets hold the last value
+        reported up to fill seconds before them"""
+        if not step:
+            return self.raw_rows(connection, metric, series_id, start, end)
+        rows = self.bucket_rows(connection, metric, series_id, start, end,
+                                step)
+        if fill:
+            # Agents do not report unchanged values, the last one before
+            # start still holds
+            previous = None
+            for previous in self.bucket_rows(connection, metric, series_id,
+                                             max(0, start - fill * 1000),
+                                             start, step):
+                pass
+            rows = forward_fill(rows, step * 1000, fill * 1000, start, end,
+                                previous)
+        if agg == 'avg':
+            return ((row[1], (float)(row[4]) / row[5]) for row in rows)
+        return ((row[1], row[AGGREGATES[agg]]) for row in rows)
+
+    def raw_rows(self, connection, metric, series_id, start, end):
+        """Get the (timestamp, value) samples of a series"""
+        if self.narrow(metric):
+            samples = SampleTable.__table__
+            rows = connection.execute(select([samples.c.timestamp,
+                                              samples.c.value]).where(
+                and_(samples.c.series_id == series_id,
+                     samples.c.timestamp >= start,
+                     samples.c.timestamp < end)).order_by(
+                samples.c.timestamp))
+            return ((timestamp, value) for timestamp, value in rows)
+        table, column = METRIC_COLUMNS[metric]
+        table = table.__table__
+        query = select([table.c.timestamp, table.c[column]]).where(
+            and_(table.c.host_id == series_id,
+                 table.c.timestamp >= from_epoch_ms(start)))
+        if end < MAX_TIMESTAMP:
+            query = query.where(
+                table.c.timestamp < from_epoch_ms(end))
+        return ((epoch_ms(timestamp), value) for timestamp, value
+                in connection.execute(query.order_by(table.c.timestamp)))
+
+    def bucket_rows(self, connection, metric, series_id, start, end, step):
+        """Get the (series_id, bucket, min, max, sum, count, last) rows of a
+        series in buckets of step seconds"""
+        if self.narrow(metric):
+            return self.rollup.read(series_id, start, end, step,
+                                    connection=connection)
+        return aggregate(sample_rows((series_id, timestamp, value)
+                                     for timestamp, value
+                                     in self.raw_rows(connection, metric,
+                                                      series_id, start, end)),
+                         step * 1000)
+
+    def columns(self, timestamps, values):
+        """Turn timestamp and value lists into NumPy arrays when available"""
+        if numpy is None:
+            return timestamps, values
+        return (numpy.array(timestamps, dtype=numpy.int64),
+                numpy.array(values, dtype=numpy.float64))
+
+    def concatenate(self, first, second):
+        """Join two (timestamps, values) column chunks"""
+        if numpy is None:
+            return first[0] + second[0], first[1] + second[1]
+        return (numpy.concatenate((first[0], second[0])),
+                numpy.concatenate((first[1], second[1])))
 
     def close_session(self):
         """Close database session"""
+        self.rollup.stop()
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
         self.session.close_all()
+        if self.wal:
+            self.reader.dispose()
+            self.engine.dispose()
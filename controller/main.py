@@ -2,7 +2,11 @@
     Main program entry
 """
 from threading import Thread
+from multiprocessing import Process
 from controller import Controller
+from database import PRAGMAS, create_schema
+from stats import expose, forward
+from async_controller import AsyncController
 from time import sleep
 from ConfigParser import ConfigParser
 
@@ -17,34 +21,161 @@ def main():
     address = config.get('Connection', 'ip')
     port = config.get('Connection', 'port')
     request_period = config.get('Connection', 'request_period')
+    mode = 'pull'
+    if config.has_option('Connection', 'mode'):
+        mode = config.get('Connection', 'mode')
+    io = 'threads'
+    if config.has_option('Connection', 'io'):
+        io = config.get('Connection', 'io')
+    prefetch = 0
+    if config.has_option('Connection', 'prefetch'):
+        prefetch = config.getint('Connection', 'prefetch')
+    cache_size = 60
+    if config.has_option('Cache', 'size'):
+        cache_size = config.getint('Cache', 'size')
     url = config.get('Database', 'dialect')+config.get('Database', 'filename')
-    controller = Controller(user, passw, address, (int)(port), url)
+    database_options = {}
+    if config.has_option('Database', 'batch_size'):
+        database_options['batch_size'] = config.getint('Database',
+                                                       'batch_size')
+    if config.has_option('Database', 'commit_latency'):
+        database_options['commit_latency'] = config.getfloat('Database',
+                                                             'commit_latency')
+    if config.has_option('Database', 'storage'):
+        database_options['storage'] = config.get('Database', 'storage')
+    if config.has_option('Database', 'wal'):
+        database_options['wal'] = config.getboolean('Database', 'wal')
+    if config.has_option('Database', 'read_connections'):
+        database_options['read_connections'] = config.getint(
+            'Database', 'read_connections')
+    if config.has_option('Database', 'checkpoint_interval'):
+        database_options['checkpoint_interval'] = config.getfloat(
+            'Database', 'checkpoint_interval')
+    pragmas = dict((name, config.get('Database', name)) for name in PRAGMAS
+                   if config.has_option('Database', name))
+    if pragmas:
+        database_options['pragmas'] = pragmas
+    if config.has_option('Rollup', 'interval'):
+        database_options['rollup_interval'] = config.getfloat('Rollup',
+                                                              'interval')
+        retention = {}
+        for tier, option in [(0, 'raw_retention'),
+                             (60, 'minute_retention'),
+                             (3600, 'hour_retention'),
+                             (86400, 'day_retention')]:
+            if config.has_option('Rollup', option):
+                retention[tier] = config.getint('Rollup', option) * 86400
+        database_options['retention'] = retention
+    workers = 1
+    if config.has_option('Connection', 'workers'):
+        workers = config.getint('Connection', 'workers')
+    reply_exchange = None
+    if config.has_option('Connection', 'reply_exchange'):
+        reply_exchange = config.get('Connection', 'reply_exchange')
+    stats_port = 0
+    if config.has_option('Stats', 'port'):
+        stats_port = config.getint('Stats', 'port')
 
+    # Agents publish on their own in push mode
+    period = None
+    if mode != 'push':
+        period = (float)(request_period)
+    args = (user, passw, address, (int)(port), url, database_options,
+            prefetch)
+    if workers > 1:
+        supervise(workers, io, args, reply_exchange or 'replies', cache_size,
+                  period, stats_port)
+    else:
+        run_worker(io, args + ('reply', reply_exchange, cache_size), period,
+                   stats_port)
+
+
+def supervise(workers, io, args, reply_exchange, cache_size, period,
+              stats_port=0):
+    """Run one controller process per reply shard, the first one also
+    sends the requests and runs the rollups and checkpoints, every worker
+    serves its stats on the port after the previous one's"""
+    # Workers would race to create the tables
+    create_schema(args[4])
+    processes = []
+    for index in range(workers):
+        database_options = args[5]
+        if index > 0:
+            database_options = dict(database_options, rollup_interval=0,
+                                    checkpoint_interval=0)
+        worker_args = args[:5] + (database_options,) + args[6:] + (
+            'reply.%d' % index, reply_exchange, cache_size)
+        process = Process(target=run_worker,
+                          args=(io, worker_args,
+                                period if index == 0 else None,
+                                stats_port + index if stats_port else 0))
+        process.start()
+        processes.append(process)
+
+    # Workers print their own stats on SIGUSR1
+    forward([process.pid for process in processes])
+    print 'Started %d controller workers' % workers
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # Workers get the interrupt as well and stop on their own
+        for process in processes:
+            process.join()
+    print 'Controller workers stopped'
+
+
+def run_worker(io, args, period, stats_port=0):
+    """Create a controller and run it until KeyboardInterrupt, metrics are
+    requested every period seconds unless period is None, stage timings
+    are printed on SIGUSR1 and served on stats_port when it is above 0"""
+    expose(stats_port)
+    if io == 'async':
+        run_async(AsyncController(*args), period)
+    else:
+        run_threads(Controller(*args), period)
+
+
+def run_threads(controller, period):
+    """Run the controller on a reply and a request thread"""
     print 'Controller started'
     # Start consuming agent messages
     reply_thread = Thread(target=controller.start_consuming)
     reply_thread.start()
 
     # Start request sequence
-    request_thread = Thread(target=controller.start_requesting,
-                            args=(request_period))
-    request_thread.start()
+    request_thread = None
+    if period is not None:
+        request_thread = Thread(target=controller.start_requesting,
+                                args=(period,))
+        request_thread.start()
     try:
         while True:
             # Keep main program here
             sleep(1)
     except KeyboardInterrupt:
         print 'Stopping controller...'
-        # Stop requesting
-        controller.stop_requesting()
+        if request_thread is not None:
+            # Stop requesting
+            controller.stop_requesting()
 
-        # Wait another request period before disconnectig
-        sleep((float)(request_period))
+            # Wait another request period before disconnectig
+            sleep(period)
         controller.stop_consuming()
         controller.disconnect()
-        request_thread.join()
+        if request_thread is not None:
+            request_thread.join()
         reply_thread.join()
         print 'Controller stopped'
 
+
+def run_async(controller, period):
+    """Run the event loop controller"""
+    print 'Controller started'
+    controller.run(period)
+    print 'Stopping controller...'
+    controller.disconnect()
+    print 'Controller stopped'
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,81 @@
+"""
+    Counter to rate conversion module
+"""
+from threading import Lock
+from codec import device_metric, split_metric
+
+# Counter metrics and the rate metrics stored in their place
+COUNTERS = {
+    'network_bytes_sent': 'network_bytes_sent_sec',
+    'network_bytes_received': 'network_bytes_received_sec',
+    'network_bytes_sent_per_nic': 'network_bytes_sent_sec_per_nic',
+    'network_bytes_received_per_nic': 'network_bytes_received_sec_per_nic',
+}
+
+# 32 bit counters wrap at this value, a decrease from its upper half may
+# be a wraparound, psutil counters are 64 bit and never wrap
+WRAP_32 = 2 ** 32
+
+
+class RateConverter(object):
+    """Turns counter samples into per second rates using the previous
+    sample of every (host, metric) series"""
+
+    def __init__(self, counters=None, max_rate=1.25e10, wrap_factor=10):
+        """Rates above max_rate, 100 Gbit/s in bytes by default, are taken
+        as counter resets, a decrease is only a wraparound when the rate it
+        gives is at most wrap_factor times the previous rate of the series"""
+        self.counters = COUNTERS if counters is None else counters
+        self.max_rate = max_rate
+        self.wrap_factor = wrap_factor
+        self.previous = {}
+        self.lock = Lock()
+
+    def convert(self, host, samples):
+        """Replace the counter samples in (timestamp, metric, value) samples
+        by rate samples, the first sample of a series and samples after a
+        counter reset only start a new baseline"""
+        converted = []
+        with self.lock:
+            for timestamp, metric, value in samples:
+                family, device = split_metric(metric)
+                if family not in self.counters:
+                    converted.append((timestamp, metric, value))
+                    continue
+                rate = self.rate((host, metric), timestamp, value)
+                if rate is None:
+                    continue
+                rate_metric = self.counters[family]
+                if device is not None:
+                    rate_metric = device_metric(rate_metric, device)
+                converted.append((timestamp, rate_metric, (int)(round(rate))))
+        return converted
+
+    def rate(self, key, timestamp, value):
+        """Get the per second increase of a counter since its previous
+        sample, None when there is no usable previous sample"""
+        previous = self.previous.get(key)
+        if previous is not None and timestamp <= previous[0]:
+            # Late or repeated sample, keep the newer baseline
+            return None
+
+        # (timestamp, value, rate) of the series, rate is None after a reset
+        self.previous[key] = (timestamp, value, None)
+        if previous is None:
+            return None
+        elapsed = (timestamp - previous[0]) / 1000.0
+        increase = value - previous[1]
+        if increase < 0:
+            # Wraparounds keep the traffic of the series going, anything
+            # else is a reset
+            last_rate = previous[2]
+            increase += WRAP_32
+            if (not WRAP_32 / 2 <= previous[1] < WRAP_32 or
+                    last_rate is None or
+                    increase / elapsed > self.wrap_factor * last_rate):
+                return None
+        rate = increase / elapsed
+        if rate > self.max_rate:
+            return None
+        self.previous[key] = (timestamp, value, rate)
+        return rate
@@ -0,0 +1,158 @@
+"""
+    Stage timing module
+"""
+import json
+import os
+import signal
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from bisect import bisect_left
+from threading import Lock, Thread
+from time import time
+
+# Upper bounds of the histogram buckets in milliseconds, slower stages go
+# to one more overflow bucket
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500,
+           1000, 2500, 5000, 10000)
+
+
+class Histogram(object):
+    """Fixed bucket histogram of stage durations in milliseconds"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        """Count a duration in milliseconds"""
+        self.counts[bisect_left(BUCKETS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the fraction percentile, the
+        slowest duration for the overflow bucket"""
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if index == len(BUCKETS):
+                    return self.max
+                return min(BUCKETS[index], self.max)
+        return 0.0
+
+    def summary(self):
+        """Get count, mean, p50, p99, max and bucket counts"""
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else 0.0,
+                'p50': self.percentile(0.5),
+                'p99': self.percentile(0.99),
+                'max': self.max,
+                'buckets': list(self.counts)}
+
+
+class Stats(object):
+    """Latency histograms of named stages, cheap enough to always record"""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = {}
+        self.since = time()
+
+    def now(self):
+        """Get the start of a stage"""
+        return time()
+
+    def record(self, stage, start):
+        """Count a stage that began at start, a now() value"""
+        duration = (time() - start) * 1000
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.add(duration)
+
+    def snapshot(self):
+        """Get {stage: summary} of every stage"""
+        with self.lock:
+            return dict((stage, histogram.summary())
+                        for stage, histogram in self.histograms.items())
+
+    def reset(self):
+        """Forget every recorded duration"""
+        with self.lock:
+            self.histograms = {}
+            self.since = time()
+
+    def report(self):
+        """Get a text table of every stage"""
+        lines = ['%-32s %9s %9s %9s %9s %9s' % ('stage (ms)', 'count', 'mean',
+                                                 'p50', 'p99', 'max')]
+        for stage, summary in sorted(self.snapshot().items()):
+            lines.append('%-32s %9d %9.3f %9.3f %9.3f %9.3f' % (
+                stage, summary['count'], summary['mean'], summary['p50'],
+                summary['p99'], summary['max']))
+        lines.append('%d seconds recorded' % (time() - self.since))
+        return '\n'.join(lines)
+
+
+# Stages of this process
+STATS = Stats()
+
+
+class StatsHandler(BaseHTTPRequestHandler):
+    """Serves the report as text, or as JSON at /json"""
+
+    def do_GET(self):
+        if self.path == '/json':
+            body = json.dumps({'buckets': BUCKETS,
+                               'stages': STATS.snapshot()})
+            content_type = 'application/json'
+        else:
+            body = STATS.report() + '\n'
+            content_type = 'text/plain'
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    """Serve the stats on a local port from a background thread"""
+    server = HTTPServer(('127.0.0.1', port), StatsHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def dump(signal_number, frame):
+    """Signal handler printing the report"""
+    print STATS.report()
+
+
+def expose(port=0):
+    """Print the report on SIGUSR1 where there is one, and serve it on a
+    local port when port is above 0"""
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, dump)
+    if port > 0:
+        return serve(port)
+
+
+def forward(pids):
+    """Pass SIGUSR1 on to the processes of pids where there is one, a
+    supervisor has no stages of its own to print"""
+    def relay(signal_number, frame):
+        for pid in pids:
+            os.kill(pid, signal_number)
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, relay)
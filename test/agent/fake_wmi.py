@@ -0,0 +1,27 @@
+"""
+    Fake WMI provider for testing Windows metrics on any platform
+"""
+
+
+class FakeWmiObject(object):
+    """WMI class instance with fixed properties"""
+    def __init__(self, properties):
+        self.__dict__.update(properties)
+
+
+class FakeWmi(object):
+    """Stand-in for a wmi.WMI() connection, records every query"""
+    def __init__(self, classes):
+        """classes maps a WMI class name to a list of property dicts"""
+        self.classes = classes
+        self.queries = []
+
+    def __getattr__(self, wmi_class):
+        if wmi_class not in self.classes:
+            raise AttributeError(wmi_class)
+
+        def query(fields=None):
+            self.queries.append(wmi_class)
+            return [FakeWmiObject(properties)
+                    for properties in self.classes[wmi_class]]
+        return query
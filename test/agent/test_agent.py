@@ -1,7 +1,10 @@
 import agent
+import codec
+import deadband
 import mock
 import unittest
-from datetime import datetime
+from pika.exceptions import AMQPConnectionError, ConnectionClosed
+from threading import Event
 
 # Tests for Agent module
 class AgentTest(unittest.TestCase):
@@ -73,21 +76,61 @@ class AgentTest(unittest.TestCase):
                                                            no_ack=True)
         mock_channel.queue_declare.assert_called_with(queue='reply')
 
-    def test_request_metric(self):
+    @mock.patch('agent.PlainCredentials')
+    @mock.patch('agent.ConnectionParameters')
+    @mock.patch('agent.BlockingConnection')
+    @mock.patch('agent.Metric.create')
+    @mock.patch('agent.gethostname')
+    def test_init_reply_exchange(self,
+                                 mock_gethostname,
+                                 mock_metric_create,
+                                 mock_BlockingConnection,
+                                 mock_ConnectionParameters,
+                                 mock_Credentials):
+
+        # Prepare test
+        mock_channel = mock_BlockingConnection.return_value.channel.return_value
+
+        # Test sequence
+        new_agent = agent.Agent(mock.sentinel.user,
+                                mock.sentinel.password,
+                                mock.sentinel.ip,
+                                mock.sentinel.port,
+                                [],
+                                reply_exchange='replies')
+
+        # Check results
+        mock_channel.exchange_declare.assert_called_with(exchange='replies',
+                                                         type='x-consistent-hash')
+        mock_channel.queue_declare.assert_called_once_with(exclusive=True)
+        self.assertEqual(new_agent.reply_exchange, 'replies')
+        self.assertEqual(new_agent.reply_routing_key, mock_gethostname.return_value)
+
+    @mock.patch('agent.Metric')
+    @mock.patch('clock.time')
+    def test_request_metric(self,
+                            mock_time,
+                            mock_Metric):
 
         # Prepare test
         self.agent.processing_request = False
-        timestamp = [datetime.now().year,
-                     datetime.now().month,
-                     datetime.now().day,
-                     datetime.now().hour,
-                     datetime.now().minute,
-                     datetime.now().second,
-                     0]
-        mock_reply = str([timestamp,
-                          self.agent.host,
-                          self.agent.metric_list[0].get_type.return_value,
-                          self.agent.metric_list[0].get_value.return_value])
+        mock_time.return_value = 1442930400.5
+        mock_metric = self.agent.metric_list[0]
+        mock_metric.get_type.return_value = 'cpu_percentage'
+        mock_metric.get_value.return_value = 23
+        mock_memory_metric = mock.MagicMock()
+        mock_memory_metric.get_type.return_value = 'total_memory'
+        mock_memory_metric.get_value.return_value = 1000
+        self.agent.metric_list.append(mock_memory_metric)
+        mock_disk_metric = mock.MagicMock()
+        mock_disk_metric.get_type.return_value = 'disk_reads_sec_per_disk'
+        mock_disk_metric.get_value.return_value = [('sda', 10), ('sdb', 20)]
+        self.agent.metric_list.append(mock_disk_metric)
+        mock_reply = codec.encode(self.agent.host,
+                                  [(1442930400500, 'cpu_percentage', 23),
+                                   (1442930400500, 'total_memory', 1000),
+                                   (1442930400500, 'disk_reads_sec_per_disk',
+                                    [('sda', 10), ('sdb', 20)])])
 
         # Test sequence
         self.agent.request_metric(mock.sentinel.channel,
@@ -99,8 +142,229 @@ class AgentTest(unittest.TestCase):
         # Check results
         self.agent.channel.basic_publish.assert_called_once_with(exchange='',
                                                                  routing_key='reply',
-                                                                 body=mock_reply)
+                                                                 body=mock_reply,
+                                                                 properties=self.agent.reply_properties)
+        self.assertEqual(self.agent.reply_properties.content_type,
+                         codec.CONTENT_TYPE)
+        mock_Metric.new_cycle.assert_called_once_with()
+        self.assertEqual(self.agent.devices.entries['disk_reads_sec_per_disk'][1],
+                         ['sda', 'sdb'])
+        stages = agent.STATS.snapshot()
+        for stage in ['request', 'request.collect', 'request.encode',
+                      'request.publish', 'metric.total_memory']:
+            self.assertIn(stage, stages)
+
+
+    @mock.patch('agent.Metric')
+    def test_publish_metrics_deadband(self,
+                                      mock_Metric):
+
+        # Prepare test
+        mock_metric = self.agent.metric_list[0]
+        mock_metric.get_type.return_value = 'total_memory'
+        mock_metric.get_value.return_value = 1000
+        self.agent.deadband = deadband.Deadband({'total_memory': (0, 0)})
+
+        # Test sequence
+        self.agent.publish_metrics()
+        self.agent.publish_metrics()
+
+        # Check results
+        self.assertEqual(self.agent.channel.basic_publish.call_count, 1)
+        self.assertFalse(self.agent.processing_request)
+
+    @mock.patch('agent.Agent.publish_metrics')
+    def test_request_metric_publish(self,
+                                    mock_publish_metrics):
+
+        # Test sequence
+        self.agent.request_metric(mock.sentinel.channel,
+                                  mock.sentinel.method,
+                                  mock.sentinel.properties,
+                                  mock.sentinel.body)
+
+        # Check results
+        mock_publish_metrics.assert_called_once_with()
+
+    @mock.patch('agent.Agent.publish_metrics')
+    @mock.patch('agent.uniform')
+    @mock.patch('agent.time')
+    def test_start_publishing(self,
+                              mock_time,
+                              mock_uniform,
+                              mock_publish_metrics):
 
+        # Prepare test
+        def stop_publishing(duration):
+            if mock_sleep.call_count == 2:
+                self.agent.publishing = False
+        mock_sleep = self.agent.connection.sleep
+        mock_sleep.side_effect = stop_publishing
+        mock_uniform.side_effect = [3, 1.1]
+        mock_time.side_effect = [100, 101.5]
+
+        # Test sequence
+        self.agent.start_publishing(5, 0.2)
+
+        # Check results
+        mock_uniform.assert_any_call(0, 5)
+        mock_uniform.assert_any_call(0.8, 1.2)
+        mock_publish_metrics.assert_called_once_with()
+        self.assertEqual(mock_sleep.call_args_list, [mock.call(3),
+                                                     mock.call(4.0)])
+
+    def test_stop_publishing(self):
+        # Prepare test
+        self.agent.publishing = True
+
+        # Test sequence
+        self.agent.stop_publishing()
+
+        # Check results
+        self.assertEqual(self.agent.publishing, False)
+
+    @mock.patch('clock.time')
+    def test_collect_metrics(self,
+                             mock_time):
+
+        # Prepare test
+        mock_time.return_value = 1442930400.5
+        mock_metric = self.agent.metric_list[0]
+        mock_metric.get_type.return_value = 'cpu_percentage'
+        mock_metric.get_value.return_value = 23
+
+        # Test sequence
+        samples = self.agent.collect_metrics()
+
+        # Check results
+        self.assertEqual(samples, [(1442930400500, 'cpu_percentage', 23)])
+
+    def test_collect_metrics_parallel(self):
+
+        # Prepare test
+        release = Event()
+        slow_metric = mock.MagicMock()
+        slow_metric.get_type.return_value = 'disk_reads_sec'
+        slow_metric.get_value.side_effect = lambda: release.wait(5) and 0
+        fast_metric = mock.MagicMock()
+        fast_metric.get_type.return_value = 'cpu_percentage'
+        fast_metric.get_value.return_value = 23
+        self.agent.metric_list = [slow_metric, fast_metric]
+        self.agent.pool = agent.ThreadPool(2)
+        self.agent.collect_timeout = 0.1
+
+        # Test sequence
+        try:
+            samples = self.agent.collect_metrics()
+        finally:
+            release.set()
+            self.agent.pool.terminate()
+
+        # Check results
+        self.assertEqual([sample[1:] for sample in samples],
+                         [('disk_reads_sec', None), ('cpu_percentage', 23)])
+        self.assertEqual(samples[0][0], samples[1][0])
+
+    def test_collect_metrics_hung(self):
+
+        # Prepare test
+        release = Event()
+        slow_metric = mock.MagicMock()
+        slow_metric.get_type.return_value = 'disk_reads_sec'
+        slow_metric.get_value.side_effect = lambda: release.wait(5) and 0
+        self.agent.metric_list = [slow_metric]
+        self.agent.pool = agent.ThreadPool(2)
+        self.agent.collect_timeout = 0.1
+
+        # Test sequence
+        try:
+            first = self.agent.collect_metrics()
+            second = self.agent.collect_metrics()
+            release.set()
+            self.agent.running[slow_metric].wait(5)
+            third = self.agent.collect_metrics()
+        finally:
+            release.set()
+            self.agent.pool.terminate()
+
+        # Check results
+        self.assertEqual(first[0][1:], ('disk_reads_sec', None))
+        self.assertEqual(second[0][1:], ('disk_reads_sec', None))
+        self.assertEqual(third[0][1:], ('disk_reads_sec', 0))
+        self.assertEqual(slow_metric.get_value.call_count, 2)
+
+    @mock.patch('agent.ThreadPool')
+    @mock.patch('agent.PlainCredentials')
+    @mock.patch('agent.ConnectionParameters')
+    @mock.patch('agent.BlockingConnection')
+    @mock.patch('agent.Metric')
+    def test_init_pool(self,
+                       mock_Metric,
+                       mock_BlockingConnection,
+                       mock_ConnectionParameters,
+                       mock_Credentials,
+                       mock_ThreadPool):
+
+        # Test sequence
+        new_agent = agent.Agent(mock.sentinel.user,
+                                mock.sentinel.password,
+                                mock.sentinel.ip,
+                                mock.sentinel.port,
+                                [],
+                                4,
+                                mock.sentinel.timeout)
+        new_agent.disconnect()
+
+        # Check results
+        mock_ThreadPool.assert_called_once_with(4, mock_Metric.init_thread)
+        self.assertEqual(new_agent.pool, mock_ThreadPool.return_value)
+        self.assertEqual(new_agent.collect_timeout, mock.sentinel.timeout)
+        mock_ThreadPool.return_value.terminate.assert_called_once_with()
+
+    @mock.patch('agent.Sampler')
+    @mock.patch('agent.PlainCredentials')
+    @mock.patch('agent.ConnectionParameters')
+    @mock.patch('agent.BlockingConnection')
+    @mock.patch('agent.Metric')
+    @mock.patch('clock.time')
+    def test_init_sampler(self,
+                          mock_time,
+                          mock_Metric,
+                          mock_BlockingConnection,
+                          mock_ConnectionParameters,
+                          mock_Credentials,
+                          mock_Sampler):
+
+        # Prepare test
+        mock_time.return_value = 1442930400.5
+        mock_cpu_metric = mock.MagicMock()
+        mock_cpu_metric.get_type.return_value = 'cpu_percentage'
+        mock_core_metric = mock.MagicMock()
+        mock_core_metric.get_type.return_value = 'cpu_percentage_per_core'
+        mock_core_metric.get_value.return_value = [('0', 7)]
+        mock_Metric.create.side_effect = [mock_cpu_metric, mock_core_metric]
+        mock_sampler = mock_Sampler.return_value
+        mock_sampler.summaries.return_value = [
+            (1442930400500, 'cpu_percentage', codec.Summary(10, 90, 40.5, 20, 3))]
+
+        # Test sequence
+        new_agent = agent.Agent(mock.sentinel.user,
+                                mock.sentinel.password,
+                                mock.sentinel.ip,
+                                mock.sentinel.port,
+                                ['cpu_percentage', 'cpu_percentage_per_core'],
+                                sample_interval=0.5)
+        new_agent.publish_metrics()
+        new_agent.disconnect()
+
+        # Check results
+        mock_Sampler.assert_called_once_with([mock_cpu_metric], 0.5)
+        mock_sampler.start.assert_called_once_with()
+        self.assertEqual(new_agent.metric_list, [mock_core_metric])
+        mock_sampler.summaries.assert_called_once_with(1442930400500)
+        body = new_agent.channel.basic_publish.call_args[1]['body']
+        self.assertEqual(body[0], chr(codec.SUMMARIES_VERSION))
+        mock_sampler.stop.assert_called_once_with()
 
     def test_start_consuming(self):
         # Prepare test
@@ -131,3 +395,94 @@ class AgentTest(unittest.TestCase):
 
         # Check results
         mock_connection.close.assert_called_once_with()
+
+    @mock.patch('agent.PlainCredentials')
+    @mock.patch('agent.ConnectionParameters')
+    @mock.patch('agent.BlockingConnection')
+    @mock.patch('agent.Metric')
+    @mock.patch('agent.time')
+    def test_init_unreachable(self,
+                              mock_time,
+                              mock_Metric,
+                              mock_BlockingConnection,
+                              mock_ConnectionParameters,
+                              mock_Credentials):
+
+        # Prepare test
+        mock_time.return_value = 100
+        mock_BlockingConnection.side_effect = AMQPConnectionError()
+        mock_spool = mock.MagicMock()
+
+        # Test sequence
+        new_agent = agent.Agent(mock.sentinel.user,
+                                mock.sentinel.password,
+                                mock.sentinel.ip,
+                                mock.sentinel.port,
+                                [],
+                                spool=mock_spool,
+                                max_backoff=4)
+        retries = [new_agent.ensure_connected() for _ in range(2)]
+        mock_time.return_value = 101
+        retries.append(new_agent.ensure_connected())
+        mock_time.return_value = 103
+        retries.append(new_agent.ensure_connected())
+        mock_time.return_value = 107
+        retries.append(new_agent.ensure_connected())
+        published = new_agent.publish_reply(mock.sentinel.reply)
+
+        # Check results
+        self.assertEqual(retries, [False] * 5)
+        self.assertEqual(mock_BlockingConnection.call_count, 4)
+        self.assertEqual(new_agent.backoff, 4)
+        self.assertEqual(new_agent.next_connect, 111)
+        self.assertFalse(published)
+        mock_spool.append.assert_called_once_with(mock.sentinel.reply)
+
+    def test_publish_failed(self):
+        # Prepare test
+        self.agent.spool = mock.MagicMock()
+        self.agent.channel.basic_publish.side_effect = ConnectionClosed()
+
+        # Test sequence
+        published = self.agent.publish_reply(mock.sentinel.reply)
+
+        # Check results
+        self.assertFalse(published)
+        self.assertEqual(self.agent.connection, None)
+        self.agent.spool.append.assert_called_once_with(mock.sentinel.reply)
+
+    @mock.patch('agent.BlockingConnection')
+    def test_reconnect_drains_spool(self,
+                                    mock_BlockingConnection):
+        # Prepare test
+        mock_channel = mock_BlockingConnection.return_value.channel.return_value
+        self.agent.connection = None
+        self.agent.backoff = 8
+        self.agent.spool = mock.MagicMock()
+        self.agent.spool.empty.return_value = False
+        self.agent.spool.drain.side_effect = lambda send: len([send(body) for body
+                                                               in ['first', 'second']])
+
+        # Test sequence
+        published = self.agent.publish_reply('third')
+
+        # Check results
+        self.assertTrue(published)
+        self.assertEqual(self.agent.backoff, 1)
+        self.assertEqual([call[1]['body'] for call in mock_channel.basic_publish.call_args_list],
+                         ['first', 'second', 'third'])
+        self.assertFalse(self.agent.spool.append.called)
+
+    @mock.patch('agent.BlockingConnection')
+    def test_start_consuming_reconnect(self,
+                                       mock_BlockingConnection):
+        # Prepare test
+        self.agent.channel.start_consuming.side_effect = ConnectionClosed()
+        mock_channel = mock_BlockingConnection.return_value.channel.return_value
+
+        # Test sequence
+        self.agent.start_consuming()
+
+        # Check results
+        mock_BlockingConnection.assert_called_once_with(self.agent.connection_parameters)
+        mock_channel.start_consuming.assert_called_once_with()
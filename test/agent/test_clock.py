@@ -0,0 +1,22 @@
+import clock
+import mock
+import unittest
+
+# Tests for Clock module
+class ClockTest(unittest.TestCase):
+
+    @mock.patch('clock.time')
+    def test_now_ms(self,
+                    mock_time):
+
+        # Prepare test
+        mock_time.side_effect = [1442930400.5, 1442930400.5, 1442930399.0,
+                                 1442930401.25]
+        sample_clock = clock.Clock()
+
+        # Test sequence
+        timestamps = [sample_clock.now_ms() for _ in range(4)]
+
+        # Check results
+        self.assertEqual(timestamps, [1442930400500, 1442930400501,
+                                      1442930400502, 1442930401250])
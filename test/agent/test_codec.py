@@ -0,0 +1,113 @@
+import codec
+import unittest
+
+# Tests for Codec module
+class CodecTest(unittest.TestCase):
+
+    def test_encode(self):
+
+        # Prepare test
+        samples = [(1442930400500, 'cpu_percentage', 23),
+                   (1442930400501, 'network_bytes_sent', 2 ** 40)]
+        expected_reply = ('\x01\x04\x00\x02' + 'host' +
+                          '\x03\x00' + '\x00\x00\x01\x4f\xf5\x5a\x9c\xf4' +
+                          '\x00\x00\x00\x00\x00\x00\x00\x17' +
+                          '\x04\x00' + '\x00\x00\x01\x4f\xf5\x5a\x9c\xf5' +
+                          '\x00\x00\x01\x00\x00\x00\x00\x00')
+
+        # Test sequence
+        reply = codec.encode('host', samples)
+
+        # Check results
+        self.assertEqual(reply, expected_reply)
+
+    def test_encode_unknown_metric(self):
+
+        # Test sequence
+        self.assertRaises(KeyError, codec.encode, 'host', [(0, 'foo', 0)])
+
+    def test_encode_missing(self):
+
+        # Prepare test
+        expected_reply = ('\x01\x04\x00\x01' + 'host' +
+                          '\x06\x01' + '\x00\x00\x00\x00\x00\x00\x00\x05' +
+                          '\x00\x00\x00\x00\x00\x00\x00\x00')
+
+        # Test sequence
+        reply = codec.encode('host', [(5, 'disk_reads_sec', None)])
+
+        # Check results
+        self.assertEqual(reply, expected_reply)
+
+    def test_encode_devices(self):
+
+        # Prepare test
+        samples = [(5, 'cpu_percentage', 23),
+                   (5, 'network_bytes_sent_per_nic', [('eth0', 256), ('lo', 2)])]
+        header = ('\x02\x04\x00\x01' + 'host' +
+                  '\x03\x00' + '\x00\x00\x00\x00\x00\x00\x00\x05' +
+                  '\x00\x00\x00\x00\x00\x00\x00\x17' +
+                  '\x00\x01')
+        values = ('\x00\x00\x00\x00\x00\x00\x01\x00' +
+                  '\x00\x00\x00\x00\x00\x00\x00\x02')
+        dictionary = codec.DeviceDictionary(refresh=2)
+
+        # Test sequence
+        first = codec.encode('host', samples, dictionary)
+        second = codec.encode('host', samples, dictionary)
+        third = codec.encode('host', samples, dictionary)
+
+        # Check results
+        self.assertEqual(first, header +
+                         '\x02\x02' + '\x00\x00\x00\x00\x00\x00\x00\x05' + '\x00\x01\x00\x02' +
+                         '\x04eth0' + '\x02lo' + values)
+        self.assertEqual(second, header +
+                         '\x02\x00' + '\x00\x00\x00\x00\x00\x00\x00\x05' + '\x00\x01\x00\x02' +
+                         values)
+        self.assertEqual(third, first)
+
+    def test_device_dictionary_change(self):
+
+        # Prepare test
+        dictionary = codec.DeviceDictionary(refresh=60)
+
+        # Test sequence
+        first = dictionary.pack('cpu_percentage_per_core', [('0', 10), ('1', 20)])
+        same = dictionary.pack('cpu_percentage_per_core', [('0', 15), ('1', 25)])
+        changed = dictionary.pack('cpu_percentage_per_core', [('0', 15)])
+
+        # Check results
+        self.assertEqual(first, (1, ['0', '1'], [10, 20]))
+        self.assertEqual(same, (1, None, [15, 25]))
+        self.assertEqual(changed, (2, ['0'], [15]))
+
+    def test_encode_devices_missing(self):
+
+        # Prepare test
+        expected_reply = ('\x02\x04\x00\x00' + 'host' + '\x00\x01' +
+                          '\x01\x01' + '\x00\x00\x00\x00\x00\x00\x00\x05' + '\x00\x00\x00\x00')
+
+        # Test sequence
+        reply = codec.encode('host', [(5, 'cpu_percentage_per_core', None)])
+
+        # Check results
+        self.assertEqual(reply, expected_reply)
+
+    def test_encode_summary(self):
+
+        # Prepare test
+        samples = [(5, 'cpu_percentage', codec.Summary(10, 90, 40.5, 20, 3))]
+        expected_reply = ('\x03\x04\x00\x01' + 'host' +
+                          '\x03\x04' + '\x00\x00\x00\x00\x00\x00\x00\x05' +
+                          '\x00\x00\x00\x00\x00\x00\x00\x14' +
+                          '\x00\x00\x00\x00\x00\x00\x00\x0a' +
+                          '\x00\x00\x00\x00\x00\x00\x00\x5a' +
+                          '\x40\x44\x40\x00\x00\x00\x00\x00' +
+                          '\x00\x00\x00\x03' +
+                          '\x00\x00')
+
+        # Test sequence
+        reply = codec.encode('host', samples)
+
+        # Check results
+        self.assertEqual(reply, expected_reply)
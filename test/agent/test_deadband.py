@@ -0,0 +1,75 @@
+import deadband
+import unittest
+from codec import Summary
+
+# Tests for Deadband module
+class DeadbandTest(unittest.TestCase):
+
+    def setUp(self):
+        super(DeadbandTest, self).setUp()
+        self.deadband = deadband.Deadband({'total_memory': (0, 0),
+                                           'available_memory': (0, 0.1),
+                                           'cpu_percentage': (2, 0),
+                                           'cpu_percentage_per_core': (2, 0)},
+                                          heartbeat=60)
+
+    def test_parse_band(self):
+        # Check results
+        self.assertEqual(deadband.parse_band('5'), (5, 0))
+        self.assertEqual(deadband.parse_band(' 2.5% '), (0, 0.025))
+        self.assertRaises(ValueError, deadband.parse_band, 'foo')
+
+    def test_filter(self):
+        # Test sequence
+        first = self.deadband.filter([(1000, 'total_memory', 1000),
+                                      (1000, 'available_memory', 500),
+                                      (1000, 'cpu_percentage', 10),
+                                      (1000, 'disk_reads_sec', 0)])
+        second = self.deadband.filter([(2000, 'total_memory', 1000),
+                                       (2000, 'available_memory', 540),
+                                       (2000, 'cpu_percentage', 13),
+                                       (2000, 'disk_reads_sec', 0)])
+        third = self.deadband.filter([(3000, 'total_memory', 1000),
+                                      (3000, 'available_memory', 560),
+                                      (3000, 'cpu_percentage', 14),
+                                      (3000, 'disk_reads_sec', 0)])
+
+        # Check results
+        self.assertEqual(len(first), 4)
+        self.assertEqual(second, [(2000, 'cpu_percentage', 13),
+                                  (2000, 'disk_reads_sec', 0)])
+        self.assertEqual(third, [(3000, 'available_memory', 560),
+                                 (3000, 'disk_reads_sec', 0)])
+
+    def test_heartbeat(self):
+        # Test sequence
+        self.deadband.filter([(1000, 'total_memory', 1000)])
+        silent = self.deadband.filter([(60999, 'total_memory', 1000)])
+        heartbeat = self.deadband.filter([(61000, 'total_memory', 1000)])
+
+        # Check results
+        self.assertEqual(silent, [])
+        self.assertEqual(heartbeat, [(61000, 'total_memory', 1000)])
+
+    def test_missing(self):
+        # Test sequence
+        self.deadband.filter([(1000, 'total_memory', 1000)])
+        missing = self.deadband.filter([(2000, 'total_memory', None)])
+        after = self.deadband.filter([(3000, 'total_memory', 1000)])
+
+        # Check results
+        self.assertEqual(missing, [(2000, 'total_memory', None)])
+        self.assertEqual(after, [(3000, 'total_memory', 1000)])
+
+    def test_devices_and_summaries(self):
+        # Test sequence
+        self.deadband.filter([(1000, 'cpu_percentage_per_core', [('0', 10), ('1', 20)]),
+                              (1000, 'cpu_percentage', Summary(5, 15, 10.0, 12, 5))])
+        unchanged = self.deadband.filter([(2000, 'cpu_percentage_per_core', [('0', 11), ('1', 19)]),
+                                          (2000, 'cpu_percentage', Summary(6, 16, 11.0, 7, 5))])
+        changed = self.deadband.filter([(3000, 'cpu_percentage_per_core', [('0', 10), ('2', 20)]),
+                                        (3000, 'cpu_percentage', Summary(5, 25, 12.0, 7, 5))])
+
+        # Check results
+        self.assertEqual(unchanged, [])
+        self.assertEqual(len(changed), 2)
@@ -5,6 +5,10 @@ import unittest
 
 class LinuxMetricTest(unittest.TestCase):
 
+    def setUp(self):
+        super(LinuxMetricTest, self).setUp()
+        linux_metric.LinuxMetric.new_cycle()
+
     @mock.patch('linux_metric.psutil')
     @mock.patch('metric.sys')
     def test_available_memory(self,
@@ -175,3 +179,163 @@ class LinuxMetricTest(unittest.TestCase):
         # Check results
         self.assertEqual(metric_type, metric_label)
         self.assertEqual(metric_value, write_bytes_sec)
+
+    @mock.patch('linux_metric.psutil')
+    @mock.patch('metric.sys')
+    def test_shared_snapshot(self,
+                             mock_sys,
+                             mock_psutil):
+
+        # Prepare test
+        mock_sys.platform = 'linux2'
+        mock_psutil.virtual_memory.return_value.available = 1024000
+        mock_psutil.virtual_memory.return_value.total = 2048000
+        mock_psutil.net_io_counters.return_value.bytes_sent = 1000
+        mock_psutil.net_io_counters.return_value.bytes_recv = 2000
+        labels = ['available_memory', 'total_memory',
+                  'network_bytes_sent', 'network_bytes_received']
+        metric_objects = [metric.Metric.create(label) for label in labels]
+
+        # Test sequence
+        metric_values = [metric_object.get_value()
+                         for metric_object in metric_objects]
+
+        # Check results
+        self.assertEqual(metric_values, [1000, 2000, 1000, 2000])
+        mock_psutil.virtual_memory.assert_called_once_with()
+        mock_psutil.net_io_counters.assert_called_once_with()
+
+    @mock.patch('linux_metric.psutil')
+    @mock.patch('metric.sys')
+    @mock.patch('linux_metric.time')
+    def test_shared_snapshot_disk(self,
+                                  mock_time,
+                                  mock_sys,
+                                  mock_psutil):
+
+        # Prepare test
+        mock_sys.platform = 'linux2'
+        mock_time.return_value = 1
+        mock_psutil.disk_io_counters.return_value.read_bytes = 1000
+        mock_psutil.disk_io_counters.return_value.write_bytes = 2000
+        reads_object = metric.Metric.create('disk_reads_sec')
+        writes_object = metric.Metric.create('disk_writes_sec')
+        mock_psutil.disk_io_counters.reset_mock()
+        mock_time.side_effect = [5, 6]
+        mock_psutil.disk_io_counters.return_value.read_bytes = 5000
+        mock_psutil.disk_io_counters.return_value.write_bytes = 10000
+
+        # Test sequence
+        metric.Metric.new_cycle()
+        reads_value = reads_object.get_value()
+        writes_value = writes_object.get_value()
+
+        # Check results
+        self.assertEqual(reads_value, 1000)
+        self.assertEqual(writes_value, 2000)
+        mock_psutil.disk_io_counters.assert_called_once_with()
+
+    @mock.patch('linux_metric.psutil')
+    @mock.patch('metric.sys')
+    def test_per_device(self,
+                        mock_sys,
+                        mock_psutil):
+
+        # Prepare test
+        mock_sys.platform = 'linux2'
+        mock_psutil.cpu_percent.return_value = [10.5, 30.0]
+        eth0 = mock.Mock(bytes_sent=100, bytes_recv=200)
+        lo = mock.Mock(bytes_sent=300, bytes_recv=400)
+        mock_psutil.net_io_counters.return_value = {'lo': lo, 'eth0': eth0}
+        labels = ['cpu_percentage_per_core', 'network_bytes_sent_per_nic',
+                  'network_bytes_received_per_nic']
+        metric_objects = [metric.Metric.create(label) for label in labels]
+
+        # Test sequence
+        metric_values = [metric_object.get_value()
+                         for metric_object in metric_objects]
+
+        # Check results
+        self.assertEqual([metric_object.get_type() for metric_object in metric_objects],
+                         labels)
+        self.assertEqual(metric_values, [[('0', 10), ('1', 30)],
+                                         [('eth0', 100), ('lo', 300)],
+                                         [('eth0', 200), ('lo', 400)]])
+        mock_psutil.cpu_percent.assert_called_once_with(percpu=True)
+        mock_psutil.net_io_counters.assert_called_once_with(pernic=True)
+
+    @mock.patch('linux_metric.psutil')
+    @mock.patch('metric.sys')
+    @mock.patch('linux_metric.time')
+    def test_per_disk(self,
+                      mock_time,
+                      mock_sys,
+                      mock_psutil):
+
+        # Prepare test
+        mock_sys.platform = 'linux2'
+        mock_time.return_value = 1
+        mock_psutil.disk_io_counters.return_value = {
+            'sda': mock.Mock(read_bytes=1000, write_bytes=2000)}
+        reads_object = metric.Metric.create('disk_reads_sec_per_disk')
+        writes_object = metric.Metric.create('disk_writes_sec_per_disk')
+        mock_psutil.disk_io_counters.reset_mock()
+        mock_time.return_value = 5
+        mock_psutil.disk_io_counters.return_value = {
+            'sda': mock.Mock(read_bytes=5000, write_bytes=10000),
+            'sdb': mock.Mock(read_bytes=100, write_bytes=100)}
+
+        # Test sequence
+        metric.Metric.new_cycle()
+        reads_value = reads_object.get_value()
+        writes_value = writes_object.get_value()
+
+        # Check results
+        self.assertEqual(reads_value, [('sda', 1000)])
+        self.assertEqual(writes_value, [('sda', 2000)])
+        mock_psutil.disk_io_counters.assert_called_once_with(perdisk=True)
+
+    @mock.patch('linux_metric.psutil')
+    @mock.patch('metric.sys')
+    def test_new_cycle(self,
+                       mock_sys,
+                       mock_psutil):
+
+        # Prepare test
+        mock_sys.platform = 'linux2'
+        metric_object = metric.Metric.create('cpu_percentage')
+        mock_psutil.cpu_percent.side_effect = [10, 20]
+
+        # Test sequence
+        metric.Metric.new_cycle()
+        value1 = metric_object.get_value()
+        value2 = metric_object.get_value()
+        metric.Metric.new_cycle()
+        value3 = metric_object.get_value()
+
+        # Check results
+        self.assertEqual([value1, value2, value3], [10, 10, 20])
+
+    @mock.patch('linux_metric.psutil')
+    @mock.patch('metric.sys')
+    def test_own_cycle(self,
+                       mock_sys,
+                       mock_psutil):
+
+        # Prepare test
+        mock_sys.platform = 'linux2'
+        requested = metric.Metric.create('cpu_percentage')
+        sampled = metric.Metric.create('cpu_percentage')
+        mock_psutil.cpu_percent.side_effect = [10, 20, 30]
+
+        # Test sequence
+        metric.Metric.new_cycle()
+        value1 = requested.get_value()
+        metric.Metric.new_cycle([sampled])
+        value2 = sampled.get_value()
+        value3 = requested.get_value()
+        metric.Metric.new_cycle([sampled])
+        value4 = sampled.get_value()
+
+        # Check results
+        self.assertEqual([value1, value2, value3, value4], [10, 20, 10, 30])
@@ -23,6 +23,8 @@ class MainTest(unittest.TestCase):
         mock_metrics = mock_config.get.return_value.split.return_value
         mock_agent = mock_Agent.return_value
         mock_agent.start_consuming.side_effect = KeyboardInterrupt
+        mock_config.has_option.return_value = False
+        mock_config.has_section.return_value = False
         
         # Test sequence
         main.main()
@@ -34,8 +36,83 @@ class MainTest(unittest.TestCase):
                                            mock_passw,
                                            mock_address,
                                            (int)(mock_port),
-                                           mock_metrics)
+                                           mock_metrics,
+                                           0,
+                                           10,
+                                           None,
+                                           60,
+                                           spool=None,
+                                           max_backoff=60,
+                                           sample_interval=0,
+                                           deadband=None)
         mock_agent.start_consuming.assert_called_once_with()
         mock_agent.stop_consuming.assert_called_once_with()
         mock_agent.disconnect.assert_called_once_with()
-        
+
+    @mock.patch('main.ConfigParser')
+    @mock.patch('main.Agent')
+    @mock.patch('main.sleep')
+    @mock.patch('main.Spool')
+    @mock.patch('main.Deadband')
+    @mock.patch('main.expose')
+    def test_main_collect_options(self,
+                                  mock_expose,
+                                  mock_Deadband,
+                                  mock_Spool,
+                                  mock_sleep,
+                                  mock_Agent,
+                                  mock_ConfigParser):
+
+        # Prepare test
+        mock_config = mock_ConfigParser.return_value
+        mock_config.has_option.return_value = True
+        mock_config.getint.return_value = 4
+        mock_config.getfloat.return_value = 2.5
+        mock_config.has_section.return_value = True
+        mock_config.items.return_value = [('heartbeat', '600'),
+                                          ('total_memory', '0'),
+                                          ('available_memory', '1%')]
+        mock_Agent.return_value.start_consuming.side_effect = KeyboardInterrupt
+
+        # Test sequence
+        main.main()
+
+        # Check results
+        self.assertEqual(mock_Agent.call_args[0][5:], (4, 2.5, mock_config.get.return_value, 4))
+        mock_Spool.assert_called_once_with(mock_config.get.return_value, 4, 4)
+        self.assertEqual(mock_Agent.call_args[1], {'spool': mock_Spool.return_value,
+                                                   'max_backoff': 2.5,
+                                                   'sample_interval': 2.5,
+                                                   'deadband': mock_Deadband.return_value})
+        mock_config.items.assert_called_once_with('Deadband')
+        mock_expose.assert_called_once_with(4)
+        mock_Deadband.assert_called_once_with({'total_memory': (0, 0),
+                                               'available_memory': (0, 0.01)},
+                                              600)
+
+    @mock.patch('main.ConfigParser')
+    @mock.patch('main.Agent')
+    @mock.patch('main.sleep')
+    def test_main_push(self,
+                       mock_sleep,
+                       mock_Agent,
+                       mock_ConfigParser):
+
+        # Prepare test
+        mock_config = mock_ConfigParser.return_value
+        mock_config.has_option.side_effect = lambda section, option: option == 'mode'
+        mock_config.has_section.return_value = False
+        mock_config.get.side_effect = lambda section, option: {'mode': 'push'}.get(option, '1')
+        mock_config.getfloat.side_effect = lambda section, option: {'interval': 5,
+                                                                    'jitter': 0.2}[option]
+        mock_agent = mock_Agent.return_value
+        mock_agent.start_publishing.side_effect = KeyboardInterrupt
+
+        # Test sequence
+        main.main()
+
+        # Check results
+        mock_agent.start_publishing.assert_called_once_with(5, 0.2)
+        self.assertFalse(mock_agent.start_consuming.called)
+        mock_agent.stop_publishing.assert_called_once_with()
+        mock_agent.disconnect.assert_called_once_with()
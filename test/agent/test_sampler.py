@@ -0,0 +1,76 @@
+import mock
+import sampler
+import unittest
+from codec import Summary
+
+# Tests for Sampler module
+class SamplerTest(unittest.TestCase):
+
+    def setUp(self):
+        super(SamplerTest, self).setUp()
+        self.cpu_metric = mock.MagicMock()
+        self.cpu_metric.get_type.return_value = 'cpu_percentage'
+        self.memory_metric = mock.MagicMock()
+        self.memory_metric.get_type.return_value = 'available_memory'
+        self.sampler = sampler.Sampler([self.cpu_metric, self.memory_metric],
+                                       interval=1, capacity=4)
+
+    @mock.patch('sampler.Metric')
+    def test_sample(self,
+                    mock_Metric):
+        # Prepare test
+        self.cpu_metric.get_value.side_effect = [10, 90, 20]
+        self.memory_metric.get_value.side_effect = [1000, IOError(), 3000]
+
+        # Test sequence
+        for _ in range(3):
+            self.sampler.sample()
+        samples = self.sampler.summaries(5)
+
+        # Check results
+        self.assertEqual(mock_Metric.new_cycle.call_count, 3)
+        mock_Metric.new_cycle.assert_called_with([self.cpu_metric, self.memory_metric])
+        self.assertEqual(samples, [(5, 'cpu_percentage', Summary(10, 90, 40, 20, 3)),
+                                   (5, 'available_memory', Summary(1000, 3000, 2000, 3000, 2))])
+
+    def test_summaries_reset(self):
+        # Prepare test
+        self.sampler.record('cpu_percentage', 10)
+
+        # Test sequence
+        first = self.sampler.summaries(5)
+        second = self.sampler.summaries(6)
+
+        # Check results
+        self.assertEqual(first[0], (5, 'cpu_percentage', Summary(10, 10, 10, 10, 1)))
+        self.assertEqual(second, [(6, 'cpu_percentage', None),
+                                  (6, 'available_memory', None)])
+
+    def test_ring_wraparound(self):
+        # Test sequence
+        for value in [1, 2, 3, 4, 5, 6]:
+            self.sampler.record('cpu_percentage', value)
+        samples = self.sampler.summaries(5)
+
+        # Check results
+        self.assertEqual(samples[0], (5, 'cpu_percentage', Summary(3, 6, 4.5, 6, 4)))
+
+    @mock.patch('sampler.Metric')
+    def test_start_stop(self,
+                        mock_Metric):
+        # Prepare test
+        self.cpu_metric.get_value.return_value = 50
+        def last_value():
+            self.sampler.stopped.set()
+            return 1000
+        self.memory_metric.get_value.side_effect = last_value
+
+        # Test sequence
+        self.sampler.start()
+        self.sampler.thread.join()
+        self.sampler.stop()
+
+        # Check results
+        mock_Metric.init_thread.assert_called_once_with()
+        self.assertEqual(self.sampler.summaries(5)[0][2].last, 50)
+        self.assertEqual(self.sampler.thread, None)
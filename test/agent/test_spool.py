@@ -0,0 +1,93 @@
+import os
+import shutil
+import spool
+import tempfile
+import unittest
+
+# Tests for Spool module
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        super(SpoolTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_append_drain(self):
+        # Prepare test
+        reply_spool = spool.Spool(self.directory, segment_size=64)
+        bodies = ['reply %d' % index for index in range(10)]
+        sent = []
+
+        # Test sequence
+        for body in bodies:
+            reply_spool.append(body)
+        segments = len(os.listdir(self.directory))
+        count = reply_spool.drain(sent.append)
+
+        # Check results
+        self.assertEqual(segments, 2)
+        self.assertEqual(count, 10)
+        self.assertEqual(sent, bodies)
+        self.assertTrue(reply_spool.empty())
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_reopen(self):
+        # Prepare test
+        reply_spool = spool.Spool(self.directory, segment_size=64)
+        reply_spool.append('first')
+        reply_spool.close()
+        sent = []
+
+        # Test sequence
+        reopened = spool.Spool(self.directory, segment_size=64)
+        reopened.append('second')
+        reopened.drain(sent.append)
+
+        # Check results
+        self.assertEqual(sent, ['first', 'second'])
+
+    def test_evict_oldest(self):
+        # Prepare test
+        reply_spool = spool.Spool(self.directory, segment_size=16, max_size=32)
+        sent = []
+
+        # Test sequence
+        for index in range(4):
+            reply_spool.append('reply %d' % index)
+        reply_spool.drain(sent.append)
+
+        # Check results
+        self.assertEqual(sent, ['reply 2', 'reply 3'])
+
+    def test_large_reply(self):
+        # Prepare test
+        reply_spool = spool.Spool(self.directory, segment_size=16)
+        sent = []
+
+        # Test sequence
+        reply_spool.append('x' * 100)
+        reply_spool.drain(sent.append)
+
+        # Check results
+        self.assertEqual(sent, ['x' * 100])
+
+    def test_failed_drain(self):
+        # Prepare test
+        reply_spool = spool.Spool(self.directory, segment_size=64)
+        reply_spool.append('first')
+        reply_spool.append('second')
+        sent = []
+
+        def send(body):
+            if not sent:
+                sent.append(body)
+                raise IOError()
+            sent.append(body)
+
+        # Test sequence
+        self.assertRaises(IOError, reply_spool.drain, send)
+        reply_spool.drain(send)
+
+        # Check results
+        self.assertEqual(sent, ['first', 'first', 'second'])
+        self.assertTrue(reply_spool.empty())
@@ -0,0 +1,36 @@
+import mock
+import stats
+import unittest
+
+# Tests for Stats module
+class StatsTest(unittest.TestCase):
+
+    @mock.patch('stats.time')
+    def test_record(self,
+                    mock_time):
+        # Prepare test
+        mock_time.side_effect = [0, 10.0, 10.0003, 10.0, 10.03]
+        agent_stats = stats.Stats()
+
+        # Test sequence
+        agent_stats.record('metric.cpu_percentage', agent_stats.now())
+        agent_stats.record('metric.cpu_percentage', agent_stats.now())
+        summary = agent_stats.snapshot()['metric.cpu_percentage']
+
+        # Check results
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['p50'], 0.5)
+        self.assertAlmostEqual(summary['max'], 30)
+        self.assertEqual(sum(summary['buckets']), 2)
+
+    @mock.patch('stats.serve')
+    @mock.patch('stats.signal')
+    def test_expose(self,
+                    mock_signal,
+                    mock_serve):
+        # Test sequence
+        stats.expose(0)
+
+        # Check results
+        mock_signal.signal.assert_called_once_with(mock_signal.SIGUSR1, stats.dump)
+        self.assertFalse(mock_serve.called)
@@ -2,9 +2,18 @@ import metric
 import windows_metric
 import mock
 import unittest
+from fake_wmi import FakeWmi
 
 class WindowsMetricTest(unittest.TestCase):
 
+    def setUp(self):
+        super(WindowsMetricTest, self).setUp()
+        windows_metric.WindowsMetric.set_provider(None)
+
+    def tearDown(self):
+        windows_metric.WindowsMetric.set_provider(None)
+        super(WindowsMetricTest, self).tearDown()
+
     @mock.patch('windows_metric.wmi')
     @mock.patch('metric.sys')
     def test_available_memory(self,
@@ -182,3 +191,151 @@ class WindowsMetricTest(unittest.TestCase):
         # Check results
         self.assertEqual(metric_type, metric_label)
         self.assertEqual(metric_value, disk_writes_sec)
+
+    @mock.patch('metric.sys')
+    def test_shared_queries(self,
+                            mock_sys):
+
+        # Prepare test
+        mock_sys.platform = 'win32'
+        provider = FakeWmi({
+            'Win32_Processor': [{'LoadPercentage': 10},
+                                {'LoadPercentage': 30}],
+            'Win32_PerfRawData_Tcpip_NetworkInterface': [
+                {'BytesSentPerSec': 100, 'BytesReceivedPerSec': 200},
+                {'BytesSentPerSec': 300, 'BytesReceivedPerSec': 400}],
+            'Win32_PerfFormattedData_PerfDisk_LogicalDisk': [
+                {'DiskReadBytesPerSec': 500, 'DiskWriteBytesPerSec': 600}]})
+        windows_metric.WindowsMetric.set_provider(provider)
+        labels = ['cpu_percentage', 'network_bytes_sent',
+                  'network_bytes_received', 'disk_reads_sec',
+                  'disk_writes_sec']
+        metric_objects = [metric.Metric.create(label) for label in labels]
+
+        # Test sequence
+        metric.Metric.new_cycle()
+        metric_values = [metric_object.get_value()
+                         for metric_object in metric_objects]
+
+        # Check results
+        self.assertEqual(metric_values, [20, 400, 600, 500, 600])
+        self.assertEqual(sorted(provider.queries),
+                         ['Win32_PerfFormattedData_PerfDisk_LogicalDisk',
+                          'Win32_PerfRawData_Tcpip_NetworkInterface',
+                          'Win32_Processor'])
+
+    def test_plain_records(self):
+
+        # Prepare test
+        provider = FakeWmi({
+            'Win32_Processor': [{'LoadPercentage': 10, 'Caption': 'x'}]})
+        windows_metric.WindowsMetric.set_provider(provider)
+
+        # Test sequence
+        records = windows_metric.WindowsMetric.session.query('Win32_Processor')
+
+        # Check results
+        self.assertIsInstance(records[0], windows_metric.WmiRecord)
+        self.assertEqual(vars(records[0]), {'LoadPercentage': 10})
+
+    @mock.patch('metric.sys')
+    def test_per_device(self,
+                        mock_sys):
+
+        # Prepare test
+        mock_sys.platform = 'win32'
+        provider = FakeWmi({
+            'Win32_PerfFormattedData_PerfOS_Processor': [
+                {'Name': '0', 'PercentProcessorTime': 10},
+                {'Name': '1', 'PercentProcessorTime': 30},
+                {'Name': '_Total', 'PercentProcessorTime': 20}],
+            'Win32_PerfRawData_Tcpip_NetworkInterface': [
+                {'Name': 'eth0', 'BytesSentPerSec': 100, 'BytesReceivedPerSec': 200},
+                {'Name': 'eth1', 'BytesSentPerSec': 300, 'BytesReceivedPerSec': 400}],
+            'Win32_PerfFormattedData_PerfDisk_PhysicalDisk': [
+                {'Name': '0 C:', 'DiskReadBytesPerSec': 500, 'DiskWriteBytesPerSec': 600},
+                {'Name': '_Total', 'DiskReadBytesPerSec': 500, 'DiskWriteBytesPerSec': 600}]})
+        windows_metric.WindowsMetric.set_provider(provider)
+        labels = ['cpu_percentage_per_core', 'network_bytes_sent_per_nic',
+                  'network_bytes_received_per_nic', 'disk_reads_sec_per_disk',
+                  'disk_writes_sec_per_disk']
+        metric_objects = [metric.Metric.create(label) for label in labels]
+
+        # Test sequence
+        metric.Metric.new_cycle()
+        metric_values = [metric_object.get_value()
+                         for metric_object in metric_objects]
+
+        # Check results
+        self.assertEqual([metric_object.get_type() for metric_object in metric_objects],
+                         labels)
+        self.assertEqual(metric_values, [[('0', 10), ('1', 30)],
+                                         [('eth0', 100), ('eth1', 300)],
+                                         [('eth0', 200), ('eth1', 400)],
+                                         [('0 C:', 500)],
+                                         [('0 C:', 600)]])
+        self.assertEqual(len(provider.queries), 3)
+
+    @mock.patch('metric.sys')
+    def test_new_cycle(self,
+                       mock_sys):
+
+        # Prepare test
+        mock_sys.platform = 'win32'
+        provider = FakeWmi({
+            'Win32_OperatingSystem': [{'TotalVirtualMemorySize': 1000}]})
+        windows_metric.WindowsMetric.set_provider(provider)
+        metric_object = metric.Metric.create('total_memory')
+
+        # Test sequence
+        metric.Metric.new_cycle()
+        metric_object.get_value()
+        metric_object.get_value()
+        metric.Metric.new_cycle()
+        metric_object.get_value()
+
+        # Check results
+        self.assertEqual(provider.queries, ['Win32_OperatingSystem',
+                                            'Win32_OperatingSystem'])
+
+    @mock.patch('metric.sys')
+    def test_own_cycle(self,
+                       mock_sys):
+
+        # Prepare test
+        mock_sys.platform = 'win32'
+        provider = FakeWmi({
+            'Win32_OperatingSystem': [{'TotalVirtualMemorySize': 1000}]})
+        windows_metric.WindowsMetric.set_provider(provider)
+        requested = metric.Metric.create('total_memory')
+        sampled = metric.Metric.create('total_memory')
+
+        # Test sequence
+        metric.Metric.new_cycle()
+        requested.get_value()
+        metric.Metric.new_cycle([sampled])
+        sampled.get_value()
+        own_session = sampled.session
+        requested.get_value()
+        metric.Metric.new_cycle([sampled])
+        sampled.get_value()
+
+        # Check results
+        self.assertEqual(len(provider.queries), 3)
+        self.assertIs(sampled.session, own_session)
+        self.assertIs(requested.session, windows_metric.WindowsMetric.session)
+
+    @mock.patch('windows_metric.wmi')
+    def test_single_connection(self,
+                               mock_wmi):
+
+        # Prepare test
+        wmi = mock_wmi.WMI.return_value
+        wmi.Win32_OperatingSystem.return_value = []
+
+        # Test sequence
+        windows_metric.WinAvailableMemory().get_value()
+        windows_metric.WinTotalMemory().get_value()
+
+        # Check results
+        mock_wmi.WMI.assert_called_once_with()
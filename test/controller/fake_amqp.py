@@ -0,0 +1,211 @@
+"""
+    In-process stand-in for a RabbitMQ server and pika's SelectConnection,
+    bench/fleet.py wraps the same routing for BlockingConnection
+"""
+from collections import deque
+from pika import BasicProperties
+from zlib import crc32
+
+
+class Router(object):
+    """Exchanges, bindings and queues of a single virtual host: the default,
+    fanout, direct and consistent hash exchanges"""
+
+    def __init__(self):
+        self.exchanges = {}
+        self.bindings = {}
+        self.queues = {}
+        self.names = 0
+
+    def declare_exchange(self, exchange, exchange_type='direct'):
+        """Create an exchange"""
+        self.exchanges[exchange] = exchange_type
+
+    def declare_queue(self, queue=''):
+        """Create a queue, an empty name gets a generated one"""
+        if not queue:
+            self.names += 1
+            queue = 'amq.gen-%d' % self.names
+        self.queues.setdefault(queue, deque())
+        return queue
+
+    def bind(self, exchange, queue, routing_key=None):
+        """Bind a queue to an exchange"""
+        self.bindings.setdefault(exchange, []).append((queue, routing_key))
+
+    def route(self, exchange, routing_key):
+        """Get the declared queues a message goes to"""
+        kind = self.exchanges.get(exchange, 'direct')
+        bound = self.bindings.get(exchange, [])
+        if exchange == '':
+            queues = [routing_key]
+        elif kind == 'fanout':
+            queues = [queue for queue, _ in bound]
+        elif kind == 'x-consistent-hash':
+            # Stand-in for the hash ring, every binding has the same weight
+            ring = sorted(queue for queue, _ in bound)
+            queues = [ring[crc32(routing_key) % len(ring)]] if ring else []
+        else:
+            queues = [queue for queue, key in bound if key == routing_key]
+        return [queue for queue in queues if queue in self.queues]
+
+
+class FakeBroker(Router):
+    """Exchanges, queues and consumers of a single virtual host, time only
+    advances when the IO loop is idle, KeyboardInterrupt is raised once the
+    clock reaches interrupt_at"""
+
+    def __init__(self, interrupt_at=None):
+        super(FakeBroker, self).__init__()
+        self.consumers = []
+        self.published = []
+        self.listeners = {}
+        self.interrupt_at = interrupt_at
+        self.connections = []
+
+    def connect(self, parameters, on_open_callback=None, **kwargs):
+        """Replacement for SelectConnection"""
+        connection = FakeConnection(self, on_open_callback)
+        self.connections.append(connection)
+        return connection
+
+    def listen(self, exchange, listener):
+        """Call listener(broker, body) for every message sent to exchange"""
+        self.listeners.setdefault(exchange, []).append(listener)
+
+    def publish(self, exchange, routing_key, body, properties=None):
+        """Route a message"""
+        self.published.append((exchange, routing_key, body))
+        for queue in self.route(exchange, routing_key):
+            self.queues[queue].append((properties, body))
+        for listener in self.listeners.get(exchange, []):
+            listener(self, body)
+
+    def reply(self, body, content_type=None, exchange='', routing_key='reply'):
+        """Queue a reply the way an agent does"""
+        self.publish(exchange, routing_key, body,
+                     BasicProperties(content_type=content_type))
+
+    def deliver(self):
+        """Deliver one queued message to its consumer, False when idle"""
+        for tag, queue, callback, channel in self.consumers:
+            if self.queues.get(queue):
+                properties, body = self.queues[queue].popleft()
+                callback(channel, tag, properties, body)
+                return True
+        return False
+
+
+class FakeIOLoop(object):
+    """IO loop running ready callbacks, deliveries and virtual time timers"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.now = 0
+        self.ready = []
+        self.timers = []
+        self.running = False
+        self.interrupted = False
+
+    def call_soon(self, callback, *args):
+        self.ready.append((callback, args))
+
+    def start(self):
+        self.running = True
+        while self.running:
+            if self.ready:
+                callback, args = self.ready.pop(0)
+                callback(*args)
+            elif self.broker.deliver():
+                pass
+            elif self.timers:
+                deadline, handle, callback = min(self.timers)
+                interrupt_at = self.broker.interrupt_at
+                if (interrupt_at is not None and not self.interrupted and
+                        deadline >= interrupt_at):
+                    self.now = interrupt_at
+                    self.interrupted = True
+                    raise KeyboardInterrupt
+                self.timers.remove((deadline, handle, callback))
+                self.now = deadline
+                callback()
+            else:
+                # Nothing left to do
+                self.running = False
+
+    def stop(self):
+        self.running = False
+
+
+class FakeConnection(object):
+    """SelectConnection stand-in"""
+
+    def __init__(self, broker, on_open_callback):
+        self.broker = broker
+        self.ioloop = FakeIOLoop(broker)
+        self.closed = False
+        self.handles = 0
+        if on_open_callback is not None:
+            self.ioloop.call_soon(on_open_callback, self)
+
+    def channel(self, on_open_callback):
+        channel = FakeChannel(self)
+        self.ioloop.call_soon(on_open_callback, channel)
+        return channel
+
+    def add_timeout(self, deadline, callback):
+        self.handles += 1
+        self.ioloop.timers.append((self.ioloop.now + deadline, self.handles,
+                                   callback))
+        return self.handles
+
+    def remove_timeout(self, handle):
+        self.ioloop.timers = [timer for timer in self.ioloop.timers
+                              if timer[1] != handle]
+
+    def close(self):
+        self.closed = True
+        self.broker.consumers = []
+        self.ioloop.timers = []
+        self.ioloop.call_soon(self.ioloop.stop)
+
+
+class FakeChannel(object):
+    """Channel stand-in with the callback style of pika's async adapters"""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.tags = 0
+
+    def exchange_declare(self, callback=None, exchange=None,
+                         exchange_type='direct'):
+        self.broker.declare_exchange(exchange, exchange_type)
+        if callback is not None:
+            self.connection.ioloop.call_soon(callback, None)
+
+    def queue_declare(self, callback, queue=''):
+        self.broker.declare_queue(queue)
+        if callback is not None:
+            self.connection.ioloop.call_soon(callback, None)
+
+    def queue_bind(self, callback, queue, exchange, routing_key=None):
+        self.broker.bind(exchange, queue, routing_key)
+        if callback is not None:
+            self.connection.ioloop.call_soon(callback, None)
+
+    def basic_consume(self, consumer_callback, queue='', no_ack=False):
+        self.tags += 1
+        tag = 'ctag%d' % self.tags
+        self.broker.consumers.append((tag, queue, consumer_callback, self))
+        return tag
+
+    def basic_cancel(self, callback=None, consumer_tag=''):
+        self.broker.consumers = [consumer
+                                 for consumer in self.broker.consumers
+                                 if consumer[0] != consumer_tag]
+        if callback is not None:
+            self.connection.ioloop.call_soon(callback, None)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.broker.publish(exchange, routing_key, body, properties)
@@ -0,0 +1,123 @@
+import aggregation
+import cache
+import numpy
+import unittest
+
+# Tests for Aggregation module
+class AggregationTest(unittest.TestCase):
+
+    def setUp(self):
+        super(AggregationTest, self).setUp()
+        # Two minutes of host1 and host2 samples, host3 only reports once
+        self.columns = {'host1': ([0, 30000, 60000, 90000], [10, 20, 30, 40]),
+                        'host2': ([0, 30000, 60000, 90000], [50, 50, 70, 90]),
+                        'host3': ([70000], [100])}
+
+    def test_align(self):
+        # Test sequence
+        hosts, buckets, matrix = aggregation.align(self.columns, 60)
+
+        # Check results
+        self.assertEqual(hosts, ['host1', 'host2', 'host3'])
+        self.assertEqual(list(buckets), [0, 60000])
+        numpy.testing.assert_equal(matrix, [[15, 35],
+                                            [50, 80],
+                                            [numpy.nan, 100]])
+
+    def test_align_range(self):
+        # Test sequence
+        hosts, buckets, matrix = aggregation.align(self.columns, 30,
+                                                   start=30000, end=90000)
+
+        # Check results
+        self.assertEqual(list(buckets), [30000, 60000])
+        numpy.testing.assert_equal(matrix[0], [20, 30])
+
+    def test_rates(self):
+        # Prepare test
+        indexes = numpy.array([0, 0, 0, 1, 1])
+        timestamps = numpy.array([0, 1000, 3000, 0, 2000])
+        values = numpy.array([100., 200., 50., 10., 30.])
+
+        # Test sequence
+        rate_indexes, rate_timestamps, rate_values = aggregation.rates(indexes,
+                                                                       timestamps,
+                                                                       values)
+
+        # Check results
+        self.assertEqual(list(rate_indexes), [0, 1])
+        self.assertEqual(list(rate_timestamps), [1000, 2000])
+        self.assertEqual(list(rate_values), [100, 10])
+
+    def test_statistic(self):
+        # Prepare test
+        matrix = numpy.array([[1., 10., numpy.nan],
+                              [3., numpy.nan, numpy.nan],
+                              [5., 30., numpy.nan]])
+
+        # Check results
+        numpy.testing.assert_equal(aggregation.statistic(matrix, 'mean'), [3, 20, numpy.nan])
+        numpy.testing.assert_equal(aggregation.statistic(matrix, 'min'), [1, 10, numpy.nan])
+        numpy.testing.assert_equal(aggregation.statistic(matrix, 'max'), [5, 30, numpy.nan])
+        numpy.testing.assert_equal(aggregation.statistic(matrix, 'count'), [3, 2, 0])
+        numpy.testing.assert_equal(aggregation.statistic(matrix, 'p50'), [3, 20, numpy.nan])
+        self.assertRaises(ValueError, aggregation.statistic, matrix, 'median')
+
+    def test_group(self):
+        # Prepare test
+        tags = {'host1': 'web', 'host2': ['web', 'db']}
+
+        # Test sequence
+        groups = aggregation.group(['host1', 'host2', 'host3'], tags)
+
+        # Check results
+        self.assertEqual(groups, {'web': [0, 1], 'db': [1], None: [2]})
+        self.assertEqual(aggregation.group(['host1', 'host2']), {None: [0, 1]})
+
+    def test_fleet_statistics(self):
+        # Test sequence
+        buckets, result = aggregation.fleet_statistics(self.columns, 60,
+                                                       ('mean', 'p100', 'count'),
+                                                       tags={'host1': 'a',
+                                                             'host2': 'a',
+                                                             'host3': 'b'})
+
+        # Check results
+        self.assertEqual(list(buckets), [0, 60000])
+        numpy.testing.assert_equal(result['a']['mean'], [32.5, 57.5])
+        numpy.testing.assert_equal(result['a']['p100'], [50, 80])
+        numpy.testing.assert_equal(result['b']['count'], [0, 1])
+
+    def test_fleet_statistics_rate(self):
+        # Test sequence
+        buckets, result = aggregation.fleet_statistics(self.columns, 60,
+                                                       ('max',), rate=True)
+
+        # Check results
+        self.assertEqual(list(buckets), [0, 60000])
+        numpy.testing.assert_almost_equal(result[None]['max'], [1. / 3, 2. / 3])
+
+    def test_fleet_statistics_empty(self):
+        # Test sequence
+        buckets, result = aggregation.fleet_statistics({}, 60)
+
+        # Check results
+        self.assertEqual(list(buckets), [])
+        self.assertEqual(result, {})
+
+    def test_cache_columns(self):
+        # Prepare test
+        sample_cache = cache.SampleCache(10)
+        sample_cache.update('host1', [(1000, 'cpu_percentage', 23),
+                                      (1000, 'total_memory', 4096)])
+        sample_cache.update('host2', [(2000, 'cpu_percentage', 25)])
+
+        # Test sequence
+        columns = aggregation.cache_columns(sample_cache, 'cpu_percentage')
+
+        # Check results
+        self.assertEqual(sorted(columns), ['host1', 'host2'])
+        self.assertEqual(list(columns['host1'][0]), [1000])
+        self.assertEqual(list(columns['host2'][1]), [25])
+        self.assertEqual(aggregation.cache_columns(sample_cache, 'cpu_percentage',
+                                                   ['host2']).keys(), ['host2'])
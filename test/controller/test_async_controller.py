@@ -0,0 +1,354 @@
+import async_controller
+import codec
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+from Queue import Queue
+from sqlalchemy import create_engine
+from fake_amqp import FakeBroker
+
+
+def encode_reply(host, samples):
+    """Pack a reply like agent/codec.py does"""
+    ids = dict((name, metric_id) for metric_id, name in codec.METRIC_NAMES.items())
+    parts = [codec.HEADER.pack(codec.VERSION, len(host), len(samples)), host]
+    for timestamp, metric_type, value in samples:
+        parts.append(codec.SAMPLE.pack(ids[metric_type], 0, timestamp, value))
+    return ''.join(parts)
+
+
+# Tests for AsyncController module
+class AsyncControllerTest(unittest.TestCase):
+
+    @mock.patch('async_controller.PlainCredentials')
+    @mock.patch('async_controller.ConnectionParameters')
+    @mock.patch('controller.Database')
+    @mock.patch('controller.SampleCache')
+    def setUp(self,
+              mock_SampleCache,
+              mock_Database,
+              mock_ConnectionParameters,
+              mock_Credentials):
+        super(AsyncControllerTest, self).setUp()
+        self.controller = async_controller.AsyncController(mock.sentinel.user,
+                                                           mock.sentinel.password,
+                                                           mock.sentinel.ip,
+                                                           mock.sentinel.port,
+                                                           mock.sentinel.url,
+                                                           max_pending=1)
+        self.controller.connection = mock.MagicMock()
+        self.controller.channel = mock.MagicMock()
+
+    @mock.patch('async_controller.PlainCredentials')
+    @mock.patch('async_controller.ConnectionParameters')
+    @mock.patch('controller.Database')
+    def test_init(self,
+                  mock_Database,
+                  mock_ConnectionParameters,
+                  mock_Credentials):
+        # Test sequence
+        control = async_controller.AsyncController(mock.sentinel.user,
+                                                   mock.sentinel.password,
+                                                   mock.sentinel.ip,
+                                                   mock.sentinel.port,
+                                                   mock.sentinel.url,
+                                                   {'batch_size': 10})
+
+        # Check results
+        mock_ConnectionParameters.assert_called_once_with(mock.sentinel.ip,
+                                                          mock.sentinel.port,
+                                                          '/',
+                                                          mock_Credentials.return_value)
+        mock_Database.assert_called_once_with(mock.sentinel.url, batch_size=10)
+        self.assertEqual(control.parameters, mock_ConnectionParameters.return_value)
+        self.assertEqual(control.connection, None)
+        self.assertEqual(control.requesting, False)
+
+    def test_store_pauses_consumer(self):
+        # Prepare test
+        self.controller.consumer_tag = mock.sentinel.tag
+        mock_channel = self.controller.channel
+
+        # Test sequence
+        self.controller.store(mock.sentinel.host1, mock.sentinel.samples1)
+        self.controller.store(mock.sentinel.host2, mock.sentinel.samples2)
+
+        # Check results
+        self.assertEqual(self.controller.pending.get_nowait(),
+                         (mock.sentinel.host1, mock.sentinel.samples1, None))
+        self.assertEqual(self.controller.overflow,
+                         [(mock.sentinel.host2, mock.sentinel.samples2, None)])
+        mock_channel.basic_cancel.assert_called_once_with(consumer_tag=mock.sentinel.tag)
+        self.assertEqual(self.controller.consumer_tag, None)
+        self.controller.connection.add_timeout.assert_called_once_with(1, self.controller.resume)
+
+    def test_resume(self):
+        # Prepare test
+        self.controller.overflow = [mock.sentinel.item]
+        mock_channel = self.controller.channel
+
+        # Test sequence
+        self.controller.resume()
+
+        # Check results
+        self.assertEqual(self.controller.pending.get_nowait(), mock.sentinel.item)
+        self.assertEqual(self.controller.overflow, [])
+        mock_channel.basic_consume.assert_called_once_with(self.controller.receive_metric,
+                                                           queue='reply',
+                                                           no_ack=True)
+        self.assertEqual(self.controller.consumer_tag,
+                         mock_channel.basic_consume.return_value)
+
+    def test_resume_writer_behind(self):
+        # Prepare test
+        self.controller.pending.put(mock.sentinel.queued)
+        self.controller.overflow = [mock.sentinel.item]
+
+        # Test sequence
+        self.controller.resume()
+
+        # Check results
+        self.assertEqual(self.controller.overflow, [mock.sentinel.item])
+        self.controller.connection.add_timeout.assert_called_once_with(1, self.controller.resume)
+        self.assertFalse(self.controller.channel.basic_consume.called)
+
+    def test_send_request(self):
+        # Prepare test
+        self.controller.requesting = True
+        self.controller.period = '5'
+
+        # Test sequence
+        self.controller.send_request()
+
+        # Check results
+        self.controller.channel.basic_publish.assert_called_once_with(exchange='request',
+                                                                      routing_key='',
+                                                                      body='request_metrics')
+        self.controller.connection.add_timeout.assert_called_once_with(5.0,
+                                                                       self.controller.send_request)
+
+    def test_send_request_stopped(self):
+        # Test sequence
+        self.controller.send_request()
+
+        # Check results
+        self.assertFalse(self.controller.channel.basic_publish.called)
+        self.assertFalse(self.controller.connection.add_timeout.called)
+
+    def test_write_loop(self):
+        # Prepare test
+        mock_database = self.controller.database
+        self.controller.pending = Queue()
+        self.controller.pending.put((mock.sentinel.host, mock.sentinel.samples, None))
+        self.controller.pending.put(None)
+
+        # Test sequence
+        self.controller.write_loop()
+
+        # Check results
+        mock_database.set_metrics.assert_called_once_with(mock.sentinel.host,
+                                                          mock.sentinel.samples)
+        mock_database.flush.assert_called_once_with()
+        mock_database.close_session.assert_called_once_with()
+        self.assertTrue(self.controller.committed.empty())
+
+    def test_write_loop_acknowledge(self):
+        # Prepare test
+        mock_database = self.controller.database
+        mock_database.pending_count = 0
+        self.controller.prefetch = 1
+        self.controller.pending = Queue()
+        self.controller.pending.put((mock.sentinel.host, mock.sentinel.samples, 1))
+        self.controller.pending.put((mock.sentinel.host, mock.sentinel.samples, 2))
+        self.controller.pending.put(None)
+
+        # Test sequence
+        self.controller.write_loop()
+
+        # Check results
+        self.assertEqual(mock_database.flush.call_count, 3)
+        self.assertEqual(self.controller.committed.get_nowait(), (1, True))
+        self.assertEqual(self.controller.committed.get_nowait(), (2, True))
+
+    def test_write_loop_failure(self):
+        # Prepare test
+        mock_database = self.controller.database
+        mock_database.pending_count = 0
+        mock_database.set_metrics.side_effect = [None, ValueError, None]
+        self.controller.prefetch = 10
+        self.controller.pending = Queue()
+        for delivery_tag in [1, 2, 3]:
+            self.controller.pending.put((mock.sentinel.host, mock.sentinel.samples, delivery_tag))
+        self.controller.pending.put(None)
+
+        # Test sequence
+        self.controller.write_loop()
+
+        # Check results
+        self.assertEqual(self.controller.committed.get_nowait(), (1, True))
+        self.assertEqual(self.controller.committed.get_nowait(), (2, False))
+        self.assertEqual(self.controller.committed.get_nowait(), (3, True))
+        mock_database.close_session.assert_called_once_with()
+
+    def test_write_loop_commit_failure(self):
+        # Prepare test
+        mock_database = self.controller.database
+        mock_database.pending_count = 1
+        mock_database.flush.side_effect = [ValueError, None]
+        self.controller.prefetch = 1
+        self.controller.pending = Queue()
+        self.controller.pending.put((mock.sentinel.host, mock.sentinel.samples, 1))
+        self.controller.pending.put(None)
+
+        # Test sequence
+        self.controller.write_loop()
+
+        # Check results
+        self.assertTrue(self.controller.committed.empty())
+        mock_database.close_session.assert_called_once_with()
+
+    def test_write_loop_batch_pending(self):
+        # Prepare test
+        mock_database = self.controller.database
+        mock_database.pending_count = 1
+        self.controller.prefetch = 2
+        self.controller.pending = Queue()
+        self.controller.pending.put((mock.sentinel.host, mock.sentinel.samples, 1))
+        self.controller.pending.put(None)
+
+        # Test sequence
+        self.controller.write_loop()
+
+        # Check results
+        self.assertTrue(self.controller.committed.empty())
+
+    def test_receive_metric_bad_reply(self):
+        # Prepare test
+        self.controller.prefetch = 10
+        mock_properties = mock.Mock(content_type=codec.CONTENT_TYPE)
+
+        # Test sequence
+        self.controller.receive_metric(mock.sentinel.channel,
+                                       mock.Mock(delivery_tag=7),
+                                       mock_properties,
+                                       '\x09\x04\x00\x00host')
+
+        # Check results
+        self.assertTrue(self.controller.pending.empty())
+        self.controller.channel.basic_reject.assert_called_once_with(delivery_tag=7,
+                                                                     requeue=False)
+
+    def test_acknowledge(self):
+        # Prepare test
+        self.controller.committed.put((3, True))
+        self.controller.committed.put((5, True))
+
+        # Test sequence
+        self.controller.acknowledge()
+
+        # Check results
+        self.controller.channel.basic_ack.assert_called_once_with(delivery_tag=5,
+                                                                  multiple=True)
+        self.controller.connection.add_timeout.assert_called_once_with(1, self.controller.acknowledge)
+
+    def test_acknowledge_failed(self):
+        # Prepare test
+        mock_channel = self.controller.channel
+        for item in [(3, True), (4, False), (5, False), (7, True)]:
+            self.controller.committed.put(item)
+
+        # Test sequence
+        self.controller.acknowledge()
+
+        # Check results
+        self.assertEqual(mock_channel.method_calls,
+                         [mock.call.basic_ack(delivery_tag=3, multiple=True),
+                          mock.call.basic_nack(delivery_tag=4, requeue=True),
+                          mock.call.basic_nack(delivery_tag=5, requeue=True),
+                          mock.call.basic_ack(delivery_tag=7, multiple=True)])
+
+    def test_receive_metric_prefetch(self):
+        # Prepare test
+        self.controller.prefetch = 10
+        mock_method = mock.Mock(delivery_tag=7)
+        mock_properties = mock.Mock(content_type=None)
+
+        # Test sequence
+        with mock.patch('controller.parse_reply') as mock_parse_reply:
+            mock_parse_reply.return_value = (mock.sentinel.host, [])
+            self.controller.receive_metric(mock.sentinel.channel,
+                                           mock_method,
+                                           mock_properties,
+                                           mock.sentinel.body)
+
+        # Check results
+        self.assertEqual(self.controller.pending.get_nowait(),
+                         (mock.sentinel.host, [], 7))
+
+
+# Tests for AsyncController against the in-process broker
+class AsyncControllerBrokerTest(unittest.TestCase):
+
+    def setUp(self):
+        super(AsyncControllerBrokerTest, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.url = 'sqlite:///' + os.path.join(self.directory, 'statistics.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super(AsyncControllerBrokerTest, self).tearDown()
+
+    def test_run(self):
+        # Prepare test
+        broker = FakeBroker(interrupt_at=12)
+        timestamps = iter([1442930400000, 1442930405000, 1442930410000])
+
+        def agent(broker, body):
+            broker.reply(encode_reply('host', [(next(timestamps), 'cpu_percentage', 23)]),
+                         codec.CONTENT_TYPE)
+        broker.listen('request', agent)
+        control = async_controller.AsyncController('user', 'password', 'ip', 5672,
+                                                   self.url, {'batch_size': 2})
+
+        # Test sequence
+        with mock.patch('async_controller.SelectConnection', broker.connect):
+            control.run(5)
+
+        # Check results
+        self.assertEqual(broker.exchanges, {'request': 'fanout'})
+        self.assertEqual(len([message for message in broker.published
+                              if message[0] == 'request']), 3)
+        self.assertTrue(broker.connections[0].closed)
+        self.assertFalse(control.writer.is_alive())
+        engine = create_engine(self.url)
+        rows = engine.execute('SELECT cpu_percentage FROM "CPU percentage"').fetchall()
+        self.assertEqual(rows, [(23,), (23,), (23,)])
+        self.assertEqual(control.cache.stats('host', 'cpu_percentage'),
+                         {'min': 23, 'max': 23, 'avg': 23, 'count': 3})
+
+    def test_run_reply_shard(self):
+        # Prepare test
+        broker = FakeBroker(interrupt_at=1)
+
+        def agents(broker, body):
+            for host, value in [('host1', 23), ('host2', 42)]:
+                broker.reply(encode_reply(host, [(1442930400000, 'cpu_percentage', value)]),
+                             codec.CONTENT_TYPE, exchange='replies', routing_key=host)
+        broker.listen('request', agents)
+        control = async_controller.AsyncController('user', 'password', 'ip', 5672,
+                                                   self.url,
+                                                   reply_queue='reply.0',
+                                                   reply_exchange='replies')
+
+        # Test sequence
+        with mock.patch('async_controller.SelectConnection', broker.connect):
+            control.run(5)
+
+        # Check results
+        self.assertEqual(broker.exchanges['replies'], 'x-consistent-hash')
+        self.assertEqual(broker.bindings, {'replies': [('reply.0', '1')]})
+        engine = create_engine(self.url)
+        rows = engine.execute('SELECT cpu_percentage FROM "CPU percentage"').fetchall()
+        self.assertEqual(sorted(rows), [(23,), (42,)])
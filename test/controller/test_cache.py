@@ -0,0 +1,77 @@
+import cache
+import unittest
+
+# Tests for Cache module
+class RingBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        super(RingBufferTest, self).setUp()
+        self.buffer = cache.RingBuffer(3)
+
+    def test_empty(self):
+        # Check results
+        self.assertEqual(self.buffer.latest(), None)
+        self.assertEqual(self.buffer.window(), [])
+        self.assertEqual(self.buffer.stats(), None)
+
+    def test_append(self):
+        # Test sequence
+        self.buffer.append(1000, 10)
+        self.buffer.append(2000, 20)
+
+        # Check results
+        self.assertEqual(self.buffer.latest(), (2000, 20))
+        self.assertEqual(self.buffer.window(), [(1000, 10), (2000, 20)])
+        self.assertEqual(self.buffer.window(1), [(2000, 20)])
+        self.assertEqual(self.buffer.window(5), [(1000, 10), (2000, 20)])
+
+    def test_append_wraps(self):
+        # Test sequence
+        for second in range(1, 6):
+            self.buffer.append(second * 1000, second * 10)
+
+        # Check results
+        self.assertEqual(self.buffer.count, 3)
+        self.assertEqual(self.buffer.latest(), (5000, 50))
+        self.assertEqual(self.buffer.window(), [(3000, 30), (4000, 40), (5000, 50)])
+
+    def test_stats(self):
+        # Prepare test
+        for second, value in enumerate([7, 1, 4, 10]):
+            self.buffer.append(second * 1000, value)
+
+        # Test sequence
+        stats = self.buffer.stats()
+        last_two = self.buffer.stats(2)
+
+        # Check results
+        self.assertEqual(stats, {'min': 1, 'max': 10, 'avg': 5, 'count': 3})
+        self.assertEqual(last_two, {'min': 4, 'max': 10, 'avg': 7, 'count': 2})
+
+
+class SampleCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        super(SampleCacheTest, self).setUp()
+        self.cache = cache.SampleCache(2)
+
+    def test_update(self):
+        # Test sequence
+        self.cache.update('host1', [(1000, 'cpu_percentage', 23),
+                                    (1000, 'total_memory', 4096)])
+        self.cache.update('host1', [(2000, 'cpu_percentage', 25)])
+
+        # Check results
+        self.assertEqual(sorted(self.cache.series()),
+                         [('host1', 'cpu_percentage'), ('host1', 'total_memory')])
+        self.assertEqual(self.cache.latest('host1', 'cpu_percentage'), (2000, 25))
+        self.assertEqual(self.cache.window('host1', 'cpu_percentage'),
+                         [(1000, 23), (2000, 25)])
+        self.assertEqual(self.cache.stats('host1', 'cpu_percentage'),
+                         {'min': 23, 'max': 25, 'avg': 24, 'count': 2})
+
+    def test_unknown_series(self):
+        # Check results
+        self.assertEqual(self.cache.latest('host1', 'cpu_percentage'), None)
+        self.assertEqual(self.cache.window('host1', 'cpu_percentage'), [])
+        self.assertEqual(self.cache.stats('host1', 'cpu_percentage'), None)
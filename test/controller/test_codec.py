@@ -0,0 +1,116 @@
+import codec
+import unittest
+
+# Tests for Codec module
+class CodecTest(unittest.TestCase):
+
+    def test_decode(self):
+
+        # Prepare test
+        body = ('\x01\x04\x00\x02' + 'host' +
+                '\x03\x00' + '\x00\x00\x01\x4f\xf5\x5a\x9c\xf4' +
+                '\x00\x00\x00\x00\x00\x00\x00\x17' +
+                '\x04\x00' + '\x00\x00\x01\x4f\xf5\x5a\x9c\xf5' +
+                '\x00\x00\x01\x00\x00\x00\x00\x00')
+        expected_samples = [(1442930400500, 'cpu_percentage', 23),
+                            (1442930400501, 'network_bytes_sent', 2 ** 40)]
+
+        # Test sequence
+        host, samples = codec.decode(body)
+
+        # Check results
+        self.assertEqual(host, 'host')
+        self.assertEqual(samples, expected_samples)
+
+    def test_decode_unknown_metric(self):
+
+        # Prepare test
+        body = ('\x01\x04\x00\x02' + 'host' +
+                '\x63\x00' + '\x00\x00\x00\x00\x00\x00\x00\x05' +
+                '\x00\x00\x00\x00\x00\x00\x00\x01' +
+                '\x03\x00' + '\x00\x00\x00\x00\x00\x00\x00\x05' +
+                '\x00\x00\x00\x00\x00\x00\x00\x17')
+
+        # Test sequence
+        host, samples = codec.decode(body)
+
+        # Check results
+        self.assertEqual(samples, [(5, 'cpu_percentage', 23)])
+
+    def test_decode_unknown_version(self):
+
+        # Prepare test
+        body = '\x04\x04\x00\x00' + 'host'
+
+        # Test sequence
+        self.assertRaises(ValueError, codec.decode, body)
+
+    def test_decode_missing(self):
+
+        # Prepare test
+        body = ('\x01\x04\x00\x01' + 'host' +
+                '\x06\x01' + '\x00\x00\x00\x00\x00\x00\x00\x05' +
+                '\x00\x00\x00\x00\x00\x00\x00\x00')
+
+        # Test sequence
+        host, samples = codec.decode(body)
+
+        # Check results
+        self.assertEqual(samples, [(5, 'disk_reads_sec', None)])
+
+    def test_decode_devices(self):
+
+        # Prepare test
+        body = ('\x02\x04\x00\x00' + 'host' + '\x00\x01' +
+                '\x02\x02' + '\x00\x00\x00\x00\x00\x00\x00\x05' + '\x00\x07\x00\x02' +
+                '\x04eth0' + '\x02lo' +
+                '\x00\x00\x00\x00\x00\x00\x01\x00' +
+                '\x00\x00\x00\x00\x00\x00\x00\x02')
+        repeated_body = ('\x02\x04\x00\x00' + 'host' + '\x00\x01' +
+                         '\x02\x00' + '\x00\x00\x00\x00\x00\x00\x00\x05' + '\x00\x07\x00\x02' +
+                         '\x00\x00\x00\x00\x00\x00\x01\x00' +
+                         '\x00\x00\x00\x00\x00\x00\x00\x02')
+        dictionaries = codec.DeviceDictionaries()
+
+        # Test sequence
+        host, samples = codec.decode(body, dictionaries)
+        _, repeated_samples = codec.decode(repeated_body, dictionaries)
+        _, unknown_samples = codec.decode(repeated_body)
+
+        # Check results
+        self.assertEqual(host, 'host')
+        self.assertEqual(samples, [(5, 'network_bytes_sent_per_nic/eth0', 256),
+                                   (5, 'network_bytes_sent_per_nic/lo', 2)])
+        self.assertEqual(repeated_samples, samples)
+        self.assertEqual(unknown_samples, [])
+
+    def test_split_metric(self):
+
+        # Check results
+        self.assertEqual(codec.split_metric('cpu_percentage'),
+                         ('cpu_percentage', None))
+        self.assertEqual(codec.split_metric('disk_reads_sec_per_disk/sda'),
+                         ('disk_reads_sec_per_disk', 'sda'))
+        self.assertEqual(codec.device_metric('cpu_percentage_per_core', '3'),
+                         'cpu_percentage_per_core/3')
+
+    def test_decode_summary(self):
+
+        # Prepare test
+        body = ('\x03\x04\x00\x02' + 'host' +
+                '\x03\x04' + '\x00\x00\x00\x00\x00\x00\x00\x05' +
+                '\x00\x00\x00\x00\x00\x00\x00\x14' +
+                '\x00\x00\x00\x00\x00\x00\x00\x0a' +
+                '\x00\x00\x00\x00\x00\x00\x00\x5a' +
+                '\x40\x44\x40\x00\x00\x00\x00\x00' +
+                '\x00\x00\x00\x03' +
+                '\x02\x00' + '\x00\x00\x00\x00\x00\x00\x00\x05' +
+                '\x00\x00\x00\x00\x00\x00\x03\xe8' +
+                '\x00\x00')
+
+        # Test sequence
+        host, samples = codec.decode(body)
+
+        # Check results
+        self.assertEqual(samples, [(5, 'cpu_percentage', codec.Summary(10, 90, 40.5, 20, 3)),
+                                   (5, 'total_memory', 1000)])
@@ -9,9 +9,11 @@ class ControllerTest(unittest.TestCase):
     @mock.patch('controller.ConnectionParameters')
     @mock.patch('controller.BlockingConnection')
     @mock.patch('controller.Database')
+    @mock.patch('controller.SampleCache')
     @mock.patch('controller.Controller.receive_metric')
     def setUp(self,
               mock_receive_metric,
+              mock_SampleCache,
               mock_Database,
               mock_BlockingConnection,
               mock_ConnectionParameters,
@@ -61,24 +63,94 @@ class ControllerTest(unittest.TestCase):
                                                            queue='reply',
                                                            no_ack=True)
         mock_Database.assert_called_once_with(mock.sentinel.url)
+        self.assertFalse(mock_channel.basic_qos.called)
+        mock_connection.add_timeout.assert_called_once_with(1, control.flush_due)
+        self.assertEqual(control.cache.size, 60)
         self.assertEqual(control.connection, mock_connection)
         self.assertEqual(control.requesting, False)
         self.assertEqual(control.database, mock_database)
 
+    @mock.patch('controller.PlainCredentials')
+    @mock.patch('controller.ConnectionParameters')
+    @mock.patch('controller.BlockingConnection')
+    @mock.patch('controller.Database')
+    @mock.patch('controller.Controller.receive_metric')
+    def test_init_prefetch(self,
+                           mock_receive_metric,
+                           mock_Database,
+                           mock_BlockingConnection,
+                           mock_ConnectionParameters,
+                           mock_Credentials):
+        # Prepare test
+        mock_channel = mock_BlockingConnection.return_value.channel.return_value
+
+        # Test sequence
+        control = controller.Controller(mock.sentinel.user,
+                                        mock.sentinel.password,
+                                        mock.sentinel.ip,
+                                        mock.sentinel.port,
+                                        mock.sentinel.url,
+                                        prefetch=100)
+
+        # Check results
+        mock_channel.basic_qos.assert_called_once_with(prefetch_count=100)
+        mock_channel.basic_consume.assert_called_once_with(mock_receive_metric,
+                                                           queue='reply',
+                                                           no_ack=False)
+        self.assertEqual(control.prefetch, 100)
+
+    @mock.patch('controller.PlainCredentials')
+    @mock.patch('controller.ConnectionParameters')
+    @mock.patch('controller.BlockingConnection')
+    @mock.patch('controller.Database')
+    @mock.patch('controller.Controller.receive_metric')
+    def test_init_reply_exchange(self,
+                                 mock_receive_metric,
+                                 mock_Database,
+                                 mock_BlockingConnection,
+                                 mock_ConnectionParameters,
+                                 mock_Credentials):
+        # Prepare test
+        mock_channel = mock_BlockingConnection.return_value.channel.return_value
+
+        # Test sequence
+        controller.Controller(mock.sentinel.user,
+                              mock.sentinel.password,
+                              mock.sentinel.ip,
+                              mock.sentinel.port,
+                              mock.sentinel.url,
+                              reply_queue='reply.2',
+                              reply_exchange='replies')
+
+        # Check results
+        mock_channel.queue_declare.assert_called_once_with(queue='reply.2')
+        mock_channel.exchange_declare.assert_called_with(exchange='replies',
+                                                         type='x-consistent-hash')
+        mock_channel.queue_bind.assert_called_once_with(exchange='replies',
+                                                        queue='reply.2',
+                                                        routing_key='1')
+        mock_channel.basic_consume.assert_called_once_with(mock_receive_metric,
+                                                           queue='reply.2',
+                                                           no_ack=True)
+
     @mock.patch('controller.literal_eval')
+    @mock.patch('controller.epoch_ms')
     @mock.patch('controller.datetime')
     def test_receive_metric(self,
                             mock_datetime,
+                            mock_epoch_ms,
                             mock_literal_eval):
         # Prepare test
-        mock_set_metric = self.controller.database.set_metric
-        mock_timestamp = mock_datetime.return_value
-        mock_metric = mock_literal_eval.return_value
+        mock_set_metrics = self.controller.database.set_metrics
+        mock_timestamp = mock_epoch_ms.return_value
+        mock_metric = [[2015, 9, 22, 10, 0, 0, 0], 'host', 'cpu_percentage', 23]
+        mock_literal_eval.return_value = mock_metric
+        mock_properties = mock.Mock(content_type=None)
 
         # Test sequence
         self.controller.receive_metric(mock.sentinel.channel,
                                        mock.sentinel.method,
-                                       mock.sentinel.properties,
+                                       mock_properties,
                                        mock.sentinel.body)
 
         # Check results
@@ -90,10 +162,170 @@ class ControllerTest(unittest.TestCase):
                                               minute=mock_metric[0][4],
                                               second=mock_metric[0][5],
                                               microsecond=mock_metric[0][6])
-        mock_set_metric.assert_called_once_with(metric=mock_metric[2],
-                                                host=mock_metric[1],
-                                                timestamp=mock_timestamp,
-                                                value=mock_metric[3])
+        mock_set_metrics.assert_called_once_with(mock_metric[1],
+                                                 [(mock_timestamp,
+                                                   mock_metric[2],
+                                                   mock_metric[3])])
+        self.controller.cache.update.assert_called_once_with(mock_metric[1],
+                                                             [(mock_timestamp,
+                                                               mock_metric[2],
+                                                               mock_metric[3])])
+
+    @mock.patch('controller.decode')
+    @mock.patch('controller.literal_eval')
+    @mock.patch('controller.datetime')
+    def test_receive_metric_encoded(self,
+                                    mock_datetime,
+                                    mock_literal_eval,
+                                    mock_decode):
+        # Prepare test
+        mock_set_metrics = self.controller.database.set_metrics
+        mock_decode.return_value = ('host', [(1442930400500, 'cpu_percentage', 23),
+                                             (1442930400500, 'disk_reads_sec', None),
+                                             (1442930400500, 'total_memory', 1000)])
+        mock_properties = mock.Mock(content_type=controller.CONTENT_TYPE)
+
+        # Test sequence
+        self.controller.receive_metric(mock.sentinel.channel,
+                                       mock.sentinel.method,
+                                       mock_properties,
+                                       mock.sentinel.body)
+
+        # Check results
+        mock_decode.assert_called_once_with(mock.sentinel.body,
+                                            self.controller.devices)
+        self.assertFalse(mock_literal_eval.called)
+        self.assertFalse(mock_datetime.called)
+        self.assertFalse(mock_datetime.fromtimestamp.called)
+        mock_set_metrics.assert_called_once_with('host',
+                                                 [(1442930400500, 'cpu_percentage', 23),
+                                                  (1442930400500, 'total_memory', 1000)])
+        self.assertFalse(self.controller.database.set_metric.called)
+
+    @mock.patch('controller.decode')
+    def test_receive_metric_summaries(self,
+                                      mock_decode):
+        # Prepare test
+        mock_set_metrics = self.controller.database.set_metrics
+        mock_decode.side_effect = [('host', [(1000, 'network_bytes_sent',
+                                              controller.Summary(100, 300, 200, 300, 3))]),
+                                   ('host', [(2000, 'cpu_percentage',
+                                              controller.Summary(10, 90, 40.4, 20, 3)),
+                                             (2000, 'network_bytes_sent',
+                                              controller.Summary(100, 500, 150, 500, 3))])]
+        mock_properties = mock.Mock(content_type=controller.CONTENT_TYPE)
+
+        # Test sequence
+        for _ in range(2):
+            self.controller.receive_metric(mock.sentinel.channel,
+                                           mock.sentinel.method,
+                                           mock_properties,
+                                           mock.sentinel.body)
+
+        # Check results
+        mock_set_metrics.assert_called_with('host',
+                                            [(2000, 'cpu_percentage', 40),
+                                             (2000, 'cpu_percentage/min', 10),
+                                             (2000, 'cpu_percentage/max', 90),
+                                             (2000, 'network_bytes_sent_sec', 200)])
+
+    @mock.patch('controller.decode')
+    def test_receive_metric_bad_reply(self,
+                                      mock_decode):
+        # Prepare test
+        mock_decode.side_effect = ValueError('Unsupported message version 9')
+        mock_properties = mock.Mock(content_type=controller.CONTENT_TYPE)
+        self.controller.prefetch = 2
+
+        # Test sequence
+        self.controller.receive_metric(mock.sentinel.channel,
+                                       mock.Mock(delivery_tag=3),
+                                       mock_properties,
+                                       mock.sentinel.body)
+
+        # Check results
+        self.assertFalse(self.controller.database.set_metrics.called)
+        self.controller.channel.basic_reject.assert_called_once_with(delivery_tag=3,
+                                                                     requeue=False)
+        self.assertEqual(self.controller.unacked, 0)
+
+    @mock.patch('controller.parse_reply')
+    def test_receive_metric_prefetch(self,
+                                     mock_parse_reply):
+        # Prepare test
+        mock_parse_reply.return_value = (mock.sentinel.host, [])
+        mock_database = self.controller.database
+        mock_channel = self.controller.channel
+        self.controller.prefetch = 2
+
+        # Test sequence
+        mock_database.pending_count = 1
+        self.controller.receive_metric(mock.sentinel.channel,
+                                       mock.Mock(delivery_tag=1),
+                                       mock.sentinel.properties,
+                                       mock.sentinel.body)
+
+        # Check results
+        self.assertFalse(mock_database.flush.called)
+        self.assertFalse(mock_channel.basic_ack.called)
+        self.assertEqual(self.controller.unacked, 1)
+
+        # Test sequence
+        mock_database.flush.side_effect = lambda: setattr(mock_database, 'pending_count', 0)
+        self.controller.receive_metric(mock.sentinel.channel,
+                                       mock.Mock(delivery_tag=2),
+                                       mock.sentinel.properties,
+                                       mock.sentinel.body)
+
+        # Check results
+        mock_database.flush.assert_called_once_with()
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=2,
+                                                       multiple=True)
+        self.assertEqual(self.controller.unacked, 0)
+
+    @mock.patch('controller.parse_reply')
+    def test_receive_metric_store_failure(self,
+                                          mock_parse_reply):
+        # Prepare test
+        mock_parse_reply.return_value = (mock.sentinel.host, [])
+        mock_database = self.controller.database
+        mock_database.set_metrics.side_effect = ValueError
+        mock_channel = self.controller.channel
+        self.controller.prefetch = 2
+
+        # Test sequence
+        self.controller.receive_metric(mock.sentinel.channel,
+                                       mock.Mock(delivery_tag=1),
+                                       mock.sentinel.properties,
+                                       mock.sentinel.body)
+
+        # Check results
+        mock_channel.basic_nack.assert_called_once_with(delivery_tag=1,
+                                                        requeue=True)
+        self.assertFalse(mock_channel.basic_ack.called)
+        self.assertEqual(self.controller.unacked, 0)
+
+    @mock.patch('controller.parse_reply')
+    def test_receive_metric_commit_failure(self,
+                                           mock_parse_reply):
+        # Prepare test
+        mock_parse_reply.return_value = (mock.sentinel.host, [])
+        mock_database = self.controller.database
+        mock_database.flush.side_effect = ValueError
+        mock_database.pending_count = 1
+        mock_channel = self.controller.channel
+        self.controller.prefetch = 1
+
+        # Test sequence
+        self.controller.receive_metric(mock.sentinel.channel,
+                                       mock.Mock(delivery_tag=1),
+                                       mock.sentinel.properties,
+                                       mock.sentinel.body)
+
+        # Check results
+        mock_database.flush.assert_called_once_with()
+        self.assertFalse(mock_channel.basic_ack.called)
+        self.assertEqual(self.controller.unacked, 1)
 
     @mock.patch('controller.sleep')
     def test_start_requesting(self,
@@ -144,6 +376,42 @@ class ControllerTest(unittest.TestCase):
         # Check results
         mock_stop_consuming.assert_called_once_with()
 
+    def test_flush_due(self):
+        # Prepare test
+        mock_database = self.controller.database
+        mock_database.flush_if_due.side_effect = lambda: setattr(mock_database, 'pending_count', 0)
+        mock_database.pending_count = 1
+        mock_channel = self.controller.channel
+        self.controller.prefetch = 10
+        self.controller.unacked = 2
+        self.controller.last_delivery_tag = 5
+
+        # Test sequence
+        self.controller.flush_due()
+
+        # Check results
+        mock_database.flush_if_due.assert_called_once_with()
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=5,
+                                                       multiple=True)
+        self.controller.connection.add_timeout.assert_called_with(1, self.controller.flush_due)
+
+    def test_flush_due_failure(self):
+        # Prepare test
+        mock_database = self.controller.database
+        mock_database.flush.side_effect = ValueError
+        mock_database.pending_count = 1
+        self.controller.prefetch = 2
+        self.controller.unacked = 2
+
+        # Test sequence
+        self.controller.flush_due()
+
+        # Check results
+        mock_database.flush.assert_called_once_with()
+        self.assertFalse(self.controller.channel.basic_ack.called)
+        self.assertEqual(self.controller.unacked, 2)
+        self.controller.connection.add_timeout.assert_called_with(1, self.controller.flush_due)
+
     def test_disconnect(self):
         # Prepare test
         mock_connection = self.controller.connection
@@ -154,4 +422,22 @@ class ControllerTest(unittest.TestCase):
 
         # Check results
         mock_connection.close.assert_called_once_with()
+        mock_database.flush.assert_called_once_with()
         mock_database.close_session.assert_called_once_with()
+
+    def test_disconnect_acknowledge(self):
+        # Prepare test
+        mock_database = self.controller.database
+        mock_database.pending_count = 0
+        mock_channel = self.controller.channel
+        self.controller.prefetch = 10
+        self.controller.unacked = 3
+        self.controller.last_delivery_tag = 3
+
+        # Test sequence
+        self.controller.disconnect()
+
+        # Check results
+        mock_database.flush.assert_called_once_with()
+        mock_channel.basic_ack.assert_called_once_with(delivery_tag=3,
+                                                       multiple=True)
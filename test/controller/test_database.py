@@ -1,6 +1,12 @@
 import database
 import mock
+import os
+import shutil
+import tempfile
 import unittest
+from datetime import datetime
+from time import mktime
+from sqlalchemy.exc import OperationalError
 
 # Tests for Database module
 class DatabaseTest(unittest.TestCase):
@@ -8,17 +14,27 @@ class DatabaseTest(unittest.TestCase):
     @mock.patch('database.create_engine')
     @mock.patch('database.declarative_base')
     @mock.patch('database.sessionmaker')
+    @mock.patch('database.migrate')
     def setUp(self,
+              mock_migrate,
               mock_sessionmaker,
               mock_declarative_base,
               mock_create_engine):
         super(DatabaseTest, self).setUp()
         self.database = database.Database(mock.sentinel.url)
+        self.database.host_ids = {mock.sentinel.host: mock.sentinel.host_id}
+
+        # Metric tables get timestamps as they are
+        patcher = mock.patch('database.from_epoch_ms', lambda timestamp: timestamp)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     @mock.patch('database.create_engine')
     @mock.patch('database.Base')
     @mock.patch('database.sessionmaker')
+    @mock.patch('database.migrate')
     def test_init(self,
+                  mock_migrate,
                   mock_sessionmaker,
                   mock_Base,
                   mock_create_engine):
@@ -32,6 +48,7 @@ class DatabaseTest(unittest.TestCase):
 
         # Check results
         mock_create_engine.assert_called_once_with(mock.sentinel.url)
+        mock_migrate.assert_called_once_with(mock_engine)
         mock_Base.metadata.create_all.assert_called_once_with(mock_engine)
         mock_sessionmaker.assert_called_once_with(bind=mock_engine)
         self.assertEqual(mock_Base.metadata.bind, mock_engine)
@@ -45,19 +62,382 @@ class DatabaseTest(unittest.TestCase):
         mock_new_entry = mock_MetricTable.insert.return_value
 
         # Test sequence
-        self.database.set_metric(mock.sentinel.metric,
+        self.database.set_metric('metric',
                                  mock.sentinel.timestamp,
                                  mock.sentinel.host,
                                  mock.sentinel.value)
 
         # Check results
-        mock_MetricTable.insert.assert_called_once_with(host=mock.sentinel.host,
-                                                        metric=mock.sentinel.metric,
+        mock_MetricTable.insert.assert_called_once_with(host_id=mock.sentinel.host_id,
+                                                        metric='metric',
                                                         timestamp=mock.sentinel.timestamp,
                                                         value=mock.sentinel.value)
         self.database.session.add.assert_called_once_with(mock_new_entry)
         self.database.session.commit.assert_called_once_with()
 
+    @mock.patch('database.MetricTable')
+    def test_set_metric_buffered(self,
+                                 mock_MetricTable):
+
+        # Prepare test
+        self.database.batch_size = 2
+        mock_table = mock.MagicMock()
+        mock_table.__table__ = mock.MagicMock()
+        mock_MetricTable.row.return_value = (mock_table, mock.sentinel.row)
+
+        # Test sequence
+        self.database.set_metric('metric',
+                                 mock.sentinel.timestamp,
+                                 mock.sentinel.host,
+                                 mock.sentinel.value)
+
+        # Check results
+        mock_MetricTable.insert.assert_not_called()
+        self.assertFalse(self.database.session.commit.called)
+        self.assertEqual(self.database.pending, {mock_table: [mock.sentinel.row]})
+
+        # Test sequence
+        self.database.set_metric('metric',
+                                 mock.sentinel.timestamp,
+                                 mock.sentinel.host,
+                                 mock.sentinel.value)
+
+        # Check results
+        mock_insert = mock_table.__table__.insert.return_value.prefix_with.return_value
+        self.database.session.execute.assert_called_once_with(mock_insert,
+                                                              [mock.sentinel.row,
+                                                               mock.sentinel.row])
+        self.database.session.commit.assert_called_once_with()
+        self.assertEqual(self.database.pending, {})
+        self.assertEqual(self.database.pending_count, 0)
+
+    @mock.patch('database.time')
+    @mock.patch('database.MetricTable')
+    def test_set_metric_commit_latency(self,
+                                       mock_MetricTable,
+                                       mock_time):
+
+        # Prepare test
+        self.database.batch_size = 100
+        self.database.commit_latency = 5
+        mock_table = mock.MagicMock()
+        mock_table.__table__ = mock.MagicMock()
+        mock_MetricTable.row.return_value = (mock_table, mock.sentinel.row)
+        mock_time.side_effect = [10, 12, 16]
+
+        # Test sequence
+        self.database.set_metric('metric',
+                                 mock.sentinel.timestamp,
+                                 mock.sentinel.host,
+                                 mock.sentinel.value)
+        self.database.set_metric('metric',
+                                 mock.sentinel.timestamp,
+                                 mock.sentinel.host,
+                                 mock.sentinel.value)
+
+        # Check results
+        self.database.session.commit.assert_called_once_with()
+
+    @mock.patch('database.MetricTable')
+    def test_set_metrics(self,
+                         mock_MetricTable):
+
+        # Prepare test
+        mock_table = mock.MagicMock()
+        mock_table.__table__ = mock.MagicMock()
+        mock_MetricTable.row.return_value = (mock_table, mock.sentinel.row)
+        samples = [(mock.sentinel.timestamp, 'metric1', mock.sentinel.value1),
+                   (mock.sentinel.timestamp, 'metric2', mock.sentinel.value2)]
+
+        # Test sequence
+        self.database.set_metrics(mock.sentinel.host, samples)
+
+        # Check results
+        mock_MetricTable.row.assert_any_call(metric='metric1',
+                                             timestamp=mock.sentinel.timestamp,
+                                             host_id=mock.sentinel.host_id,
+                                             value=mock.sentinel.value1)
+        mock_MetricTable.row.assert_any_call(metric='metric2',
+                                             timestamp=mock.sentinel.timestamp,
+                                             host_id=mock.sentinel.host_id,
+                                             value=mock.sentinel.value2)
+        mock_insert = mock_table.__table__.insert.return_value.prefix_with.return_value
+        self.database.session.execute.assert_called_once_with(mock_insert,
+                                                              [mock.sentinel.row,
+                                                               mock.sentinel.row])
+        self.database.session.commit.assert_called_once_with()
+
+    @mock.patch('database.MetricTable')
+    def test_set_metrics_buffered(self,
+                                  mock_MetricTable):
+
+        # Prepare test
+        self.database.batch_size = 100
+        mock_table = mock.MagicMock()
+        mock_MetricTable.row.return_value = (mock_table, mock.sentinel.row)
+        samples = [(mock.sentinel.timestamp, 'metric', mock.sentinel.value)]
+
+        # Test sequence
+        self.database.set_metrics(mock.sentinel.host, samples)
+
+        # Check results
+        self.assertFalse(self.database.session.commit.called)
+        self.assertEqual(self.database.pending_count, 1)
+
+    @mock.patch('database.STATS')
+    @mock.patch('database.MetricTable')
+    def test_set_metrics_stages(self,
+                                mock_MetricTable,
+                                mock_STATS):
+
+        # Prepare test
+        self.database.batch_size = 100
+        mock_MetricTable.row.return_value = (mock.MagicMock(), mock.sentinel.row)
+        samples = [(mock.sentinel.timestamp, 'metric', mock.sentinel.value)]
+
+        # Test sequence
+        self.database.set_metrics(mock.sentinel.host, samples)
+
+        # Check results
+        self.assertEqual([call[0][0] for call in mock_STATS.record.call_args_list],
+                         ['db.insert', 'db.set_metric'])
+
+    def test_flush(self):
+
+        # Prepare test
+        mock_table1 = mock.MagicMock()
+        mock_table1.__table__ = mock.MagicMock()
+        mock_table2 = mock.MagicMock()
+        mock_table2.__table__ = mock.MagicMock()
+        self.database.pending = {mock_table1: [mock.sentinel.row1],
+                                 mock_table2: [mock.sentinel.row2]}
+        self.database.pending_count = 2
+
+        # Test sequence
+        self.database.flush()
+
+        # Check results
+        mock_insert1 = mock_table1.__table__.insert.return_value.prefix_with.return_value
+        mock_insert2 = mock_table2.__table__.insert.return_value.prefix_with.return_value
+        self.database.session.execute.assert_any_call(mock_insert1,
+                                                      [mock.sentinel.row1])
+        self.database.session.execute.assert_any_call(mock_insert2,
+                                                      [mock.sentinel.row2])
+        self.database.session.commit.assert_called_once_with()
+        self.assertEqual(self.database.pending_count, 0)
+
+    def test_flush_empty(self):
+
+        # Test sequence
+        self.database.flush()
+
+        # Check results
+        self.assertFalse(self.database.session.execute.called)
+        self.assertFalse(self.database.session.commit.called)
+
+    def test_flush_rollback(self):
+
+        # Prepare test
+        mock_table = mock.MagicMock()
+        mock_table.__table__ = mock.MagicMock()
+        self.database.pending = {mock_table: [mock.sentinel.row]}
+        self.database.pending_count = 1
+        self.database.pending_since = 10
+        self.database.session.commit.side_effect = [ValueError, None]
+
+        # Test sequence
+        self.assertRaises(ValueError, self.database.flush)
+
+        # Check results
+        self.database.session.rollback.assert_called_once_with()
+        self.assertEqual(self.database.pending, {mock_table: [mock.sentinel.row]})
+        self.assertEqual(self.database.pending_count, 1)
+        self.assertEqual(self.database.pending_since, 10)
+
+        # Test sequence
+        self.database.flush()
+
+        # Check results
+        self.assertEqual(self.database.pending, {})
+        self.assertEqual(self.database.pending_count, 0)
+
+    def test_row(self):
+
+        # Test sequence
+        table, row = database.MetricTable.row(metric='disk_reads_sec',
+                                              timestamp=mock.sentinel.timestamp,
+                                              host_id=mock.sentinel.host_id,
+                                              value=mock.sentinel.value)
+
+        # Check results
+        self.assertEqual(table, database.DiskReadsPerSecTable)
+        self.assertEqual(row, {'timestamp': mock.sentinel.timestamp,
+                               'host_id': mock.sentinel.host_id,
+                               'reads_sec': mock.sentinel.value})
+
+    def test_get_host_id_cached(self):
+
+        # Test sequence
+        host_id = self.database.get_host_id(mock.sentinel.host)
+
+        # Check results
+        self.assertEqual(host_id, mock.sentinel.host_id)
+        self.assertFalse(self.database.session.query.called)
+
+    def test_get_host_id_known(self):
+
+        # Prepare test
+        mock_query = self.database.session.query.return_value
+        mock_entry = mock_query.filter_by.return_value.first.return_value
+
+        # Test sequence
+        host_id = self.database.get_host_id('host')
+
+        # Check results
+        self.database.session.query.assert_called_once_with(database.HostTable)
+        mock_query.filter_by.assert_called_once_with(name='host')
+        self.assertFalse(self.database.session.add.called)
+        self.assertEqual(host_id, mock_entry.id)
+        self.assertEqual(self.database.host_ids['host'], mock_entry.id)
+
+    @mock.patch('database.HostTable')
+    def test_get_host_id_new(self,
+                             mock_HostTable):
+
+        # Prepare test
+        mock_query = self.database.session.query.return_value
+        mock_query.filter_by.return_value.first.return_value = None
+        mock_entry = mock_HostTable.return_value
+
+        # Test sequence
+        host_id = self.database.get_host_id('host')
+
+        # Check results
+        mock_HostTable.assert_called_once_with(name='host')
+        self.database.session.add.assert_called_once_with(mock_entry)
+        self.database.session.commit.assert_called_once_with()
+        self.assertEqual(host_id, mock_entry.id)
+
+    def test_migrate(self):
+
+        # Prepare test
+        engine = database.create_engine('sqlite://')
+        engine.execute('CREATE TABLE "CPU percentage" ('
+                       'timestamp DATETIME NOT NULL, '
+                       'host VARCHAR(250), '
+                       'cpu_percentage INTEGER, '
+                       'PRIMARY KEY (timestamp))')
+        engine.execute('INSERT INTO "CPU percentage" VALUES '
+                       '("2015-09-22 10:00:00.000000", "host1", 10), '
+                       '("2015-09-22 10:00:01.000000", "host2", 20), '
+                       '("2015-09-22 10:00:02.000000", "host1", 30)')
+
+        # Test sequence
+        database.migrate(engine)
+
+        # Check results
+        hosts = engine.execute('SELECT id, name FROM "Hosts" '
+                               'ORDER BY name').fetchall()
+        self.assertEqual([host[1] for host in hosts], ['host1', 'host2'])
+        host_ids = dict((name, host_id) for host_id, name in hosts)
+        rows = engine.execute('SELECT host_id, cpu_percentage '
+                              'FROM "CPU percentage" '
+                              'ORDER BY timestamp').fetchall()
+        self.assertEqual([tuple(row) for row in rows],
+                         [(host_ids['host1'], 10),
+                          (host_ids['host2'], 20),
+                          (host_ids['host1'], 30)])
+        self.assertEqual(sorted(database.inspect(engine).get_table_names()),
+                         ['CPU percentage', 'Hosts'])
+
+        # Migrated tables are left alone
+        database.migrate(engine)
+        count = engine.execute('SELECT count(*) FROM "CPU percentage"').scalar()
+        self.assertEqual(count, 3)
+
+    @mock.patch('database.SeriesTable')
+    def test_get_series_id_new(self,
+                               mock_SeriesTable):
+
+        # Prepare test
+        mock_query = self.database.session.query.return_value
+        mock_query.filter_by.return_value.first.return_value = None
+        mock_entry = mock_SeriesTable.return_value
+
+        # Test sequence
+        series_id = self.database.get_series_id(mock.sentinel.host_id,
+                                                'cpu_percentage')
+        cached_series_id = self.database.get_series_id(mock.sentinel.host_id,
+                                                       'cpu_percentage')
+
+        # Check results
+        mock_query.filter_by.assert_called_once_with(host_id=mock.sentinel.host_id,
+                                                     metric='cpu_percentage')
+        mock_SeriesTable.assert_called_once_with(host_id=mock.sentinel.host_id,
+                                                 metric='cpu_percentage')
+        self.database.session.add.assert_called_once_with(mock_entry)
+        self.assertEqual(series_id, mock_entry.id)
+        self.assertEqual(cached_series_id, mock_entry.id)
+
+    @mock.patch('database.MetricTable')
+    def test_set_metric_samples(self,
+                                mock_MetricTable):
+
+        # Prepare test
+        self.database.storage = 'samples'
+        self.database.series_ids = {(mock.sentinel.host_id, 'foo'): 7}
+        self.database.rollup = mock.Mock()
+
+        # Test sequence
+        self.database.set_metric('foo',
+                                 mock.sentinel.timestamp,
+                                 mock.sentinel.host,
+                                 mock.sentinel.value)
+
+        # Check results
+        self.assertFalse(mock_MetricTable.insert.called)
+        self.assertFalse(mock_MetricTable.row.called)
+        self.database.session.execute.assert_called_once_with(mock.ANY,
+                                                              [{'series_id': 7,
+                                                                'timestamp': mock.sentinel.timestamp,
+                                                                'value': mock.sentinel.value}])
+        self.database.rollup.mark.assert_called_once_with(self.database.session, 0,
+                                                          [(7, mock.sentinel.timestamp)])
+        self.database.session.commit.assert_called_once_with()
+
+    def test_samples_storage(self):
+
+        # Prepare test
+        db = database.Database('sqlite://', storage='samples')
+        timestamp = 1442930400250
+        samples = [(timestamp, 'cpu_percentage', 23),
+                   (timestamp, 'total_memory', 2 ** 40)]
+
+        # Test sequence
+        db.set_metrics('host1', samples)
+        db.set_metrics('host2', samples[:1])
+
+        # Check results
+        series = db.session.query(database.SeriesTable).count()
+        rows = db.session.query(database.SampleTable.timestamp,
+                                database.SampleTable.value).all()
+        self.assertEqual(series, 3)
+        self.assertEqual(sorted(row.value for row in rows), [23, 23, 2 ** 40])
+        self.assertEqual(set(row.timestamp for row in rows), set([timestamp]))
+        db.close_session()
+
+    def test_epoch_ms(self):
+
+        # Prepare test
+        timestamp = datetime(2015, 9, 22, 10, 0, 0, 250999)
+        expected_ms = (int)(mktime(timestamp.timetuple())) * 1000 + 250
+
+        # Test sequence
+        ms = database.epoch_ms(timestamp)
+
+        # Check results
+        self.assertEqual(ms, expected_ms)
+
     def test_close_session(self):
 
         # Test sequence
@@ -77,7 +457,7 @@ class DatabaseTest(unittest.TestCase):
                                  value=mock.sentinel.value)
         # Check results
         mock_AvailableMemoryTable.assert_called_once_with(timestamp=mock.sentinel.timestamp,
-                                                          host=mock.sentinel.host,
+                                                          host_id=mock.sentinel.host_id,
                                                           available_memory=mock.sentinel.value)
 
     @mock.patch('database.TotalMemoryTable')
@@ -91,7 +471,7 @@ class DatabaseTest(unittest.TestCase):
                                  value=mock.sentinel.value)
         # Check results
         mock_TotalMemoryTable.assert_called_once_with(timestamp=mock.sentinel.timestamp,
-                                                      host=mock.sentinel.host,
+                                                      host_id=mock.sentinel.host_id,
                                                       total_memory=mock.sentinel.value)
 
     @mock.patch('database.CpuPercentageTable')
@@ -105,7 +485,7 @@ class DatabaseTest(unittest.TestCase):
                                  value=mock.sentinel.value)
         # Check results
         mock_CpuPercentageTable.assert_called_once_with(timestamp=mock.sentinel.timestamp,
-                                                        host=mock.sentinel.host,
+                                                        host_id=mock.sentinel.host_id,
                                                         cpu_percentage=mock.sentinel.value)
 
     @mock.patch('database.NetworkBytesSentTable')
@@ -119,7 +499,7 @@ class DatabaseTest(unittest.TestCase):
                                  value=mock.sentinel.value)
         # Check results
         mock_NetworkBytesSentTable.assert_called_once_with(timestamp=mock.sentinel.timestamp,
-                                                           host=mock.sentinel.host,
+                                                           host_id=mock.sentinel.host_id,
                                                            bytes_sent=mock.sentinel.value)
 
     @mock.patch('database.NetworkBytesReceivedTable')
@@ -133,7 +513,7 @@ class DatabaseTest(unittest.TestCase):
                                  value=mock.sentinel.value)
         # Check results
         mock_NetworkBytesReceivedTable.assert_called_once_with(timestamp=mock.sentinel.timestamp,
-                                                               host=mock.sentinel.host,
+                                                               host_id=mock.sentinel.host_id,
                                                                bytes_received=mock.sentinel.value)
 
     @mock.patch('database.DiskReadsPerSecTable')
@@ -147,7 +527,7 @@ class DatabaseTest(unittest.TestCase):
                                  value=mock.sentinel.value)
         # Check results
         mock_DiskReadsPerSecTable.assert_called_once_with(timestamp=mock.sentinel.timestamp,
-                                                          host=mock.sentinel.host,
+                                                          host_id=mock.sentinel.host_id,
                                                           reads_sec=mock.sentinel.value)
 
     @mock.patch('database.DiskWritesPerSecTable')
@@ -161,5 +541,455 @@ class DatabaseTest(unittest.TestCase):
                                  value=mock.sentinel.value)
         # Check results
         mock_DiskWritesPerSecTable.assert_called_once_with(timestamp=mock.sentinel.timestamp,
-                                                          host=mock.sentinel.host,
+                                                          host_id=mock.sentinel.host_id,
                                                           writes_sec=mock.sentinel.value)
+
+
+# Tests against an in-memory database
+class StorageTest(unittest.TestCase):
+
+    def test_redelivered_samples(self):
+
+        # Prepare test
+        db = database.Database('sqlite://')
+        samples = [(1442930400000, 'cpu_percentage', 23)]
+
+        # Test sequence
+        db.set_metrics('host1', samples)
+        db.set_metrics('host1', samples)
+
+        # Check results
+        rows = db.session.query(database.CpuPercentageTable).count()
+        self.assertEqual(rows, 1)
+        db.close_session()
+
+    def test_from_epoch_ms(self):
+
+        # Prepare test
+        timestamp = 1442930400250
+
+        # Test sequence
+        local = database.from_epoch_ms(timestamp)
+
+        # Check results
+        self.assertEqual(local.microsecond, 250000)
+        self.assertEqual(database.epoch_ms(local), timestamp)
+
+    def test_tables_storage(self):
+
+        # Prepare test
+        db = database.Database('sqlite://')
+
+        # Test sequence
+        db.set_metric('cpu_percentage', 1442930400250, 'host1', 23)
+
+        # Check results
+        row = db.session.query(database.CpuPercentageTable).one()
+        self.assertEqual(row.timestamp, database.from_epoch_ms(1442930400250))
+        db.close_session()
+
+
+# Tests for rollup tiers of the samples storage
+class WalTest(unittest.TestCase):
+
+    def setUp(self):
+        super(WalTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.url = 'sqlite:///' + os.path.join(directory, 'statistics.db')
+
+    def test_wal(self):
+        # Prepare test
+        db = database.Database(self.url, storage='samples', wal=True,
+                               pragmas={'synchronous': 'NORMAL',
+                                        'cache_size': -1000},
+                               read_connections=2)
+        self.addCleanup(db.close_session)
+
+        # Test sequence
+        db.set_metrics('host', [(1000, 'cpu_percentage', 23)])
+        with db.reader.connect() as connection:
+            # Readers see committed samples while the writer goes on
+            db.set_metrics('host', [(2000, 'cpu_percentage', 25)])
+            count = connection.execute('SELECT count(*) FROM samples').scalar()
+            self.assertRaises(OperationalError, connection.execute,
+                              'DELETE FROM samples')
+            synchronous = connection.execute('PRAGMA synchronous').scalar()
+
+        # Check results
+        self.assertEqual(db.engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+        self.assertEqual(count, 2)
+        self.assertEqual(synchronous, 1)
+        self.assertEqual(list(db.query('cpu_percentage')['host'][1]), [23, 25])
+
+    def test_checkpoint(self):
+        # Prepare test
+        db = database.Database(self.url, wal=True, checkpoint_interval=3600)
+        self.addCleanup(db.close_session)
+        db.set_metrics('host', [(1000, 'cpu_percentage', 23)])
+
+        # Test sequence
+        log, checkpointed = db.checkpointer.run_once()
+        db.close_session()
+
+        # Check results
+        self.assertEqual(db.engine.execute('PRAGMA wal_autocheckpoint').scalar(), 0)
+        self.assertIsNot(db.checkpointer.engine, db.engine)
+        self.assertIsInstance(db.checkpointer.engine.pool, database.NullPool)
+        self.assertTrue(log > 0)
+        self.assertEqual(checkpointed, log)
+        self.assertEqual(db.checkpointer.thread, None)
+
+    def test_create_schema(self):
+        # Test sequence
+        database.create_schema(self.url)
+        db = database.Database(self.url, wal=True)
+        self.addCleanup(db.close_session)
+
+        # Check results
+        tables = database.inspect(db.engine).get_table_names()
+        self.assertIn('Samples', tables)
+        self.assertIn('Rollup watermarks', tables)
+
+    def test_errors(self):
+        # Check results
+        self.assertRaises(ValueError, database.Database, 'sqlite://', wal=True)
+        self.assertRaises(ValueError, database.Database, self.url,
+                          pragmas={'journal_mode': 'OFF'})
+
+
+class RollupTest(unittest.TestCase):
+
+    # Start of a day in milliseconds since the epoch
+    day = 1442880000000
+
+    def setUp(self):
+        super(RollupTest, self).setUp()
+        self.database = database.Database('sqlite://', storage='samples',
+                                          retention={0: 3600})
+        self.rollup = self.database.rollup
+        self.series_id = self.database.get_series_id(
+            self.database.get_host_id('host'), 'cpu_percentage')
+
+        # Three minutes of samples every 20 seconds
+        self.rollup.engine.execute(database.SampleTable.__table__.insert(),
+                                   [{'series_id': self.series_id,
+                                     'timestamp': self.day + index * 20000,
+                                     'value': index}
+                                    for index in range(9)])
+        self.now = self.day / 1000 + 3720
+
+    def tearDown(self):
+        self.database.close_session()
+        super(RollupTest, self).tearDown()
+
+    def rollups(self, tier):
+        rollups = database.RollupTable.__table__
+        return [tuple(row)[1:] for row in self.rollup.engine.execute(
+            rollups.select().where(rollups.c.tier == tier).order_by(rollups.c.bucket))]
+
+    def test_aggregate(self):
+        # Prepare test
+        rows = [(1, 1000, 5, 5, 5, 1, 5),
+                (1, 59000, 2, 7, 9, 2, 7),
+                (1, 60000, 1, 1, 1, 1, 1),
+                (2, 0, 3, 3, 3, 1, 3)]
+
+        # Test sequence
+        buckets = list(database.aggregate(rows, 60000))
+
+        # Check results
+        self.assertEqual(buckets, [(1, 0, 2, 7, 14, 3, 7),
+                                   (1, 60000, 1, 1, 1, 1, 1),
+                                   (2, 0, 3, 3, 3, 1, 3)])
+
+    def test_run_once(self):
+        # Test sequence
+        self.rollup.run_once(self.now)
+
+        # Check results
+        series_id = self.series_id
+        self.assertEqual(self.rollups(60),
+                         [(series_id, self.day, 0, 2, 3, 3, 2),
+                          (series_id, self.day + 60000, 3, 5, 12, 3, 5),
+                          (series_id, self.day + 120000, 6, 8, 21, 3, 8)])
+        self.assertEqual(self.rollups(3600),
+                         [(series_id, self.day, 0, 8, 36, 9, 8)])
+        self.assertEqual(self.rollups(86400), [])
+        self.assertEqual(self.rollup.watermark(60), self.day + 3660000)
+        self.assertEqual(self.rollup.watermark(3600), self.day + 3600000)
+        self.assertEqual(self.rollup.watermark(86400), None)
+
+        # Raw samples past their hour of retention are pruned
+        samples = self.database.session.query(database.SampleTable.value).all()
+        self.assertEqual(samples, [(6,), (7,), (8,)])
+
+    def test_run_once_again(self):
+        # Test sequence
+        self.rollup.run_once(self.now)
+        self.rollup.run_once(self.now)
+
+        # Check results
+        self.assertEqual(len(self.rollups(60)), 3)
+        self.assertEqual(len(self.rollups(3600)), 1)
+
+    def test_run_once_late(self):
+        # Prepare test
+        self.rollup.run_once(self.now)
+        self.database.set_metrics('host', [(self.day + 130000, 'cpu_percentage', 100)])
+
+        # Test sequence
+        self.rollup.run_once(self.now)
+
+        # Check results
+        series_id = self.series_id
+        self.assertEqual(self.rollups(60)[2],
+                         (series_id, self.day + 120000, 6, 100, 121, 4, 8))
+        self.assertEqual(self.rollups(3600),
+                         [(series_id, self.day, 0, 100, 136, 10, 8)])
+        late = self.rollup.engine.execute(database.LateBucketTable.__table__.select())
+        self.assertEqual(late.fetchall(), [])
+
+    def test_run_once_late_pruned(self):
+        # Prepare test
+        self.rollup.run_once(self.now)
+        self.database.set_metrics('host', [(self.day + 30000, 'cpu_percentage', 100)])
+
+        # Test sequence
+        self.rollup.run_once(self.now)
+
+        # Check results
+        self.assertEqual(self.rollups(60)[0],
+                         (self.series_id, self.day, 0, 2, 3, 3, 2))
+
+    def test_select_tier(self):
+        # Check results
+        now = self.now
+        self.assertEqual(self.rollup.select_tier(self.day, 30, now), -1)
+        self.rollup.run_once(now)
+        self.assertEqual(self.rollup.select_tier(self.day + 3600000, 30, now), -1)
+        self.assertEqual(self.rollup.select_tier(self.day, 300, now), 0)
+        self.assertEqual(self.rollup.select_tier(self.day, 7200, now), 1)
+        self.assertEqual(self.rollup.select_tier(self.day, 86400, now), 2)
+
+        # Tiers are only read into steps that are a multiple of their width
+        self.assertEqual(self.rollup.select_tier(self.day + 3600000, 90, now), -1)
+        self.assertEqual(self.rollup.select_tier(self.day + 3600000, 120, now), 0)
+        self.assertEqual(self.rollup.select_tier(self.day, 5400, now), 0)
+
+        # Pruned tiers are skipped, even when finer than step
+        self.assertEqual(self.rollup.select_tier(self.day, 30, now), 0)
+        self.assertEqual(self.rollup.select_tier(self.day, 300, now + 31 * 86400), 0)
+        rollups = database.RollupTable.__table__
+        self.rollup.engine.execute(rollups.delete().where(rollups.c.tier == 60))
+        self.assertEqual(self.rollup.select_tier(self.day, 300, now + 31 * 86400), 1)
+        self.assertEqual(self.rollup.select_tier(self.day, 300, now + 800 * 86400), 1)
+        self.rollup.engine.execute(rollups.delete())
+        self.rollup.engine.execute(database.SampleTable.__table__.delete())
+        self.rollup.retention[86400] = 400 * 86400
+        self.assertEqual(self.rollup.select_tier(self.day, 300, now + 800 * 86400), 2)
+
+    def test_prune_rows(self):
+        # Prepare test
+        self.rollup.prune_rows = 2
+        samples = database.SampleTable.__table__
+
+        # Test sequence
+        with mock.patch.object(self.rollup.engine, 'begin',
+                               wraps=self.rollup.engine.begin) as mock_begin:
+            self.rollup.delete(samples, samples.c.timestamp, self.day + 120000)
+
+        # Check results
+        self.assertEqual(mock_begin.call_count, 4)
+        values = self.database.session.query(database.SampleTable.value).all()
+        self.assertEqual(values, [(6,), (7,), (8,)])
+
+    def test_read(self):
+        # Prepare test
+        self.rollup.run_once(self.now)
+        self.rollup.engine.execute(database.SampleTable.__table__.insert(),
+                                   [{'series_id': self.series_id,
+                                     'timestamp': self.day + 3670000,
+                                     'value': 100}])
+
+        # Test sequence
+        minutes = list(self.rollup.read(self.series_id, self.day,
+                                        self.day + 3720000, 60, self.now))
+        raw = list(self.rollup.read(self.series_id, self.day,
+                                    self.day + 3720000))
+
+        # Check results
+        series_id = self.series_id
+        self.assertEqual(minutes,
+                         [(series_id, self.day, 0, 2, 3, 3, 2),
+                          (series_id, self.day + 60000, 3, 5, 12, 3, 5),
+                          (series_id, self.day + 120000, 6, 8, 21, 3, 8),
+                          (series_id, self.day + 3660000, 100, 100, 100, 1, 100)])
+        self.assertEqual([row[1] for row in raw],
+                         [self.day + 120000, self.day + 140000,
+                          self.day + 160000, self.day + 3670000])
+
+    def test_read_unaligned(self):
+        # Prepare test
+        self.rollup.run_once(self.now)
+
+        # Test sequence
+        minutes = list(self.rollup.read(self.series_id, self.day + 30000,
+                                        self.day + 600000, 60, self.now))
+
+        # Check results
+        series_id = self.series_id
+        self.assertEqual(minutes,
+                         [(series_id, self.day, 0, 2, 3, 3, 2),
+                          (series_id, self.day + 60000, 3, 5, 12, 3, 5),
+                          (series_id, self.day + 120000, 6, 8, 21, 3, 8)])
+
+
+# Tests for the query API
+class QueryTest(unittest.TestCase):
+
+    # Start of a day in milliseconds since the epoch
+    day = 1442880000000
+
+    def setUp(self):
+        super(QueryTest, self).setUp()
+        self.timestamps = [self.day + index * 20000 for index in range(6)]
+
+    def fill(self, storage):
+        db = database.Database('sqlite://', storage=storage)
+        for host, offset in [('host1', 0), ('host2', 100), ('host3', 200)]:
+            db.set_metrics(host, [(timestamp, 'cpu_percentage', offset + index)
+                                  for index, timestamp in enumerate(self.timestamps)])
+        self.addCleanup(db.close_session)
+        return db
+
+    def test_query_tables(self):
+        # Prepare test
+        db = self.fill('tables')
+
+        # Test sequence
+        result = db.query('cpu_percentage', hosts=['host1', 'host3'],
+                          start=self.day + 20000, end=self.day + 100000)
+
+        # Check results
+        self.assertEqual(sorted(result.keys()), ['host1', 'host3'])
+        timestamps, values = result['host1']
+        self.assertEqual(list(timestamps), [self.day + 20000, self.day + 40000,
+                                            self.day + 60000, self.day + 80000])
+        self.assertEqual(list(values), [1, 2, 3, 4])
+        self.assertEqual(list(result['host3'][1]), [201, 202, 203, 204])
+
+    def test_query_tables_step(self):
+        # Prepare test
+        db = self.fill('tables')
+
+        # Test sequence
+        result = db.query('cpu_percentage', hosts=['host2'], step=60, agg='max')
+        average = db.query('cpu_percentage', hosts=['host2'], step=60)
+
+        # Check results
+        self.assertEqual(list(result['host2'][0]), [self.day, self.day + 60000])
+        self.assertEqual(list(result['host2'][1]), [102, 105])
+        self.assertEqual(list(average['host2'][1]), [101, 104])
+
+    def test_query_samples(self):
+        # Prepare test
+        db = self.fill('samples')
+
+        # Test sequence
+        raw = db.query('cpu_percentage', hosts=['host1'])
+        minutes = db.query('cpu_percentage', step=60, agg='count')
+
+        # Check results
+        self.assertEqual(list(raw['host1'][1]), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(sorted(minutes.keys()), ['host1', 'host2', 'host3'])
+        self.assertEqual(list(minutes['host3'][0]), [self.day, self.day + 60000])
+        self.assertEqual(list(minutes['host3'][1]), [3, 3])
+
+    def test_stream_chunks(self):
+        # Prepare test
+        db = self.fill('samples')
+
+        # Test sequence
+        chunks = list(db.stream('cpu_percentage', hosts=['host1', 'host2'],
+                                chunk_size=4))
+
+        # Check results
+        self.assertEqual([(host, list(values)) for host, _, values in chunks],
+                         [('host1', [0, 1, 2, 3]),
+                          ('host1', [4, 5]),
+                          ('host2', [100, 101, 102, 103]),
+                          ('host2', [104, 105])])
+        self.assertEqual(list(db.query('cpu_percentage', hosts=['host2'])['host2'][1]),
+                         [100, 101, 102, 103, 104, 105])
+
+    def test_query_devices(self):
+        # Prepare test
+        db = self.fill('tables')
+        db.set_metrics('host1', [(timestamp, 'cpu_percentage_per_core/' + core, index)
+                                 for index, timestamp in enumerate(self.timestamps)
+                                 for core in ('0', '1')])
+
+        # Test sequence
+        result = db.query('cpu_percentage_per_core/1')
+        minutes = db.query('cpu_percentage_per_core/0', step=60, agg='max')
+
+        # Check results
+        self.assertEqual(db.session.query(database.SeriesTable).count(), 2)
+        self.assertEqual(result.keys(), ['host1'])
+        self.assertEqual(list(result['host1'][1]), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(list(minutes['host1'][1]), [2, 5])
+
+    def test_query_fill(self):
+        # Prepare test
+        db = self.fill('samples')
+        db.set_metrics('host1', [(self.day + 300000, 'cpu_percentage', 9)])
+
+        # Test sequence
+        result = db.query('cpu_percentage', hosts=['host1'], step=60, fill=120)
+        late = db.query('cpu_percentage', hosts=['host1'], step=60, agg='max',
+                        start=self.day + 180000, end=self.day + 360000, fill=120)
+        unfilled = db.query('cpu_percentage', hosts=['host1'], step=60,
+                            start=self.day + 180000, end=self.day + 360000)
+
+        # Check results
+        self.assertEqual(list(result['host1'][0]),
+                         [self.day + minute * 60000 for minute in (0, 1, 2, 3, 5, 6, 7)])
+        self.assertEqual(list(result['host1'][1]), [1, 4, 5, 5, 9, 9, 9])
+        self.assertEqual(list(late['host1'][1]), [5, 9])
+        self.assertEqual(list(unfilled['host1'][1]), [9])
+
+    def test_forward_fill(self):
+        # Prepare test
+        rows = [(1, 120000, 3, 3, 3, 1, 3), (1, 600000, 7, 7, 7, 1, 7)]
+
+        # Test sequence
+        filled = list(database.forward_fill(iter(rows), 60000, 120000, 0,
+                                            720000, (1, 0, 1, 2, 3, 2, 2)))
+
+        # Check results
+        self.assertEqual([row[1] for row in filled],
+                         [0, 60000, 120000, 180000, 240000, 600000, 660000])
+        self.assertEqual([row[6] for row in filled], [2, 2, 3, 3, 3, 7, 7])
+
+    @mock.patch('database.numpy', None)
+    def test_query_lists(self):
+        # Prepare test
+        db = self.fill('tables')
+
+        # Test sequence
+        result = db.query('cpu_percentage', hosts=['host1'], end=self.day + 40000)
+
+        # Check results
+        self.assertEqual(result, {'host1': ([self.day, self.day + 20000], [0, 1])})
+
+    def test_query_errors(self):
+        # Prepare test
+        db = self.fill('tables')
+
+        # Check results
+        self.assertRaises(ValueError, db.query, 'cpu_percentage', agg='median')
+        self.assertRaises(ValueError, db.query, 'foo')
+        self.assertRaises(ValueError, db.query, 'cpu_percentage', fill=60)
+        self.assertRaises(ValueError, db.query, 'cpu_percentage', step=60,
+                          agg='count', fill=60)
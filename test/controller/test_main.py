@@ -23,14 +23,15 @@ class MainTest(unittest.TestCase):
         mock_address = mock_config.get.return_value
         mock_port = mock_config.get.return_value
         mock_request_period = mock_config.get.return_value
-        mock_url = mock_config.get.return_value
+        mock_url = mock_config.get.return_value.__add__.return_value
         
         mock_controller = mock_Controller.return_value
         
         mock_reply_thread = mock_Thread.return_value
         mock_request_thread = mock_Thread.return_value
         
-        mock_sleep.side_effect = KeyboardInterrupt
+        mock_sleep.side_effect = [KeyboardInterrupt, None]
+        mock_config.has_option.return_value = False
         
         # Test sequence
         main.main()
@@ -41,10 +42,195 @@ class MainTest(unittest.TestCase):
         mock_Controller.assert_called_once_with(mock_user,
                                                 mock_passw,
                                                 mock_address,
-                                                mock_port,
-                                                mock_url)
+                                                (int)(mock_port),
+                                                mock_url,
+                                                {},
+                                                0,
+                                                'reply',
+                                                None,
+                                                60)
+        mock_Thread.assert_any_call(target=mock_controller.start_consuming)
+        mock_Thread.assert_any_call(target=mock_controller.start_requesting,
+                                    args=((float)(mock_request_period),))
+        mock_controller.stop_requesting.assert_called_once_with()
+        mock_controller.stop_consuming.assert_called_once_with()
+        mock_controller.disconnect.assert_called_once_with()
+
+    @mock.patch('main.ConfigParser')
+    @mock.patch('main.Controller')
+    @mock.patch('main.Thread')
+    @mock.patch('main.sleep')
+    def test_main_database_options(self,
+                                   mock_sleep,
+                                   mock_Thread,
+                                   mock_Controller,
+                                   mock_ConfigParser):
+
+        # Prepare test
+        mock_config = mock_ConfigParser.return_value
+        mock_config.has_option.return_value = True
+        mock_config.getint.side_effect = lambda section, option: {'batch_size': 500,
+                                                                  'prefetch': 50,
+                                                                  'size': 10,
+                                                                  'raw_retention': 2,
+                                                                  'day_retention': 0}.get(option, 1)
+        mock_config.getfloat.return_value = 2.5
+        mock_sleep.side_effect = [KeyboardInterrupt, None]
+
+        # Test sequence
+        main.main()
+
+        # Check results
+        database_options = mock_Controller.call_args[0][5]
+        self.assertEqual(database_options, {'batch_size': 500,
+                                            'commit_latency': 2.5,
+                                            'storage': mock_config.get.return_value,
+                                            'wal': mock_config.getboolean.return_value,
+                                            'read_connections': 1,
+                                            'checkpoint_interval': 2.5,
+                                            'pragmas': {'synchronous': mock_config.get.return_value,
+                                                        'cache_size': mock_config.get.return_value,
+                                                        'mmap_size': mock_config.get.return_value},
+                                            'rollup_interval': 2.5,
+                                            'retention': {0: 2 * 86400,
+                                                          60: 86400,
+                                                          3600: 86400,
+                                                          86400: 0}})
+        self.assertEqual(mock_Controller.call_args[0][6:], (50, 'reply',
+                                                            mock_config.get.return_value,
+                                                            10))
+
+    @mock.patch('main.ConfigParser')
+    @mock.patch('main.Controller')
+    @mock.patch('main.Thread')
+    @mock.patch('main.sleep')
+    def test_main_push(self,
+                       mock_sleep,
+                       mock_Thread,
+                       mock_Controller,
+                       mock_ConfigParser):
+
+        # Prepare test
+        mock_config = mock_ConfigParser.return_value
+        mock_config.has_option.side_effect = lambda section, option: option == 'mode'
+        mock_config.get.side_effect = lambda section, option: {'mode': 'push'}.get(option, '1')
+        mock_controller = mock_Controller.return_value
+        mock_sleep.side_effect = KeyboardInterrupt
+
+        # Test sequence
+        main.main()
+
+        # Check results
         mock_Thread.assert_called_once_with(target=mock_controller.start_consuming)
-        mock_Thread.assert_called_once_with(target=mock_controller.start_requesting,
-                                            args=(request_period))
+        self.assertFalse(mock_controller.stop_requesting.called)
+        mock_controller.stop_consuming.assert_called_once_with()
+        mock_controller.disconnect.assert_called_once_with()
+
+    @mock.patch('main.ConfigParser')
+    @mock.patch('main.AsyncController')
+    @mock.patch('main.Controller')
+    @mock.patch('main.Thread')
+    def test_main_async(self,
+                        mock_Thread,
+                        mock_Controller,
+                        mock_AsyncController,
+                        mock_ConfigParser):
 
+        # Prepare test
+        mock_config = mock_ConfigParser.return_value
+        mock_config.has_option.side_effect = lambda section, option: option == 'io'
+        mock_config.get.side_effect = lambda section, option: {'io': 'async',
+                                                               'port': '5672',
+                                                               'request_period': '5'}.get(option, 'x')
+        mock_controller = mock_AsyncController.return_value
+
+        # Test sequence
+        main.main()
 
+        # Check results
+        mock_AsyncController.assert_called_once_with('x', 'x', 'x', 5672, 'xx', {}, 0,
+                                                    'reply', None, 60)
+        mock_controller.run.assert_called_once_with(5.0)
+        mock_controller.disconnect.assert_called_once_with()
+        self.assertFalse(mock_Controller.called)
+        self.assertFalse(mock_Thread.called)
+
+    @mock.patch('main.ConfigParser')
+    @mock.patch('main.Process')
+    @mock.patch('main.Controller')
+    @mock.patch('main.create_schema')
+    @mock.patch('main.forward')
+    def test_main_workers(self,
+                          mock_forward,
+                          mock_create_schema,
+                          mock_Controller,
+                          mock_Process,
+                          mock_ConfigParser):
+
+        # Prepare test
+        mock_config = mock_ConfigParser.return_value
+        mock_config.has_option.side_effect = lambda section, option: option == 'workers'
+        mock_config.getint.return_value = 3
+        mock_config.get.side_effect = lambda section, option: {'port': '5672',
+                                                               'request_period': '5'}.get(option, 'x')
+        mock_process = mock_Process.return_value
+        mock_process.join.side_effect = [KeyboardInterrupt, None, None, None]
+
+        # Test sequence
+        main.main()
+
+        # Check results
+        mock_create_schema.assert_called_once_with('xx')
+        args = ('x', 'x', 'x', 5672, 'xx')
+        options = {'rollup_interval': 0, 'checkpoint_interval': 0}
+        self.assertEqual(mock_Process.call_args_list,
+                         [mock.call(target=main.run_worker,
+                                    args=('threads', args + ({}, 0, 'reply.0', 'replies', 60), 5.0, 0)),
+                          mock.call(target=main.run_worker,
+                                    args=('threads', args + (options, 0, 'reply.1', 'replies', 60), None, 0)),
+                          mock.call(target=main.run_worker,
+                                    args=('threads', args + (options, 0, 'reply.2', 'replies', 60), None, 0))])
+        self.assertEqual(mock_process.start.call_count, 3)
+        self.assertEqual(mock_process.join.call_count, 4)
+        mock_forward.assert_called_once_with([mock_process.pid] * 3)
+        self.assertFalse(mock_Controller.called)
+
+    @mock.patch('main.ConfigParser')
+    @mock.patch('main.Process')
+    @mock.patch('main.create_schema')
+    @mock.patch('main.forward')
+    def test_main_workers_stats(self,
+                                mock_forward,
+                                mock_create_schema,
+                                mock_Process,
+                                mock_ConfigParser):
+
+        # Prepare test
+        mock_config = mock_ConfigParser.return_value
+        mock_config.has_option.side_effect = lambda section, option: option in ('workers', 'port')
+        mock_config.getint.side_effect = lambda section, option: {'workers': 2,
+                                                                  'port': 8100}[option]
+        mock_config.get.side_effect = lambda section, option: {'port': '5672',
+                                                               'request_period': '5'}.get(option, 'x')
+
+        # Test sequence
+        main.main()
+
+        # Check results
+        self.assertEqual([call[1]['args'][3] for call in mock_Process.call_args_list],
+                         [8100, 8101])
+
+    @mock.patch('main.expose')
+    @mock.patch('main.run_threads')
+    @mock.patch('main.Controller')
+    def test_run_worker(self,
+                        mock_Controller,
+                        mock_run_threads,
+                        mock_expose):
+
+        # Test sequence
+        main.run_worker('threads', ('x',), 5.0, 8100)
+
+        # Check results
+        mock_expose.assert_called_once_with(8100)
+        mock_run_threads.assert_called_once_with(mock_Controller.return_value, 5.0)
@@ -0,0 +1,98 @@
+import rates
+import unittest
+
+# Tests for Rates module
+class RateConverterTest(unittest.TestCase):
+
+    def setUp(self):
+        super(RateConverterTest, self).setUp()
+        self.converter = rates.RateConverter()
+
+    def test_convert(self):
+        # Test sequence
+        first = self.converter.convert('host', [(1000, 'network_bytes_sent', 5000),
+                                                (1000, 'cpu_percentage', 23)])
+        second = self.converter.convert('host', [(3000, 'network_bytes_sent', 9000),
+                                                 (3000, 'cpu_percentage', 25)])
+
+        # Check results
+        self.assertEqual(first, [(1000, 'cpu_percentage', 23)])
+        self.assertEqual(second, [(3000, 'network_bytes_sent_sec', 2000),
+                                  (3000, 'cpu_percentage', 25)])
+
+    def test_convert_per_host(self):
+        # Test sequence
+        self.converter.convert('host1', [(1000, 'network_bytes_received', 0)])
+        other = self.converter.convert('host2', [(2000, 'network_bytes_received', 100)])
+        same = self.converter.convert('host1', [(2000, 'network_bytes_received', 100)])
+
+        # Check results
+        self.assertEqual(other, [])
+        self.assertEqual(same, [(2000, 'network_bytes_received_sec', 100)])
+
+    def test_reset(self):
+        # Test sequence
+        self.converter.convert('host', [(1000, 'network_bytes_sent', 5000)])
+        reset = self.converter.convert('host', [(2000, 'network_bytes_sent', 100)])
+        after = self.converter.convert('host', [(3000, 'network_bytes_sent', 300)])
+
+        # Check results
+        self.assertEqual(reset, [])
+        self.assertEqual(after, [(3000, 'network_bytes_sent_sec', 200)])
+
+    def test_wraparound(self):
+        # Test sequence
+        self.converter.convert('host', [(0, 'network_bytes_sent', 2 ** 32 - 300)])
+        self.converter.convert('host', [(1000, 'network_bytes_sent', 2 ** 32 - 100)])
+        wrapped = self.converter.convert('host', [(2000, 'network_bytes_sent', 100)])
+
+        # Check results
+        self.assertEqual(wrapped, [(2000, 'network_bytes_sent_sec', 200)])
+
+    def test_wraparound_too_fast(self):
+        # Prepare test
+        self.converter.max_rate = 1000
+
+        # Test sequence
+        self.converter.convert('host', [(0, 'network_bytes_sent', 2 ** 32 - 1000)])
+        self.converter.convert('host', [(1000, 'network_bytes_sent', 2 ** 32 - 100)])
+        wrapped = self.converter.convert('host', [(2000, 'network_bytes_sent', 5000)])
+
+        # Check results
+        self.assertEqual(wrapped, [])
+
+    def test_wraparound_implausible(self):
+        # Test sequence
+        self.converter.convert('host', [(1000, 'network_bytes_sent', 3000000000)])
+        reset = self.converter.convert('host', [(2000, 'network_bytes_sent', 100)])
+        self.converter.convert('host', [(3000, 'network_bytes_sent', 3000000000)])
+        self.converter.convert('host', [(4000, 'network_bytes_sent', 3000001000)])
+        restarted = self.converter.convert('host', [(5000, 'network_bytes_sent', 50)])
+
+        # Check results, a 64 bit counter drop is a reset without a
+        # previous rate or far above it
+        self.assertEqual(reset, [])
+        self.assertEqual(restarted, [])
+
+    def test_late_sample(self):
+        # Test sequence
+        self.converter.convert('host', [(2000, 'network_bytes_sent', 500)])
+        late = self.converter.convert('host', [(1000, 'network_bytes_sent', 100)])
+        after = self.converter.convert('host', [(3000, 'network_bytes_sent', 600)])
+
+        # Check results
+        self.assertEqual(late, [])
+        self.assertEqual(after, [(3000, 'network_bytes_sent_sec', 100)])
+
+    def test_convert_per_device(self):
+        # Test sequence
+        self.converter.convert('host', [(1000, 'network_bytes_sent_per_nic/eth0', 0),
+                                        (1000, 'network_bytes_sent_per_nic/lo', 0)])
+        converted = self.converter.convert('host', [(2000, 'network_bytes_sent_per_nic/eth0', 300),
+                                                    (2000, 'network_bytes_sent_per_nic/lo', 5),
+                                                    (2000, 'cpu_percentage_per_core/0', 7)])
+
+        # Check results
+        self.assertEqual(converted, [(2000, 'network_bytes_sent_sec_per_nic/eth0', 300),
+                                     (2000, 'network_bytes_sent_sec_per_nic/lo', 5),
+                                     (2000, 'cpu_percentage_per_core/0', 7)])
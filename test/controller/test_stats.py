@@ -0,0 +1,106 @@
+import json
+import mock
+import stats
+import unittest
+import urllib2
+
+# Tests for Stats module
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        super(StatsTest, self).setUp()
+        self.stats = stats.Stats()
+
+    def test_histogram(self):
+        # Prepare test
+        histogram = stats.Histogram()
+
+        # Test sequence
+        for duration in [0.01, 0.3, 0.3, 0.3, 7, 20000]:
+            histogram.add(duration)
+        summary = histogram.summary()
+
+        # Check results
+        self.assertEqual(summary['count'], 6)
+        self.assertEqual(summary['p50'], 0.5)
+        self.assertEqual(summary['p99'], 20000)
+        self.assertEqual(summary['max'], 20000)
+        self.assertEqual(summary['buckets'][0], 1)
+        self.assertEqual(summary['buckets'][3], 3)
+        self.assertEqual(summary['buckets'][-1], 1)
+
+    @mock.patch('stats.time')
+    def test_record(self,
+                    mock_time):
+        # Prepare test
+        mock_time.side_effect = [10.0, 10.002, 11.0]
+
+        # Test sequence
+        start = self.stats.now()
+        self.stats.record('receive', start)
+        self.stats.record('receive', 10.5)
+        summary = self.stats.snapshot()['receive']
+
+        # Check results
+        self.assertEqual(summary['count'], 2)
+        self.assertAlmostEqual(summary['mean'], 251)
+        self.assertEqual(summary['p50'], 2.5)
+        self.assertAlmostEqual(summary['max'], 500)
+
+    def test_report_reset(self):
+        # Prepare test
+        self.stats.record('db.commit', self.stats.now())
+
+        # Test sequence
+        report = self.stats.report()
+        self.stats.reset()
+
+        # Check results
+        self.assertEqual(report.splitlines()[1].split()[:2], ['db.commit', '1'])
+        self.assertEqual(self.stats.snapshot(), {})
+
+    def test_serve(self):
+        # Prepare test
+        stats.STATS.record('receive.decode', stats.STATS.now())
+        server = stats.serve(0)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%d/' % server.server_address[1]
+
+        # Test sequence
+        text = urllib2.urlopen(url).read()
+        document = json.loads(urllib2.urlopen(url + 'json').read())
+
+        # Check results
+        self.assertIn('receive.decode', text)
+        self.assertEqual(document['stages']['receive.decode']['count'],
+                         stats.STATS.snapshot()['receive.decode']['count'])
+        self.assertEqual(len(document['buckets']), len(stats.BUCKETS))
+
+    @mock.patch('stats.serve')
+    @mock.patch('stats.signal')
+    def test_expose(self,
+                    mock_signal,
+                    mock_serve):
+        # Test sequence
+        stats.expose(0)
+        stats.expose(8100)
+
+        # Check results
+        mock_signal.signal.assert_called_with(mock_signal.SIGUSR1, stats.dump)
+        mock_serve.assert_called_once_with(8100)
+
+    @mock.patch('stats.os')
+    @mock.patch('stats.signal')
+    def test_forward(self,
+                     mock_signal,
+                     mock_os):
+        # Test sequence
+        stats.forward([101, 102])
+        relay = mock_signal.signal.call_args[0][1]
+        relay(mock_signal.SIGUSR1, None)
+
+        # Check results
+        self.assertEqual(mock_signal.signal.call_args[0][0], mock_signal.SIGUSR1)
+        self.assertEqual(mock_os.kill.call_args_list,
+                         [mock.call(101, mock_signal.SIGUSR1),
+                          mock.call(102, mock_signal.SIGUSR1)])